@@ -0,0 +1,296 @@
+'''
+dripline-bench: measure request throughput and latency of a Spimescape with synthetic endpoints.
+
+The service is either run against a real broker, with clients using Interface, or driven through an in-memory
+stand-in for the broker which passes encoded requests and replies between client threads and a single service
+thread (like the service's ioloop), so that the cost of dripline itself can be measured without a broker.
+'''
+
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import queue
+import random
+import threading
+import time
+import types
+import uuid
+
+from .core import constants
+from .core.endpoint import Endpoint
+from .core.exceptions import DriplineTimeoutError
+from .core.interface import Interface
+from .core.message import Message, RequestMessage
+from .core.spimescape import Spimescape
+from .core.utilities import fancy_doc
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 95, 99, 99.9)
+
+
+__all__.append('SyntheticEndpoint')
+@fancy_doc
+class SyntheticEndpoint(Endpoint):
+    '''
+    Endpoint answering a get with a payload of a configurable size, and storing the value of a set
+    '''
+
+    def __init__(self, payload_size=16, **kwargs):
+        '''
+        payload_size (int): number of characters in the value returned by a get
+        '''
+        Endpoint.__init__(self, **kwargs)
+        self.value = 'x' * int(payload_size)
+
+    def on_get(self):
+        return {'value_raw': self.value}
+
+    def on_set(self, value):
+        self.value = value
+
+
+__all__.append('LoopbackBroker')
+class LoopbackBroker(object):
+    '''
+    In-memory stand-in for the broker: requests from any thread are queued to one service thread, which handles them
+    with the service's usual request path; encoded replies are routed back to the waiting client by correlation_id.
+    '''
+
+    def __init__(self, service):
+        self.service = service
+        self._requests = queue.Queue()
+        self._replies = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        service.send_reply = self._send_reply
+
+    def _send_reply(self, properties, reply):
+        reply.sender_info['service_name'] = self.service.name
+        with self._lock:
+            waiting = self._replies.get(properties.correlation_id)
+        if waiting is not None:
+            waiting.put(reply.to_json())
+
+    def _serve(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            routing_key, properties, body = item
+            try:
+                self.service.on_request_message(None, types.SimpleNamespace(routing_key=routing_key), properties, body)
+            except Exception as err:
+                logger.error('request to <{}> raised: {}'.format(routing_key, err))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, name='loopback-service')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._requests.put(None)
+        self._thread.join(5)
+
+    def request(self, target, request, timeout=10):
+        '''
+        Send <request> to <target>, returning the decoded reply
+        '''
+        correlation_id = str(uuid.uuid4())
+        waiting = queue.Queue()
+        with self._lock:
+            self._replies[correlation_id] = waiting
+        # stand-in for the pika properties object passed to request handlers
+        properties = types.SimpleNamespace(content_encoding='application/json', correlation_id=correlation_id, reply_to='loopback')
+        try:
+            self._requests.put((target, properties, request.to_json()))
+            try:
+                return Message.from_json(waiting.get(timeout=timeout))
+            except queue.Empty:
+                raise DriplineTimeoutError('request response timed out')
+        finally:
+            with self._lock:
+                del self._replies[correlation_id]
+
+
+def percentile(sorted_values, q):
+    '''
+    nearest-rank percentile <q> (in %) of a sorted list
+    '''
+    if not sorted_values:
+        return None
+    rank = int(round(q / 100. * (len(sorted_values) - 1)))
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def summarize(latencies):
+    '''
+    count, mean and percentiles (in milliseconds) of a list of latencies in seconds
+    '''
+    ordered = sorted(latencies)
+    summary = {'count': len(ordered),
+               'mean': 1e3 * sum(ordered) / len(ordered) if ordered else None,
+              }
+    for q in PERCENTILES:
+        value = percentile(ordered, q)
+        summary['p{}'.format(q).replace('.', '')] = None if value is None else 1e3 * value
+    return summary
+
+
+def parse_mix(mix):
+    '''
+    parse an op mix such as 'get=0.8,set=0.2' into normalized (op, weight) pairs
+    '''
+    pairs = []
+    for item in mix.split(','):
+        op, _, weight = item.partition('=')
+        if op not in ('get', 'set'):
+            raise ValueError('unknown op <{}> in mix; use get and/or set'.format(op))
+        pairs.append((op, float(weight or 1)))
+    total = sum(weight for op, weight in pairs)
+    return [(op, weight / total) for op, weight in pairs]
+
+
+def _client(send, endpoint_names, mix, payload_size, deadline, max_requests, seed, results):
+    '''
+    one client thread: send requests until the deadline (or max_requests), recording each latency by op
+    '''
+    rng = random.Random(seed)
+    ops = [op for op, weight in mix]
+    weights = [weight for op, weight in mix]
+    latencies = {op: [] for op in ops}
+    n_errors = 0
+    n_sent = 0
+    set_value = 'y' * payload_size
+    while time.time() < deadline and (not max_requests or n_sent < max_requests):
+        op = rng.choices(ops, weights)[0]
+        target = rng.choice(endpoint_names)
+        if op == 'get':
+            request = RequestMessage(msgop=constants.OP_GET, payload={'values': []})
+        else:
+            request = RequestMessage(msgop=constants.OP_SET, payload={'values': [set_value]})
+        start = time.time()
+        try:
+            reply = send(target, request)
+            if reply.retcode != 0:
+                n_errors += 1
+        except Exception as err:
+            logger.debug('request failed: {}'.format(err))
+            n_errors += 1
+        latencies[op].append(time.time() - start)
+        n_sent += 1
+    results.append((latencies, n_errors))
+
+
+def run_benchmark(n_clients=4, n_endpoints=10, mix='get=0.8,set=0.2', payload_size=16, duration=10., max_requests=0,
+                  broker=None, startup_wait=2., seed=0):
+    '''
+    Run a benchmark and return its results as a dict. Without a broker, the in-memory LoopbackBroker is used.
+    '''
+    op_mix = parse_mix(mix)
+    service_name = 'dripline_bench_' + uuid.uuid4().hex[:8]
+    service = Spimescape(name=service_name, broker=broker or 'loopback', keys=[])
+    endpoint_names = ['{}_ep{}'.format(service_name, i) for i in range(n_endpoints)]
+    for name in endpoint_names:
+        service.add_endpoint(SyntheticEndpoint(name=name, payload_size=payload_size))
+
+    clients = []
+    if broker is None:
+        loopback = LoopbackBroker(service)
+        loopback.start()
+        sends = [loopback.request] * n_clients
+    else:
+        service_thread = threading.Thread(target=service.run, name='bench-service')
+        service_thread.daemon = True
+        service_thread.start()
+        time.sleep(startup_wait)
+        clients = [Interface(broker, confirm_retcodes=False) for i in range(n_clients)]
+        sends = [client.request for client in clients]
+
+    results = []
+    threads = []
+    start = time.time()
+    deadline = start + duration
+    for i_client, send in enumerate(sends):
+        thread = threading.Thread(target=_client, args=(send, endpoint_names, op_mix, payload_size, deadline, max_requests, seed + i_client, results))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    if broker is None:
+        loopback.stop()
+    else:
+        for client in clients:
+            client.close()
+        # closing the connection from the ioloop thread ends service.run
+        service._closing = True
+        service.call_threadsafe(service.close_connection)
+
+    by_op = {}
+    for latencies, n_errors in results:
+        for op, values in latencies.items():
+            by_op.setdefault(op, []).extend(values)
+    all_latencies = [value for values in by_op.values() for value in values]
+    return {'config': {'n_clients': n_clients,
+                       'n_endpoints': n_endpoints,
+                       'mix': dict(op_mix),
+                       'payload_size': payload_size,
+                       'duration': duration,
+                       'max_requests': max_requests,
+                       'broker': broker or 'loopback',
+                      },
+            'requests': len(all_latencies),
+            'errors': sum(n_errors for latencies, n_errors in results),
+            'elapsed': elapsed,
+            'throughput': len(all_latencies) / elapsed if elapsed > 0 else None,
+            'latency_ms': dict([('all', summarize(all_latencies))] + [(op, summarize(values)) for op, values in by_op.items()]),
+           }
+
+
+def format_results(results):
+    lines = ['{requests} requests ({errors} errors) in {elapsed:.2f} s: {throughput:.1f} requests/s'.format(**results)]
+    for op, summary in sorted(results['latency_ms'].items()):
+        if not summary['count']:
+            continue
+        lines.append('  {:<4} n={:<8} mean={:8.3f}  p50={:8.3f}  p95={:8.3f}  p99={:8.3f}  p999={:8.3f} ms'.format(
+                     op, summary['count'], summary['mean'], summary['p50'], summary['p95'], summary['p99'], summary['p999']))
+    return '\n'.join(lines)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='dripline-bench', description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-b', '--broker', default=None, help='AMQP broker to use; if omitted, the in-memory loopback is used')
+    parser.add_argument('-c', '--clients', type=int, default=4, help='number of concurrent clients')
+    parser.add_argument('-e', '--endpoints', type=int, default=10, help='number of synthetic endpoints')
+    parser.add_argument('-m', '--mix', default='get=0.8,set=0.2', help='op mix, eg. get=0.8,set=0.2')
+    parser.add_argument('-p', '--payload-size', type=int, default=16, help='characters in each get reply and set value')
+    parser.add_argument('-d', '--duration', type=float, default=10., help='seconds to run for')
+    parser.add_argument('-n', '--max-requests', type=int, default=0, help='if > 0, stop each client after this many requests')
+    parser.add_argument('--startup-wait', type=float, default=2., help='seconds to let the service connect to a real broker')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the op and endpoint choices')
+    parser.add_argument('-o', '--json', default=None, help='also write the results to this JSON file')
+    options = parser.parse_args(args)
+    results = run_benchmark(n_clients=options.clients,
+                            n_endpoints=options.endpoints,
+                            mix=options.mix,
+                            payload_size=options.payload_size,
+                            duration=options.duration,
+                            max_requests=options.max_requests,
+                            broker=options.broker,
+                            startup_wait=options.startup_wait,
+                            seed=options.seed,
+                           )
+    print(format_results(results))
+    if options.json:
+        with open(options.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,15 +6,26 @@ The core namespace contains the layers of abstraction over AMQP.
 
 from __future__ import absolute_import
 
+from .aggregation import *
+from .archive import *
 from .constants import *
+from .dispatcher import *
 from .scheduler import *
 from .endpoint import *
 from .exceptions import *
 from .gogol import *
+from .gogol_pool import *
+from .history import *
 from .interface import *
+from .log_decision import *
 from .message import *
+from .metrics import *
 from .provider import *
 from .service import *
+from .socket_provider import *
 from .spime import *
 from .spimescape import *
+from .spool import *
+from .sql_sink import *
+from .topic import *
 from .utilities import *
@@ -0,0 +1,68 @@
+'''
+Constant-memory streaming statistics, used by Spime to publish summaries of readings sampled faster than they are logged.
+'''
+
+from __future__ import absolute_import
+
+import logging
+import math
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+__all__.append('StreamingStatistics')
+class StreamingStatistics(object):
+    '''
+    Running count, min, max, mean and standard deviation of a stream of values (Welford's algorithm).
+    Values which cannot be cast to float are counted separately and otherwise ignored.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.n_non_numeric = 0
+        self.min = None
+        self.max = None
+        self.mean = None
+        self._m2 = 0.
+
+    def add(self, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            self.n_non_numeric += 1
+            return
+        if math.isnan(value):
+            self.n_non_numeric += 1
+            return
+        self.count += 1
+        if self.count == 1:
+            self.min = self.max = self.mean = value
+            self._m2 = 0.
+            return
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def std(self):
+        '''
+        sample standard deviation (None for fewer than two values)
+        '''
+        if self.count < 2:
+            return None
+        return math.sqrt(self._m2 / (self.count - 1))
+
+    def as_dict(self):
+        return {'count': self.count,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.mean,
+                'std': self.std,
+               }
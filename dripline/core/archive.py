@@ -0,0 +1,398 @@
+'''
+Columnar, memory-mapped time-series archive of sensor readings, and the Gogol which fills it from sensor_value alerts.
+
+Each endpoint has a directory holding its segments: .npy files of (time, value_raw, value_cal) records, memory-mapped
+while being written and grown by doubling as they fill, and an index.json listing every segment's time span and row
+count. A segment is closed, and a new one started, when it is full or spans more than segment_duration, or when a
+reading is older than the segment's latest by more than the reorder window. Readings which are not numeric are stored
+as NaN.
+'''
+
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+
+try:
+    import numpy
+    from numpy.lib.format import open_memmap
+except ImportError:
+    # only required if an archive is actually used
+    numpy = None
+
+from .exceptions import DriplineValueError
+from .endpoint import ChunkedResult, Endpoint, get_query
+from .gogol import Gogol
+from .history import _require_numpy, decimate_minmax, to_epoch
+from .spimescape import Spimescape
+from .utilities import fancy_doc
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+__all__.append('SegmentArchive')
+class SegmentArchive(object):
+    '''
+    Per-endpoint archive of memory-mapped, time-ordered segments.
+    '''
+    columns = ('time', 'value_raw', 'value_cal')
+
+    def __init__(self, root, segment_rows=1048576, segment_duration=7*24*3600., initial_segment_rows=1024, reorder_window=60.):
+        '''
+        root (str): directory containing the archive
+        segment_rows (int): most rows per segment file, which bounds its size (24 bytes per row)
+        segment_duration (float): seconds of readings after which a segment is closed even if not full
+        initial_segment_rows (int): rows allocated when a segment is started; its file doubles in size whenever it fills, up to segment_rows
+        reorder_window (float): a reading older than the latest one in the open segment by at most this many seconds is inserted
+            in order; older readings start a new segment (which reads merge back in order)
+        '''
+        _require_numpy('to use a SegmentArchive')
+        self.root = os.path.expanduser(root)
+        self.segment_rows = int(segment_rows)
+        self.segment_duration = float(segment_duration)
+        self.initial_segment_rows = max(min(int(initial_segment_rows), self.segment_rows), 1)
+        self.reorder_window = float(reorder_window)
+        self._dtype = numpy.dtype([(column, 'f8') for column in self.columns])
+        self._indexes = {}
+        self._index_versions = {}
+        self._open = {}
+        self._dirty = set()
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+
+    def _directory(self, endpoint):
+        return os.path.join(self.root, endpoint.replace(os.sep, '_'))
+
+    def endpoints(self):
+        '''
+        names of the endpoints with archived data
+        '''
+        return sorted(name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, 'index.json')))
+
+    def _index_version(self, path):
+        '''
+        identifies a version of an index file, which is replaced (not rewritten in place) whenever it is saved
+        '''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def index(self, endpoint):
+        '''
+        list of segment records (file, start, stop, count), ordered by start time
+
+        The index is reloaded if its file was replaced since it was read (eg. by an ArchiveSink in another process),
+        except for endpoints this archive is appending to, whose index in memory is the most recent.
+        '''
+        if endpoint in self._indexes and endpoint in self._open:
+            return self._indexes[endpoint]
+        path = os.path.join(self._directory(endpoint), 'index.json')
+        version = self._index_version(path)
+        if endpoint not in self._indexes or version != self._index_versions.get(endpoint):
+            segments = []
+            if version is not None:
+                with open(path) as index_file:
+                    segments = json.load(index_file)
+            self._indexes[endpoint] = segments
+            self._index_versions[endpoint] = version
+        return self._indexes[endpoint]
+
+    def _write_index(self, endpoint):
+        directory = self._directory(endpoint)
+        temp_path = os.path.join(directory, 'index.json.tmp')
+        with open(temp_path, 'w') as index_file:
+            json.dump(self.index(endpoint), index_file)
+        os.replace(temp_path, os.path.join(directory, 'index.json'))
+        self._index_versions[endpoint] = self._index_version(os.path.join(directory, 'index.json'))
+
+    def _writable_segment(self, endpoint, timestamp):
+        '''
+        the (record, memmap) of the segment to which a reading at <timestamp> is appended, rotating if needed
+        '''
+        segment, data = self._open.get(endpoint, (None, None))
+        if segment is None:
+            segments = self.index(endpoint)
+            if segments and segments[-1]['count'] < self.segment_rows:
+                # reopen the last segment; rows written after the index was last saved are recovered from the data
+                segment = segments[-1]
+                data = open_memmap(os.path.join(self._directory(endpoint), segment['file']), mode='r+')
+                filled = numpy.isnan(data['time'])
+                segment['count'] = int(numpy.argmax(filled)) if filled.any() else len(data)
+                if segment['count']:
+                    segment['stop'] = float(data['time'][segment['count'] - 1])
+        if segment is not None and (segment['count'] >= self.segment_rows or
+                                    timestamp - segment['start'] > self.segment_duration or
+                                    (segment['count'] and timestamp < max(segment['stop'] - self.reorder_window, segment['start']))):
+            data.flush()
+            segment = None
+        if segment is None:
+            directory = self._directory(endpoint)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # numbered, since segments started by out-of-order readings may share a start time with an earlier one
+            number = len(self.index(endpoint))
+            while os.path.exists(os.path.join(directory, '{:06d}-{:.6f}.npy'.format(number, timestamp))):
+                number += 1
+            segment = {'file': '{:06d}-{:.6f}.npy'.format(number, timestamp), 'start': timestamp, 'stop': timestamp, 'count': 0}
+            data = open_memmap(os.path.join(directory, segment['file']), mode='w+', dtype=self._dtype, shape=(self.initial_segment_rows,))
+            data['time'] = numpy.nan
+            self.index(endpoint).append(segment)
+            self.index(endpoint).sort(key=lambda record: record['start'])
+            # save the index right away, so that rows appended to the new segment can be recovered after a crash
+            self._write_index(endpoint)
+            logger.debug('started segment {} for {}'.format(segment['file'], endpoint))
+        elif segment['count'] >= len(data):
+            data = self._grow(endpoint, segment, data)
+        self._open[endpoint] = (segment, data)
+        return segment, data
+
+    def _grow(self, endpoint, segment, data):
+        '''
+        replace a full segment file with one of twice as many rows (at most segment_rows), returning its memmap
+        '''
+        path = os.path.join(self._directory(endpoint), segment['file'])
+        grown = open_memmap(path + '.tmp', mode='w+', dtype=self._dtype, shape=(min(2 * len(data), self.segment_rows),))
+        grown['time'] = numpy.nan
+        grown[:len(data)] = data
+        grown.flush()
+        os.replace(path + '.tmp', path)
+        logger.debug('grew segment {} for {} to {} rows'.format(segment['file'], endpoint, len(grown)))
+        return grown
+
+    def append(self, endpoint, timestamp, value_raw, value_cal=None):
+        '''
+        Archive a reading; timestamp may be seconds since the epoch, a datetime or a TIME_FORMAT string
+        '''
+        timestamp = to_epoch(timestamp)
+        segment, data = self._writable_segment(endpoint, timestamp)
+        row = [timestamp]
+        for value in (value_raw, value_cal):
+            try:
+                row.append(float(value))
+            except (TypeError, ValueError):
+                row.append(numpy.nan)
+        count = segment['count']
+        if count and timestamp < segment['stop']:
+            # within the reorder window: shift the (few) later rows to insert this one in order
+            position = int(numpy.searchsorted(data['time'][:count], timestamp, side='right'))
+            data[position + 1:count + 1] = data[position:count].copy()
+        else:
+            position = count
+            segment['stop'] = timestamp
+        data[position] = tuple(row)
+        segment['count'] += 1
+        self._dirty.add(endpoint)
+
+    def flush(self):
+        '''
+        Write the open segments to disk and save the index of every endpoint appended to
+        '''
+        for endpoint in self._dirty:
+            self._open[endpoint][1].flush()
+            self._write_index(endpoint)
+        self._dirty.clear()
+
+    def close(self):
+        self.flush()
+        self._open.clear()
+
+    def read(self, endpoint, start=None, stop=None):
+        '''
+        Return the readings of <endpoint> with start <= time <= stop (either may be None for an open range), as a dict
+        of numpy arrays keyed by column. Only the segments overlapping the range are opened (memory-mapped), found with a
+        binary search of the index, and each is sliced with a binary search on its times.
+        '''
+        start = to_epoch(start)
+        stop = to_epoch(stop)
+        segments = self.index(endpoint)
+        starts = numpy.array([segment['start'] for segment in segments])
+        # segments only overlap after out-of-order readings, so the running maximum of their stops is (almost always) their stops
+        stops = numpy.maximum.accumulate([segment['stop'] for segment in segments]) if segments else numpy.empty(0)
+        first = 0 if start is None else int(numpy.searchsorted(stops, start, side='left'))
+        last = len(segments) if stop is None else int(numpy.searchsorted(starts, stop, side='right'))
+        pieces = []
+        for segment in segments[first:last]:
+            if not segment['count'] or (start is not None and segment['stop'] < start):
+                continue
+            if segment['file'] == self._open.get(endpoint, ({}, None))[0].get('file'):
+                data = self._open[endpoint][1][:segment['count']]
+            else:
+                data = numpy.load(os.path.join(self._directory(endpoint), segment['file']), mmap_mode='r')[:segment['count']]
+            first_row = 0 if start is None else numpy.searchsorted(data['time'], start, side='left')
+            last_row = len(data) if stop is None else numpy.searchsorted(data['time'], stop, side='right')
+            pieces.append(data[first_row:last_row])
+        if not pieces:
+            return {column: numpy.empty(0) for column in self.columns}
+        if len(pieces) == 1:
+            records = pieces[0]
+        else:
+            records = numpy.concatenate(pieces)
+            records = records[numpy.argsort(records['time'], kind='mergesort')]
+        return {column: records[column] for column in self.columns}
+
+
+__all__.append('ArchiveSink')
+@fancy_doc
+class ArchiveSink(Gogol):
+    '''
+    Archive sensor_value alerts into a SegmentArchive, one set of segments per endpoint.
+
+    Alerts are consumed in batches (see Gogol's consume_batch_size and consume_batch_latency) and acknowledged once
+    the batch has been flushed to the archive files.
+    '''
+
+    def __init__(self, archive_root=None, segment_rows=1048576, segment_duration=7*24*3600., reorder_window=60., keys=['sensor_value.#'], consume_batch_size=1000, **kwargs):
+        '''
+        archive_root (str): directory containing the archive
+        segment_rows (int): most rows per segment file
+        segment_duration (float): seconds of readings after which a segment is closed even if not full
+        reorder_window (float): seconds by which an alert may be older than the latest one archived for its endpoint and still be inserted in order
+        '''
+        Gogol.__init__(self, keys=keys, consume_batch_size=consume_batch_size, **kwargs)
+        if archive_root is None:
+            raise DriplineValueError('<archive_root> is required to __init__ an ArchiveSink')
+        self.archive = SegmentArchive(root=archive_root, segment_rows=segment_rows, segment_duration=segment_duration, reorder_window=reorder_window)
+        self.n_archived = 0
+
+    def this_consume_batch(self, messages):
+        for message, method in messages:
+            payload = message.payload if isinstance(message.payload, dict) else {'value_raw': message.payload}
+            self.archive.append(method.routing_key.split('.', 1)[-1], message.timestamp, payload.get('value_raw'), payload.get('value_cal'))
+        self.archive.flush()
+        self.n_archived += len(messages)
+
+    def this_consume(self, message, method):
+        self.this_consume_batch([(message, method)])
+
+
+def _as_list(values):
+    '''
+    a numpy array as a list, with NaN replaced by None
+    '''
+    return [None if value != value else value for value in values.tolist()]
+
+
+__all__.append('ArchivedEndpoint')
+@fancy_doc
+class ArchivedEndpoint(Endpoint):
+    '''
+    Read-only view of one endpoint's archived readings: a get returns the latest, and a get to <name>.history returns a time range.
+    '''
+
+    def __init__(self, archive=None, archive_name=None, default_max_points=2000, chunk_points=10000, **kwargs):
+        '''
+        archive (SegmentArchive): archive containing the readings
+        archive_name (str): name of the endpoint in the archive
+        default_max_points (int): decimation applied to history queries which do not give max_points
+        chunk_points (int): history results with more points than this are sent as several replies of at most this many points
+        '''
+        Endpoint.__init__(self, **kwargs)
+        self.archive = archive
+        self.archive_name = archive_name
+        self.default_max_points = default_max_points
+        self.chunk_points = chunk_points
+
+    def on_get(self):
+        for segment in reversed(self.archive.index(self.archive_name)):
+            if segment['count']:
+                data = self.archive.read(self.archive_name, start=segment['stop'], stop=segment['stop'])
+                return {column: _as_list(data[column][-1:])[0] for column in self.archive.columns}
+        return None
+
+    @get_query
+    def history(self, start=None, stop=None, max_points=None):
+        '''
+        Archived readings with start <= time <= stop, decimated with decimate_minmax to at most max_points
+        (0 for no decimation); large results are split into chunks, each with its 'chunk' index and 'n_chunks'
+        '''
+        data = self.archive.read(self.archive_name, start, stop)
+        if max_points is None:
+            max_points = self.default_max_points
+        if max_points:
+            primary = data['value_cal'] if not numpy.all(numpy.isnan(data['value_cal'])) else data['value_raw']
+            indices = decimate_minmax(primary, int(max_points))
+            data = {column: values[indices] for column, values in data.items()}
+        n_points = len(data['time'])
+        if not self.chunk_points or n_points <= self.chunk_points:
+            return {column: _as_list(values) for column, values in data.items()}
+        n_chunks = -(-n_points // self.chunk_points)
+        result = ChunkedResult()
+        for i_chunk in range(n_chunks):
+            these = slice(i_chunk * self.chunk_points, (i_chunk + 1) * self.chunk_points)
+            chunk = {column: _as_list(values[these]) for column, values in data.items()}
+            chunk.update({'chunk': i_chunk, 'n_chunks': n_chunks})
+            result.append(chunk)
+        return result
+
+
+__all__.append('ArchiveQueryService')
+@fancy_doc
+class ArchiveQueryService(Spimescape):
+    '''
+    Serve the contents of a SegmentArchive: each archived endpoint <name> is exposed as an ArchivedEndpoint named
+    <endpoint_prefix><name>, so that eg. a get to archive_cpu_temp.history with payload {'start': ..., 'stop': ..., 'max_points': ...}
+    returns that range. The prefix keeps these bindings apart from those of the live endpoints.
+    '''
+
+    def __init__(self, archive_root=None, endpoint_names=None, endpoint_prefix='archive_', default_max_points=2000, chunk_points=10000,
+                 refresh_interval=60., **kwargs):
+        '''
+        archive_root (str): directory containing the archive
+        endpoint_names (list|None): archived endpoints to serve; by default, every endpoint in the archive, including those added while running
+        endpoint_prefix (str): prefix added to the name of each archived endpoint
+        refresh_interval (float): if > 0 and endpoint_names is None, seconds between checks of the archive for new endpoints to serve
+        '''
+        if archive_root is None:
+            raise DriplineValueError('<archive_root> is required to __init__ an ArchiveQueryService')
+        Spimescape.__init__(self, **kwargs)
+        self.archive = SegmentArchive(root=archive_root)
+        self.endpoint_prefix = endpoint_prefix
+        self.default_max_points = default_max_points
+        self.chunk_points = chunk_points
+        self.refresh_interval = refresh_interval if endpoint_names is None else 0
+        self._refresh_task = None
+        if endpoint_names is None:
+            endpoint_names = self.archive.endpoints()
+        for name in endpoint_names:
+            self._add_archived_endpoint(name)
+
+    def _add_archived_endpoint(self, name):
+        self.add_endpoint(ArchivedEndpoint(name=self.endpoint_prefix + name,
+                                           archive=self.archive,
+                                           archive_name=name,
+                                           default_max_points=self.default_max_points,
+                                           chunk_points=self.chunk_points,
+                                          ))
+
+    def refresh_endpoints(self):
+        '''
+        Serve every endpoint archived since startup (or the last refresh), binding it right away if connected;
+        returns the names of the endpoints added
+        '''
+        added = []
+        for name in self.archive.endpoints():
+            if self.endpoint_prefix + name in self.endpoints:
+                continue
+            self._add_archived_endpoint(name)
+            added.append(name)
+            if self._channel is not None:
+                self._channel.queue_bind(None, self.queue_name, 'requests', self.endpoint_prefix + name + '.#')
+        if added:
+            logger.info('now serving archived endpoints {}'.format(added))
+        return added
+
+    def on_service_start(self):
+        if self.refresh_interval > 0 and self._refresh_task is None:
+            self._refresh_task = self.dispatcher.add(self._scheduled_refresh, self.refresh_interval)
+
+    def _scheduled_refresh(self):
+        try:
+            self.refresh_endpoints()
+        except Exception as err:
+            logger.error('unable to refresh the archived endpoints: {}'.format(err))
+        self._refresh_task = self.dispatcher.add(self._scheduled_refresh, self.refresh_interval)
@@ -0,0 +1,209 @@
+'''
+Service-level dispatcher which owns the timers for all scheduled tasks of a service.
+'''
+
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import time
+import traceback
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+__all__.append('ScheduledTask')
+class ScheduledTask(object):
+    '''
+    Handle for a callback registered with a ScheduleDispatcher; pass it back to cancel or reschedule.
+    '''
+    __slots__ = ('callback', 'due', 'version', 'cancelled')
+
+    def __init__(self, callback, due):
+        self.callback = callback
+        self.due = due
+        self.version = 0
+        self.cancelled = False
+
+    @property
+    def active(self):
+        return not self.cancelled and self.due is not None
+
+
+__all__.append('ScheduleDispatcher')
+class ScheduleDispatcher(object):
+    '''
+    Single heap of scheduled tasks driven by one ioloop timeout.
+
+    Only the earliest due time is ever registered with the ioloop. When it fires, every task due within
+    <coalesce_window> seconds is run in the same pass, so co-due tasks cost one timer wake-up rather than one each.
+    Cancelling and rescheduling are O(log n): stale heap entries are discarded lazily when they reach the top.
+    '''
+
+    def __init__(self, add_timeout, remove_timeout, clock=time.time, coalesce_window=0.001):
+        '''
+        add_timeout (callable): add_timeout(delay, callback) registering a one-shot timer, returning a handle
+        remove_timeout (callable): remove_timeout(handle) cancelling a timer returned by add_timeout
+        clock (callable): returns the current time in seconds
+        coalesce_window (float): tasks due within this many seconds of each other are dispatched together
+        '''
+        self._add_timeout = add_timeout
+        self._remove_timeout = remove_timeout
+        self.clock = clock
+        self.coalesce_window = coalesce_window
+        self._heap = []
+        self._counter = itertools.count()
+        self._timer_handle = None
+        self._timer_due = None
+        self._dispatching = False
+        self._after_pass = []
+        self._n_active = 0
+        self._stats = {'dispatches': 0,
+                       'tasks_run': 0,
+                       'last_lag': 0.,
+                       'max_lag': 0.,
+                       'mean_lag': 0.,
+                      }
+
+    def add(self, callback, delay):
+        '''
+        Schedule callback() to run in <delay> seconds, returning the ScheduledTask handle
+        '''
+        task = ScheduledTask(callback, None)
+        self._push(task, self.clock() + max(delay, 0.))
+        return task
+
+    def add_at(self, callback, due):
+        '''
+        Schedule callback() to run at absolute time <due> (in the dispatcher's clock), returning the ScheduledTask handle
+        '''
+        task = ScheduledTask(callback, None)
+        self._push(task, due)
+        return task
+
+    def call_after_pass(self, callback):
+        '''
+        Run callback() once the tasks of the current dispatch pass have all run, eg. to act on everything they queued.
+        Outside of a dispatch pass, it is scheduled to run as soon as possible.
+        '''
+        if self._dispatching:
+            self._after_pass.append(callback)
+        else:
+            self.add(callback, 0.)
+
+    def cancel(self, task):
+        '''
+        Cancel a task; cancelling None, or a task which has already run or been cancelled, does nothing
+        '''
+        if task is None or not task.active:
+            return
+        task.cancelled = True
+        task.due = None
+        self._n_active -= 1
+
+    def reschedule(self, task, delay):
+        '''
+        Move an existing (or already run) task to run <delay> seconds from now
+        '''
+        self.reschedule_at(task, self.clock() + max(delay, 0.))
+
+    def reschedule_at(self, task, due):
+        if task.active:
+            self._n_active -= 1
+        task.cancelled = False
+        task.version += 1
+        self._push(task, due)
+
+    def _push(self, task, due):
+        task.due = due
+        self._n_active += 1
+        heapq.heappush(self._heap, (due, next(self._counter), task.version, task))
+        if not self._dispatching and (self._timer_due is None or due < self._timer_due):
+            self._arm()
+
+    def _discard_stale(self):
+        heap = self._heap
+        while heap and (heap[0][3].cancelled or heap[0][2] != heap[0][3].version):
+            heapq.heappop(heap)
+
+    def _arm(self):
+        '''
+        (re)register the single ioloop timeout for the earliest due task
+        '''
+        if self._timer_handle is not None:
+            self._remove_timeout(self._timer_handle)
+            self._timer_handle = None
+            self._timer_due = None
+        self._discard_stale()
+        if not self._heap:
+            return
+        self._timer_due = self._heap[0][0]
+        self._timer_handle = self._add_timeout(max(self._timer_due - self.clock(), 0.), self._dispatch)
+
+    def rearm(self):
+        '''
+        Register the timeout again, eg. after the ioloop connection was replaced and its timers were lost
+        '''
+        self._timer_handle = None
+        self._timer_due = None
+        self._arm()
+
+    def _dispatch(self):
+        self._timer_handle = None
+        self._timer_due = None
+        now = self.clock()
+        horizon = now + self.coalesce_window
+        heap = self._heap
+        due_tasks = []
+        while heap and heap[0][0] <= horizon:
+            due, _, version, task = heapq.heappop(heap)
+            if task.cancelled or version != task.version:
+                continue
+            due_tasks.append((due, version, task))
+        stats = self._stats
+        stats['dispatches'] += 1
+        self._dispatching = True
+        for due, version, task in due_tasks:
+            # an earlier callback in this pass may have cancelled or moved the task
+            if task.cancelled or version != task.version:
+                continue
+            task.due = None
+            self._n_active -= 1
+            lag = max(now - due, 0.)
+            stats['tasks_run'] += 1
+            stats['last_lag'] = lag
+            stats['max_lag'] = max(stats['max_lag'], lag)
+            stats['mean_lag'] += (lag - stats['mean_lag']) / stats['tasks_run']
+            try:
+                task.callback()
+            except Exception as err:
+                logger.error('scheduled task raised: {}'.format(err))
+                logger.debug('traceback follows:\n{}'.format(traceback.format_exc()))
+        self._dispatching = False
+        after_pass, self._after_pass = self._after_pass, []
+        for callback in after_pass:
+            try:
+                callback()
+            except Exception as err:
+                logger.error('after-pass callback raised: {}'.format(err))
+                logger.debug('traceback follows:\n{}'.format(traceback.format_exc()))
+        self._arm()
+
+    @property
+    def pending(self):
+        '''
+        number of tasks waiting to run
+        '''
+        return self._n_active
+
+    @property
+    def statistics(self):
+        '''
+        dispatch counts and lag (seconds between a task's due time and the start of the pass which ran it)
+        '''
+        stats = dict(self._stats)
+        stats['pending'] = self._n_active
+        return stats
@@ -2,7 +2,11 @@ from __future__ import absolute_import
 
 from abc import ABCMeta, abstractproperty, abstractmethod
 
+import concurrent.futures
+import datetime
 import functools
+import inspect
+import time
 import traceback
 import types
 import uuid
@@ -20,14 +24,71 @@ from .message import Message, RequestMessage, ReplyMessage
 from .utilities import fancy_doc
 
 
-__all__ = ['Endpoint',
+__all__ = ['ChunkedResult',
+           'Endpoint',
            'calibrate',
+           'get_query',
           ]
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+def _apply_calibration(endpoint, very_raw, cal_functions):
+    '''
+    build the {value_raw, value_cal} dict for a raw reading using <endpoint>'s calibration
+    '''
+    if isinstance(very_raw, list):
+        very_raw = very_raw[0]
+    val_dict = {'value_raw':very_raw}
+    logger.debug('attempting to calibrate')
+    if val_dict['value_raw'] is None:
+        return None
+    if endpoint._calibration is None:
+        pass
+    elif isinstance(endpoint._calibration, str):
+        evaluator = asteval.Interpreter(usersyms=cal_functions)
+        if isinstance(val_dict['value_raw'], float):
+            eval_str = endpoint._calibration.format(val_dict['value_raw'])
+        elif isinstance(val_dict['value_raw'], six.string_types):
+            eval_str = endpoint._calibration.format(val_dict['value_raw'].strip())
+        else:
+            eval_str = endpoint._calibration.format(val_dict['value_raw'])
+        logger.debug("formatted cal is:\n{}".format(eval_str))
+        try:
+            cal = evaluator(eval_str)
+        except OverflowError:
+            logger.debug('GOT AN OVERFLOW ERROR')
+            cal = None
+        except Exception as e:
+            raise exceptions.DriplineValueError(repr(e), result=val_dict)
+        if cal is not None:
+            val_dict['value_cal'] = cal
+    elif isinstance(endpoint._calibration, dict):
+        logger.debug('calibration is dictionary, looking up value')
+        if val_dict['value_raw'] in endpoint._calibration:
+            val_dict['value_cal'] = endpoint._calibration[val_dict['value_raw']]
+        else:
+            raise exceptions.DriplineValueError('raw value <{}> not in cal dict'.format(repr(val_dict['value_raw'])), result=val_dict)
+    else:
+        logger.warning('the _calibration property is of unknown type')
+    return val_dict
+
+
+def _chain_future(future, fun):
+    '''
+    a Future resolving to fun(<future>'s result), or to its exception
+    '''
+    chained = concurrent.futures.Future()
+    def on_done(done):
+        try:
+            chained.set_result(fun(done.result()))
+        except Exception as err:
+            chained.set_exception(err)
+    future.add_done_callback(on_done)
+    return chained
+
+
 def calibrate(cal_functions=None):
     if callable(cal_functions):
         cal_functions = {cal_functions.__name__: cal_functions}
@@ -38,45 +99,63 @@ def calibrate(cal_functions=None):
     def calibration(fun):
         def wrapper(self, *args, **kwargs):
             very_raw = fun(self)
-            if isinstance(very_raw, list):
-                very_raw = very_raw[0]
-            val_dict = {'value_raw':very_raw}
-            logger.debug('attempting to calibrate')
-            if val_dict['value_raw'] is None:
-                return None
-            if self._calibration is None:
-                pass
-            elif isinstance(self._calibration, str):
-                evaluator = asteval.Interpreter(usersyms=cal_functions)
-                if isinstance(val_dict['value_raw'], float):
-                    eval_str = self._calibration.format(val_dict['value_raw'])
-                elif isinstance(val_dict['value_raw'], six.string_types):
-                    eval_str = self._calibration.format(val_dict['value_raw'].strip())
-                else:
-                    eval_str = self._calibration.format(val_dict['value_raw'])
-                logger.debug("formatted cal is:\n{}".format(eval_str))
-                try:
-                    cal = evaluator(eval_str)
-                except OverflowError:
-                    logger.debug('GOT AN OVERFLOW ERROR')
-                    cal = None
-                except Exception as e:
-                    raise exceptions.DriplineValueError(repr(e), result=val_dict)
-                if cal is not None:
-                    val_dict['value_cal'] = cal
-            elif isinstance(self._calibration, dict):
-                logger.debug('calibration is dictionary, looking up value')
-                if val_dict['value_raw'] in self._calibration:
-                    val_dict['value_cal'] = self._calibration[val_dict['value_raw']]
-                else:
-                    raise exceptions.DriplineValueError('raw value <{}> not in cal dict'.format(repr(val_dict['value_raw'])), result=val_dict)
-            else:
-                logger.warning('the _calibration property is of unknown type')
-            return val_dict
+            if isinstance(very_raw, concurrent.futures.Future):
+                # eg. a reading through Provider.send_batched, calibrated once the batch has been sent
+                return _chain_future(very_raw, lambda value: _apply_calibration(self, value, cal_functions))
+            return _apply_calibration(self, very_raw, cal_functions)
+        # kept so that raw values obtained elsewhere (eg. a provider scan) can be calibrated the same way
+        wrapper.cal_functions = cal_functions
         return wrapper
     return calibration
 
 
+def get_query(fun):
+    '''
+    Mark an endpoint method as a query which can be called with an OP_GET to <endpoint>.<method name>.
+    The request's values and remaining payload fields are passed to the method as its args and kwargs.
+    '''
+    fun.get_query = True
+    return fun
+
+
+class ChunkedResult(list):
+    '''
+    Returned by an endpoint method whose result is too large for one message: each element is sent as a separate
+    reply to the request (with the same correlation_id), so the requester should collect them as a multi-reply.
+    '''
+    pass
+
+
+def _is_deferred(result):
+    '''
+    True if an endpoint method returned something which must complete before a reply can be sent
+    '''
+    return isinstance(result, concurrent.futures.Future) or inspect.isawaitable(result)
+
+
+def _error_reply_fields(err):
+    '''
+    map an exception raised while handling a request onto (retcode, result, return_msg) for the reply
+    '''
+    if isinstance(err, exceptions.DriplineException):
+        logger.debug("got a dripline exception: {}".format(err.retcode))
+        return err.retcode, err.result, str(err)
+    logger.error('got an error: {}'.format(str(err)))
+    logger.error('traceback follows:\n{}'.format(''.join(traceback.format_exception(type(err), err, err.__traceback__))))
+    return 999, None, str(err)
+
+
+def _queue_wait(timestamp):
+    '''
+    seconds since a message with <timestamp> was sent, by the local clock; None if the timestamp cannot be parsed
+    '''
+    try:
+        sent = datetime.datetime.strptime(timestamp, constants.TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+    return max((datetime.datetime.utcnow() - sent).total_seconds(), 0.)
+
+
 def _get_on_set(self, fun):
     @functools.wraps(fun)
     def wrapper(*args, **kwargs):
@@ -88,6 +167,9 @@ def _get_on_set(self, fun):
 @fancy_doc
 class Endpoint(object):
 
+    #: cmds which are passed the request's lockout_key, to check it themselves
+    _lockout_key_cmds = ('lock',)
+
     def __init__(self, name=None, calibration=None, get_on_set=False, **kwargs):
         '''
         name (str): unique identifier across all dripline services (used to determine routing key)
@@ -144,15 +226,26 @@ class Endpoint(object):
             raise exceptions.DriplineAccessDenied('Endpoint <{}> is locked; lockout_key required'.format(self.name))
 
     def handle_request(self, channel, method, properties, request):
+        '''
+        Decode and execute a request, then reply to it.
+
+        If the endpoint method returns a concurrent.futures.Future or an awaitable (eg. a coroutine), the reply is deferred
+        until it completes and request handling returns immediately so that the ioloop is not blocked; a Future which
+        completes once the deferred reply has been sent is then returned (otherwise None is).
+        '''
         logger.debug('handling request:{}'.format(request))
         result = None
         retcode = None
         return_msg = None
+        op = 'unknown'
+        queue_wait = None
+        handler_start = None
         try:
             routing_key_specifier = method.routing_key.replace(self.name, '', 1).lstrip('.')
             logger.debug('routing key specifier is: {}'.format(routing_key_specifier))
 
             msg = Message.from_encoded(request, properties.content_encoding)
+            queue_wait = _queue_wait(msg.timestamp)
             if msg.payload is None:
                 msg.payload = {}
             logger.info('got a {} request: {}'.format(msg.msgop, msg.payload))
@@ -171,33 +264,106 @@ class Endpoint(object):
             for const_name in dir(constants):
                 if getattr(constants, const_name) == msg.msgop:
                     method_name = '_on_' + const_name.split('_')[-1].lower()
+            op = method_name[len('_on_'):] or op
             endpoint_method = getattr(self, method_name)
             logger.debug('method is: {}'.format(endpoint_method))
 
             self._check_lockout_conditions(msg, these_args, these_kwargs)
             logger.debug('args are:\n{}'.format(these_args))
             logger.debug('kwargs are:\n{}'.format(these_kwargs))
+            handler_start = time.time()
             result = endpoint_method(*these_args, **these_kwargs)
+            if _is_deferred(result):
+                return self._defer_reply(properties, result, op=op, handler_start=handler_start, queue_wait=queue_wait)
             if isinstance(result, types.MethodType):
                 raise exceptions.DriplineValueError('endpoint returned a method reference; perhaps OP_GET was used for a cmd?', result=repr(result))
+            if isinstance(result, ChunkedResult):
+                for chunk in result[:-1]:
+                    self.service.send_reply(properties, ReplyMessage(payload=chunk))
+                result = result[-1] if result else None
             logger.debug('\n endpoint method returned \n')
             if result is None and return_msg is None:
                 return_msg = "operation completed silently"
-        except exceptions.DriplineException as err:
-            logger.debug("got a dripline exception: {}".format(err.retcode))
-            retcode = err.retcode
-            result = err.result
-            return_msg = str(err)
         except Exception as err:
-            logger.error('got an error: {}'.format(str(err)))
-            logger.error('traceback follows:\n{}'.format(traceback.format_exc()))
-            return_msg = str(err)
-            retcode = 999
+            retcode, result, return_msg = _error_reply_fields(err)
         logger.debug('request method execution complete')
+        self._record_request(op, retcode, handler_start, queue_wait)
         reply = ReplyMessage(payload=result, retcode=retcode, return_msg=return_msg)
         self.service.send_reply(properties, reply)
         logger.debug('reply sent')
 
+    def _record_request(self, op, retcode, handler_start, queue_wait):
+        '''
+        count a handled request in the service's request_metrics, if it has any
+        '''
+        metrics = getattr(self.service, 'request_metrics', None)
+        if metrics is None:
+            return
+        handler_time = 0. if handler_start is None else time.time() - handler_start
+        metrics.record_request(self.name, op, retcode or 0, handler_time, queue_wait)
+
+    def _defer_reply(self, properties, pending, op='unknown', handler_start=None, queue_wait=None):
+        '''
+        Arrange for the reply to a request to be sent once <pending> completes; the request is counted in the service's
+        request_metrics (as <op>, handled from <handler_start> and after <queue_wait>) when the reply is sent.
+
+        Completion is handed back to the service's ioloop thread before replying; if the service has a deferred_timeout
+        and it expires first, a DriplineTimeoutError reply is sent instead and the late result is discarded.
+        Returns a Future which completes, on the ioloop thread, once the reply has been sent.
+        '''
+        if not isinstance(pending, concurrent.futures.Future):
+            pending = self.service.run_awaitable(pending)
+        logger.debug('reply to <{}> request deferred'.format(self.name))
+        state = {'replied': False, 'timeout_handle': None}
+        replied = concurrent.futures.Future()
+
+        def finish(result=None, error=None):
+            if state['replied']:
+                logger.warning('discarding late result for <{}> request'.format(self.name))
+                return
+            state['replied'] = True
+            if state['timeout_handle'] is not None:
+                self.service._connection.remove_timeout(state['timeout_handle'])
+            retcode = None
+            return_msg = None
+            if error is not None:
+                retcode, result, return_msg = _error_reply_fields(error)
+            elif isinstance(result, types.MethodType):
+                retcode, result, return_msg = _error_reply_fields(exceptions.DriplineValueError('endpoint returned a method reference; perhaps OP_GET was used for a cmd?', result=repr(result)))
+            elif isinstance(result, ChunkedResult):
+                for chunk in result[:-1]:
+                    self.service.send_reply(properties, ReplyMessage(payload=chunk))
+                result = result[-1] if result else None
+            if retcode is None and result is None:
+                return_msg = "operation completed silently"
+            self._record_request(op, retcode, handler_start, queue_wait)
+            reply = ReplyMessage(payload=result, retcode=retcode, return_msg=return_msg)
+            try:
+                self.service.send_reply(properties, reply)
+            finally:
+                replied.set_result(None)
+            logger.debug('deferred reply sent')
+
+        def on_done(future):
+            try:
+                result = future.result()
+            except concurrent.futures.CancelledError:
+                self.service.call_threadsafe(finish, None, exceptions.DriplineTimeoutError('request handling was cancelled'))
+            except Exception as err:
+                self.service.call_threadsafe(finish, None, err)
+            else:
+                self.service.call_threadsafe(finish, result)
+
+        def on_timeout():
+            state['timeout_handle'] = None
+            finish(error=exceptions.DriplineTimeoutError('request handling exceeded {} seconds'.format(self.service.deferred_timeout)))
+            pending.cancel()
+
+        if self.service.deferred_timeout:
+            state['timeout_handle'] = self.service._connection.add_timeout(self.service.deferred_timeout, on_timeout)
+        pending.add_done_callback(on_done)
+        return replied
+
     def _on_get(self, *args, **kwargs):
         '''
         WARNING! you should *NOT* override this method
@@ -209,6 +375,8 @@ class Endpoint(object):
                 result = getattr(self, attribute)
             except AttributeError:
                 raise exceptions.DriplineValueError('{}({}) has no <{}> attribute'.format(self.name, self.__class__.__name__, attribute))
+            if getattr(result, 'get_query', False):
+                result = result(*args, **{k:v for k,v in kwargs.items() if k != 'routing_key_specifier'})
         else:
             result = self.on_get()
         return result
@@ -263,11 +431,18 @@ class Endpoint(object):
             raise exceptions.DriplineDeprecated('specifying cmd name in values array is deprecated (use an RKS)')
             #method_name = args[0:1][0].replace('-', '_')
             #args = args[1:len(args)]
-        if method_name != 'lock' and 'lockout_key' in kwargs:
+        if method_name not in self._lockout_key_cmds and 'lockout_key' in kwargs:
             kwargs.pop('lockout_key')
         result = getattr(self, method_name)(*args, **kwargs)
         return result
 
+    def on_service_start(self):
+        '''
+        Called on the ioloop once the service is connected, before its setup_calls; endpoints which need periodic
+        background work (eg. connection health checks) start it here. Does nothing by default.
+        '''
+        pass
+
     def ping(self, *args, **kwargs):
         '''
         ignore all details and respond with an empty message
@@ -293,6 +468,14 @@ class Endpoint(object):
                 logger.debug('{} has no _set_condition attribute, skipped!'.format(key))
         return None
 
+    def apply_calibration(self, value_raw):
+        '''
+        Calibrate a raw value obtained outside of on_get (eg. by a provider scan), returning the same dict a
+        calibrated on_get would, using the calibration functions on_get is decorated with (if any)
+        '''
+        cal_functions = getattr(self.on_get, 'cal_functions', {})
+        return _apply_calibration(self, value_raw, cal_functions)
+
     @property
     def is_locked(self):
         return bool(self.__lockout_key)
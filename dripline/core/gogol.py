@@ -5,45 +5,195 @@ Basic abstraction for binding to the alerts exchange
 from __future__ import absolute_import
 
 # standard libs
+import inspect
 import logging
+import time
 import traceback
 import uuid
 
 # internal imports
 from . import exceptions
-from .message import Message
+from .history import to_epoch
+from .message import Message, AlertMessage
 from .service import Service
 from .spimescape import Spimescape
+from .topic import TopicTrie, binding_key
 from .utilities import fancy_doc
 
-__all__ = ['Gogol']
+__all__ = ['Gogol',
+           'on_alert',
+          ]
 
 logger = logging.getLogger(__name__)
 
 
+def on_alert(*patterns):
+    '''
+    Mark a Gogol method as the handler for alerts whose routing key matches any of <patterns>, eg. @on_alert('sensor_value.*_temp').
+    The method is called as method(message, method_frame); every matching handler is called for each alert.
+    '''
+    def decorator(fun):
+        fun.alert_patterns = getattr(fun, 'alert_patterns', ()) + patterns
+        return fun
+    return decorator
+
+
 @fancy_doc
 class Gogol(Spimescape):
-    def __init__(self, exchange='requests', keys=['#'], name=None, **kwargs):
+    def __init__(self, exchange='requests', keys=['#'], name=None, consume_batch_size=0, consume_batch_latency=1.,
+                 shared_queue=None, hash_exchange=None, **kwargs):
         '''
         exchange (str): (overrides Service default)
         keys (list): (overrides Service default)
+        consume_batch_size (int): if > 0, alerts are buffered and passed to this_consume_batch in groups of up to this many,
+            and acknowledged together (with a single multiple ack) only once the batch has been consumed
+        consume_batch_latency (float): a partial batch is consumed once its oldest alert has waited this many seconds
+        shared_queue (str|None): if given, consume alerts from this durable, non-exclusive queue, so that several Gogols share (compete for) them; requests to this Gogol (and broadcasts) are still received on a private queue named after it
+        hash_exchange (str|None): if given, alerts are routed through this consistent-hash exchange (requires the rabbitmq_consistent_hash_exchange plugin),
+            so that each Gogol bound to it receives every alert for a subset of routing keys, preserving per-endpoint order
 
         '''
         logger.debug('Gogol initializing')
+        if shared_queue is not None and hash_exchange is not None:
+            raise exceptions.DriplineValueError('a Gogol cannot use both a shared_queue and a hash_exchange')
         if name is None:
             name = __name__ + '-' + uuid.uuid1().hex[:12]
         Spimescape.__init__(self, exchange=exchange, keys=keys, name=name, **kwargs)
         if isinstance(keys, str):
            keys = [keys]
-        self._bindings += [["alerts", a_key] for a_key in keys]
+        self.alert_keys = list(keys)
+        self.hash_exchange = hash_exchange
+        if hash_exchange is None:
+            self._bindings += [["alerts", a_key] for a_key in keys]
+        else:
+            # the binding key of a consistent-hash exchange is this queue's weight
+            self._bindings.append([hash_exchange, '1'])
+        self._request_consumer_tag = None
+        if shared_queue is not None:
+            self.queue_name = shared_queue
+            self.queue_exclusive = False
+        self.alert_handlers = TopicTrie()
+        for attribute, member in inspect.getmembers(type(self), inspect.isfunction):
+            for pattern in getattr(member, 'alert_patterns', ()):
+                self.add_alert_handler(pattern, getattr(self, attribute))
+        self.n_alerts_received = 0
+        #: if set to a StreamingStatistics, the delay (in seconds) between each alert's timestamp and its receipt is added to it
+        self.lag_statistics = None
+        self.consume_batch_size = consume_batch_size
+        self.consume_batch_latency = consume_batch_latency
+        self._consume_buffer = []
+        self._consume_channel = None
+        self._consume_flush_task = None
+        self.n_consumed_batches = 0
+        self.n_batched_alerts = 0
+        self.n_failed_alerts = 0
+        if self.consume_batch_size > 0 and self.ack_mode != 'late':
+            # a multiple ack for other messages could cover buffered alerts which have not been consumed yet
+            if self.ack_mode == 'batched':
+                logger.warning('batched acks cannot be combined with consume_batch_size, using late acks')
+            self.ack_mode = 'late'
+
+    def add_alert_handler(self, pattern, handler):
+        '''
+        Call handler(message, method) for alerts matching the topic <pattern>; the binding needed to receive them is
+        added if required, which only takes effect when (re)connecting
+        '''
+        self.alert_handlers.add(pattern, handler)
+        key = binding_key(pattern)
+        if self.hash_exchange is None and ['alerts', key] not in self._bindings:
+            self._bindings.append(['alerts', key])
+        elif self.hash_exchange is not None and key not in self.alert_keys:
+            self.alert_keys.append(key)
 
     def this_consume(self, message, method):
-        raise NotImplementedError('you must set this_consume to a valid function')
+        '''
+        Dispatch an alert to every handler registered (with on_alert or add_alert_handler) for a matching pattern.
+        Without any handlers this must be overridden.
+        '''
+        if not len(self.alert_handlers):
+            raise NotImplementedError('you must set this_consume to a valid function')
+        handlers = self.alert_handlers.match(method.routing_key)
+        if not handlers:
+            logger.debug('no handler for alert to <{}>'.format(method.routing_key))
+        for handler in handlers:
+            handler(message, method)
+
+    def this_consume_batch(self, messages):
+        '''
+        Consume a batch of alerts; the default calls this_consume for each. Override to eg. insert them in bulk.
+        If this raises anything other than a DriplineException, the batch's alerts are retried one at a time (see
+        consume_singly), so an override should consume all of a batch or none of it (eg. in one transaction).
+
+        messages (list): (message, method) pairs, in delivery order
+        '''
+        for message, method in messages:
+            self.this_consume(message, method)
+
+    def acknowledge_handled(self, basic_deliver, message):
+        '''
+        Alerts being consumed in batches are acknowledged by flush_consume_batch instead
+        '''
+        if self.consume_batch_size > 0 and isinstance(message, AlertMessage):
+            return
+        Service.acknowledge_handled(self, basic_deliver, message)
+
+    def flush_consume_batch(self):
+        '''
+        Consume the buffered alerts now, acknowledging all of them with one multiple ack if that succeeds
+        '''
+        self.dispatcher.cancel(self._consume_flush_task)
+        self._consume_flush_task = None
+        batch = self._consume_buffer
+        self._consume_buffer = []
+        if not batch:
+            return
+        if self._consume_channel is not self._channel:
+            # delivery tags belong to a channel which has since closed; the broker will redeliver them
+            logger.warning('channel closed, discarding {} buffered alerts'.format(len(batch)))
+            return
+        last_tag = batch[-1][1].delivery_tag
+        try:
+            self.this_consume_batch(batch)
+        except exceptions.DriplineException as err:
+            logger.warning(str(err))
+        except Exception as err:
+            logger.error('batch of {} alerts failed, retrying them one at a time:\n{}'.format(len(batch), str(err)))
+            logger.debug('traceback follows:\n{}'.format(traceback.format_exc()))
+            self.consume_singly(batch)
+            return
+        self.acknowledge_message(last_tag, multiple=True)
+        self.n_consumed_batches += 1
+        self.n_batched_alerts += len(batch)
+
+    def consume_singly(self, batch):
+        '''
+        Consume the alerts of a failed batch one at a time, so that one which cannot be consumed does not hold up the others.
+        Each is acknowledged once consumed; one which fails is rejected, and requeued only if it was not already
+        redelivered (as for ack_mode 'late'), so that it is dropped rather than redelivered forever.
+        '''
+        for message, method in batch:
+            try:
+                self.this_consume_batch([(message, method)])
+            except exceptions.DriplineException as err:
+                logger.warning(str(err))
+            except Exception as err:
+                logger.error('alert to <{}> could not be consumed, {}: {}'.format(method.routing_key, 'dropping it' if method.redelivered else 'requeueing it', err))
+                self.n_failed_alerts += 1
+                self.reject_message(method.delivery_tag, requeue=not method.redelivered)
+                continue
+            self.acknowledge_message(method.delivery_tag)
+            self.n_batched_alerts += 1
 
     def on_alert_message(self, channel, method, properties, message):
         logger.debug('in process_message callback')
+        self.n_alerts_received += 1
         try:
             message_unpacked = Message.from_encoded(message, properties.content_encoding)
+            if self.lag_statistics is not None:
+                self.lag_statistics.add(time.time() - to_epoch(message_unpacked.timestamp))
+            if self.consume_batch_size > 0:
+                self._buffer_alert(channel, message_unpacked, method)
+                return
             self.this_consume(message_unpacked, method)
         except exceptions.DriplineException as err:
             logger.warning(str(err))
@@ -52,6 +202,67 @@ class Gogol(Spimescape):
             logger.debug('traceback follows:\n{}'.format(traceback.format_exc()))
             raise
 
+    def on_queue_declareok(self, method_frame):
+        if not self.queue_exclusive:
+            self._bind_shared_queue()
+            return
+        if self.hash_exchange is None:
+            Service.on_queue_declareok(self, method_frame)
+            return
+        logger.debug('Declaring consistent-hash exchange {}'.format(self.hash_exchange))
+        self._channel.exchange_declare(lambda frame: self._on_hash_exchange_declareok(method_frame),
+                                       self.hash_exchange,
+                                       'x-consistent-hash',
+                                      )
+
+    def _on_hash_exchange_declareok(self, method_frame):
+        for a_key in self.alert_keys:
+            logger.debug('Binding alerts to {} with {}'.format(self.hash_exchange, a_key))
+            self._channel.exchange_bind(None, self.hash_exchange, 'alerts', a_key)
+        Service.on_queue_declareok(self, method_frame)
+
+    def _bind_shared_queue(self):
+        '''
+        Bind only the alerts to the shared queue, and declare this Gogol's private queue for its requests; any other
+        Gogol sharing the queue could otherwise receive them, and only one of them would receive each broadcast
+        '''
+        for exchange, key in self._bindings:
+            if exchange != 'requests':
+                logger.debug('Binding {} to {} with {}'.format(exchange, self.queue_name, key))
+                self._channel.queue_bind(None, self.queue_name, exchange, key)
+        logger.debug('Declaring queue {}'.format(self.name))
+        self._channel.queue_declare(self._on_request_queue_declareok, self.name, exclusive=True, auto_delete=True)
+
+    def _on_request_queue_declareok(self, method_frame):
+        for exchange, key in self._bindings:
+            if exchange == 'requests':
+                logger.debug('Binding {} to {} with {}'.format(exchange, self.name, key))
+                self._channel.queue_bind(None, self.name, exchange, key)
+        self.start_consuming()
+
+    def start_consuming(self):
+        Service.start_consuming(self)
+        if not self.queue_exclusive:
+            self._request_consumer_tag = self._channel.basic_consume(self.on_message, self.name)
+
+    def stop_consuming(self):
+        if self._channel and self._request_consumer_tag is not None:
+            self._channel.basic_cancel(None, self._request_consumer_tag)
+            self._request_consumer_tag = None
+        Service.stop_consuming(self)
+
+    def _buffer_alert(self, channel, message, method):
+        if channel is not self._consume_channel:
+            if self._consume_buffer:
+                logger.warning('channel changed, discarding {} buffered alerts'.format(len(self._consume_buffer)))
+            self._consume_buffer = []
+            self._consume_channel = channel
+        self._consume_buffer.append((message, method))
+        if len(self._consume_buffer) >= self.consume_batch_size:
+            self.flush_consume_batch()
+        elif self._consume_flush_task is None:
+            self._consume_flush_task = self.dispatcher.add(self.flush_consume_batch, self.consume_batch_latency)
+
     def start(self):
         '''
         Begin consuming by calling `self.run` (from Spimescape)
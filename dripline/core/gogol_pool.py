@@ -0,0 +1,210 @@
+'''
+Supervisor running several Gogol worker processes as competing consumers of one alert stream.
+'''
+
+from __future__ import absolute_import
+
+import importlib
+import logging
+import multiprocessing
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from .aggregation import StreamingStatistics
+from .exceptions import DriplineValueError
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+def _resolve_class(gogol_class):
+    '''
+    accept either a class or its dotted path, eg. 'my_package.loggers.SensorLogger'
+    '''
+    if not isinstance(gogol_class, str):
+        return gogol_class
+    module_name, _, class_name = gogol_class.rpartition('.')
+    if not module_name:
+        raise DriplineValueError('gogol_class <{}> must be given as module.Class'.format(gogol_class))
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def _run_worker(gogol_class, gogol_kwargs, metrics_queue, report_interval):
+    '''
+    target of each worker process: run a Gogol, reporting its counters to the supervisor every report_interval seconds
+    '''
+    gogol = _resolve_class(gogol_class)(**gogol_kwargs)
+    gogol.lag_statistics = StreamingStatistics()
+
+    def report():
+        while True:
+            time.sleep(report_interval)
+            lag, gogol.lag_statistics = gogol.lag_statistics, StreamingStatistics()
+            metrics_queue.put({'name': gogol.name,
+                               'time': time.time(),
+                               'received': gogol.n_alerts_received,
+                               'lag': lag.as_dict(),
+                              })
+    reporter = threading.Thread(target=report, name='{}-metrics'.format(gogol.name))
+    reporter.daemon = True
+    reporter.start()
+    gogol.start()
+
+
+__all__.append('GogolSupervisor')
+class GogolSupervisor(object):
+    '''
+    Launch and monitor N worker processes, each running a Gogol.
+
+    By default the workers consume from one shared, non-exclusive queue, so the broker spreads alerts across them
+    (with at most prefetch_count unacknowledged alerts in flight per worker). With a hash_exchange, each worker instead
+    has its own queue bound to a consistent-hash exchange, so all alerts from a given endpoint reach the same worker in order.
+    Either way, requests reach each worker on its own queue, named after it.
+    Workers acknowledge alerts only once consumed (ack_mode 'late'), so that prefetch_count bounds those in flight and
+    a worker which dies loses none.
+    Workers periodically report their receive counts and lag, which the supervisor aggregates and logs.
+    '''
+
+    def __init__(self, gogol_class, n_workers=2, name=None, shared_queue=None, prefetch_count=100, hash_exchange=None,
+                 report_interval=10., restart_workers=True, **gogol_kwargs):
+        '''
+        gogol_class (class|str): Gogol subclass (or its dotted import path) run by each worker
+        n_workers (int): number of worker processes
+        name (str|None): base name of the workers, which are named <name>-<index>; defaults to the class name
+        shared_queue (str|None): name of the queue shared by the workers; defaults to <name>, unused with a hash_exchange
+        prefetch_count (int): most unacknowledged alerts delivered to each worker at once
+        hash_exchange (str|None): if given, route alerts to the workers through this consistent-hash exchange
+        report_interval (float): seconds between worker metric reports
+        restart_workers (bool): restart worker processes which exit
+        gogol_kwargs: all other kwargs are passed to every worker's Gogol; ack_mode defaults to 'late'
+        '''
+        self.gogol_class = gogol_class
+        self.n_workers = int(n_workers)
+        if name is None:
+            name = (gogol_class if isinstance(gogol_class, str) else gogol_class.__name__).rpartition('.')[2]
+        self.name = name
+        self.report_interval = report_interval
+        self.restart_workers = restart_workers
+        self.gogol_kwargs = dict(gogol_kwargs)
+        self.gogol_kwargs['prefetch_count'] = prefetch_count
+        self.gogol_kwargs.setdefault('ack_mode', 'late')
+        if hash_exchange is not None:
+            self.gogol_kwargs['hash_exchange'] = hash_exchange
+        else:
+            self.gogol_kwargs['shared_queue'] = shared_queue or name
+        self._metrics_queue = multiprocessing.Queue()
+        self._workers = {}
+        self._reports = {}
+        self._running = False
+        self.statistics = {}
+
+    def _worker_kwargs(self, index):
+        these_kwargs = dict(self.gogol_kwargs)
+        these_kwargs['name'] = '{}-{}'.format(self.name, index)
+        return these_kwargs
+
+    def _start_worker(self, index):
+        process = multiprocessing.Process(target=_run_worker,
+                                          name='{}-{}'.format(self.name, index),
+                                          args=(self.gogol_class, self._worker_kwargs(index), self._metrics_queue, self.report_interval),
+                                         )
+        process.daemon = True
+        process.start()
+        self._workers[index] = process
+        logger.info('started worker {} (pid {})'.format(process.name, process.pid))
+
+    def start(self):
+        '''
+        Launch all of the worker processes
+        '''
+        for index in range(self.n_workers):
+            self._start_worker(index)
+        self._running = True
+
+    def stop(self):
+        '''
+        Terminate all of the worker processes; the broker redelivers the alerts they had not acknowledged, which with
+        ack_mode 'early' does not include those received but not yet consumed
+        '''
+        self._running = False
+        for process in self._workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self._workers.values():
+            process.join(5)
+        logger.info('all workers stopped')
+
+    def check_workers(self):
+        '''
+        Restart (or just report) any worker process which has exited
+        '''
+        for index, process in list(self._workers.items()):
+            if process.is_alive():
+                continue
+            logger.error('worker {} exited with code {}'.format(process.name, process.exitcode))
+            if self.restart_workers and self._running:
+                self._start_worker(index)
+
+    def collect(self, timeout=0.):
+        '''
+        Process the metric reports received from the workers, waiting up to <timeout> seconds for the first
+        '''
+        block = timeout > 0
+        while True:
+            try:
+                report = self._metrics_queue.get(block, timeout if block else None)
+            except queue.Empty:
+                break
+            block = False
+            previous = self._reports.get(report['name'])
+            report['rate'] = None
+            if previous is not None and report['time'] > previous['time']:
+                report['rate'] = (report['received'] - previous['received']) / (report['time'] - previous['time'])
+            self._reports[report['name']] = report
+        self.statistics = self._aggregate()
+        return self.statistics
+
+    def _aggregate(self):
+        '''
+        total receive rate and overall lag, from the latest report of each worker
+        '''
+        n_lag = 0
+        lag_sum = 0.
+        lag_max = None
+        rate = 0.
+        for report in self._reports.values():
+            rate += report['rate'] or 0.
+            lag = report['lag']
+            if lag['count']:
+                n_lag += lag['count']
+                lag_sum += lag['mean'] * lag['count']
+                lag_max = lag['max'] if lag_max is None else max(lag_max, lag['max'])
+        return {'workers_alive': sum(process.is_alive() for process in self._workers.values()),
+                'received': sum(report['received'] for report in self._reports.values()),
+                'rate': rate,
+                'mean_lag': lag_sum / n_lag if n_lag else None,
+                'max_lag': lag_max,
+               }
+
+    def run(self):
+        '''
+        Start the workers, then supervise them and log aggregate metrics until interrupted
+        '''
+        self.start()
+        try:
+            while self._running:
+                next_report = time.time() + self.report_interval
+                while time.time() < next_report:
+                    self.collect(timeout=max(next_report - time.time(), 0.01))
+                self.check_workers()
+                logger.info('{workers_alive} workers, {rate:.1f} alerts/s, mean lag {mean_lag}, max lag {max_lag}'.format(**self.statistics))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
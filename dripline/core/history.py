@@ -0,0 +1,135 @@
+'''
+In-memory, fixed-size reading history and the time-range selection and decimation used to query it.
+'''
+
+from __future__ import absolute_import
+
+import calendar
+import datetime
+import logging
+
+try:
+    import numpy
+except ImportError:
+    # only required if a history is actually used, see _require_numpy
+    numpy = None
+
+from .constants import TIME_FORMAT
+from .exceptions import DriplineInternalError, DriplineValueError
+
+__all__ = []
+
+
+logger = logging.getLogger(__name__)
+
+
+def _require_numpy(feature):
+    if numpy is None:
+        raise DriplineInternalError('numpy is required {}; install it with the numpy extra (pip install dripline[numpy])'.format(feature))
+
+
+__all__.append('to_epoch')
+def to_epoch(value):
+    '''
+    Convert a time given as seconds since the epoch, a datetime, or a TIME_FORMAT string, to seconds since the epoch
+    '''
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.strptime(value, TIME_FORMAT)
+        except ValueError:
+            raise DriplineValueError('unable to parse time <{}>; expected seconds since the epoch or {}'.format(value, TIME_FORMAT))
+    return calendar.timegm(value.utctimetuple()) + value.microsecond * 1e-6
+
+
+__all__.append('decimate_minmax')
+def decimate_minmax(values, max_points):
+    '''
+    Return sorted indices selecting at most <max_points> of <values>, keeping the minimum and maximum of each of
+    max_points/2 equal-width buckets so that peaks survive decimation. NaN values are ignored where possible.
+    Since each bucket keeps two points, max_points must be at least 2.
+    '''
+    _require_numpy('to decimate readings')
+    if max_points is not None and max_points < 2:
+        raise DriplineValueError('max_points must be at least 2 to keep the minimum and maximum, got {}'.format(max_points))
+    n_points = len(values)
+    if max_points is None or n_points <= max_points:
+        return numpy.arange(n_points)
+    n_buckets = int(max_points) // 2
+    bucket_size = -(-n_points // n_buckets)
+    padded = numpy.full(n_buckets * bucket_size, numpy.nan)
+    padded[:n_points] = values
+    buckets = padded.reshape(n_buckets, bucket_size)
+    filled = ~numpy.all(numpy.isnan(buckets), axis=1)
+    safe_min = numpy.where(numpy.isnan(buckets), numpy.inf, buckets)
+    safe_max = numpy.where(numpy.isnan(buckets), -numpy.inf, buckets)
+    offsets = numpy.arange(n_buckets) * bucket_size
+    mins = numpy.where(filled, offsets + numpy.argmin(safe_min, axis=1), offsets)
+    maxs = numpy.where(filled, offsets + numpy.argmax(safe_max, axis=1), offsets)
+    indices = numpy.unique(numpy.concatenate([mins, maxs]))
+    return indices[indices < n_points]
+
+
+__all__.append('RingHistory')
+class RingHistory(object):
+    '''
+    Fixed-size, NumPy-backed ring buffer of (time, value_raw, value_cal) readings.
+
+    Values which are not numeric are stored as NaN. Appending is O(1) and queries select a time range with a binary search.
+    '''
+    columns = ('value_raw', 'value_cal')
+
+    def __init__(self, length):
+        _require_numpy('to keep a reading history')
+        self.length = int(length)
+        self._times = numpy.zeros(self.length)
+        self._values = numpy.full((len(self.columns), self.length), numpy.nan)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, timestamp, value_raw, value_cal=None):
+        '''
+        Record a reading; timestamps are expected to be non-decreasing
+        '''
+        i = self._next
+        self._times[i] = timestamp
+        for row, value in enumerate((value_raw, value_cal)):
+            try:
+                self._values[row, i] = float(value)
+            except (TypeError, ValueError):
+                self._values[row, i] = numpy.nan
+        self._next = (i + 1) % self.length
+        self._count = min(self._count + 1, self.length)
+
+    def _ordered(self):
+        '''
+        the stored times and values, oldest first
+        '''
+        if self._count < self.length:
+            return self._times[:self._count], self._values[:, :self._count]
+        order = numpy.r_[self._next:self.length, 0:self._next]
+        return self._times[order], self._values[:, order]
+
+    def query(self, start=None, stop=None, max_points=None):
+        '''
+        Return the readings with start <= time <= stop (either may be None for an open range), decimated to at most
+        max_points with decimate_minmax, as a dict of lists keyed by 'time' and the column names
+        '''
+        times, values = self._ordered()
+        first = 0 if start is None else numpy.searchsorted(times, to_epoch(start), side='left')
+        last = len(times) if stop is None else numpy.searchsorted(times, to_epoch(stop), side='right')
+        times = times[first:last]
+        values = values[:, first:last]
+        if max_points is not None:
+            primary = values[1] if not numpy.all(numpy.isnan(values[1])) else values[0]
+            indices = decimate_minmax(primary, int(max_points))
+            times = times[indices]
+            values = values[:, indices]
+        result = {'time': times.tolist()}
+        for row, column in enumerate(self.columns):
+            result[column] = [None if numpy.isnan(v) else v for v in values[row].tolist()]
+        return result
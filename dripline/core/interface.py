@@ -5,11 +5,20 @@ Creating an interface class, intended for use in scripting runs
 from __future__ import absolute_import
 
 import logging
+import threading
+import time
+import uuid
+
+try:
+    import pika
+except ImportError:
+    pass
 
 from .constants import *
-from .exceptions import exception_map, DriplineTimeoutError, DriplineDeprecated
-from .message import ReplyMessage, RequestMessage
+from .exceptions import exception_map, DriplineAMQPConnectionError, DriplineAMQPRoutingKeyError, DriplineTimeoutError, DriplineDeprecated
+from .message import Message, ReplyMessage, RequestMessage
 from .service import Service
+from .topic import TopicTrie, binding_key
 from .utilities import fancy_doc
 
 
@@ -17,43 +26,276 @@ __all__ = []
 
 logger = logging.getLogger(__name__)
 
+
+def _chunks_complete(replies):
+    '''
+    True if <replies> include every chunk of a chunked result whose chunks are numbered (see ArchivedEndpoint.history)
+    '''
+    chunks = set()
+    n_chunks = None
+    for reply in replies:
+        if not isinstance(reply.payload, dict) or 'n_chunks' not in reply.payload:
+            return False
+        chunks.add(reply.payload.get('chunk'))
+        n_chunks = reply.payload['n_chunks']
+    return len(chunks) >= n_chunks
+
+
 __all__.append('Interface')
 @fancy_doc
 class Interface(Service):
-    def __init__(self, amqp_url, name=None, confirm_retcodes=True):
+    '''
+    Send requests from scripts. By default one connection, channel and reply queue are opened on first use and kept
+    for the lifetime of the Interface (reconnecting if needed), so each request costs about one broker round trip.
+    Use it as a context manager, or call close(), to release the connection. The connection is not thread-safe.
+
+    With subscribe, alerts are also consumed in a background thread (on a connection of its own), keeping the latest
+    value of each endpoint available from latest() without any request.
+    '''
+    def __init__(self, amqp_url, name=None, confirm_retcodes=True, persistent_connection=True):
         '''
         Keywords:
             confirm_retcodes (bool): if True and if retcode!=0, raise exception
+            persistent_connection (bool): if False, open a new connection (and reply process) for every request, as Service.send_request does
         '''
         if name is None:
             name = 'scripting_interface_' + str(uuid.uuid4())[1:12]
         Service.__init__(self, amqp_url, exchange='requests', keys='', name=name)
         self._confirm_retcode = confirm_retcodes
+        self.persistent_connection = persistent_connection
+        self._session = None
+        self._session_replies = {}
+        self._subscriptions = TopicTrie()
+        self._subscription_lock = threading.Lock()
+        self._subscription_thread = None
+        self._subscription_stop = threading.Event()
+        self._latest = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        self.unsubscribe()
+
+    def _open_session(self):
+        '''
+        open the connection, channel and reply queue used for every request
+        '''
+        connection = self._blocking_connection()
+        channel = connection.channel()
+        channel.confirm_delivery()
+        reply_queue = channel.queue_declare(queue='request_reply' + str(uuid.uuid4()), exclusive=True, auto_delete=True).method.queue
+        channel.queue_bind(exchange='requests', queue=reply_queue, routing_key=reply_queue)
+        channel.basic_consume(self._on_session_reply, no_ack=True, queue=reply_queue)
+        self._session = (connection, channel, reply_queue)
+        logger.debug('interface session opened with reply queue {}'.format(reply_queue))
+
+    def _on_session_reply(self, channel, method, properties, body):
+        if properties.correlation_id in self._session_replies:
+            self._session_replies[properties.correlation_id].append(Message.from_encoded(body, properties.content_encoding))
+        else:
+            logger.debug('discarding reply to an earlier request')
+
+    def close(self):
+        '''
+        Close the persistent connection, if open; it is reopened by the next request
+        '''
+        if self._session is None:
+            return
+        connection = self._session[0]
+        self._session = None
+        try:
+            connection.close()
+        except pika.exceptions.AMQPError as err:
+            logger.debug('error closing interface connection: {}'.format(err))
+
+    def subscribe(self, patterns, callback=None):
+        '''
+        Start receiving the alerts whose routing keys match <patterns> (eg. 'sensor_value.#' or 'sensor_value.*_temp'),
+        caching the latest value of each endpoint for latest(). May be called again to add patterns.
+
+        patterns (str|list): AMQP topic pattern(s); a word may also contain '*' as a partial wildcard
+        callback (callable|None): if given, called as callback(endpoint, entry) from the subscription thread for each
+            matching alert, where entry is the dict which latest(endpoint) returns
+        '''
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        with self._subscription_lock:
+            for pattern in patterns:
+                self._subscriptions.add(pattern, callback)
+        if self._subscription_thread is None or not self._subscription_thread.is_alive():
+            self._subscription_stop.clear()
+            self._subscription_thread = threading.Thread(target=self._consume_subscriptions, name='{}-subscriptions'.format(self.name))
+            self._subscription_thread.daemon = True
+            self._subscription_thread.start()
+
+    def unsubscribe(self):
+        '''
+        Stop the subscription thread and forget every pattern; cached values remain available
+        '''
+        if self._subscription_thread is None:
+            return
+        self._subscription_stop.set()
+        self._subscription_thread.join(5)
+        self._subscription_thread = None
+        with self._subscription_lock:
+            self._subscriptions = TopicTrie()
+
+    def latest(self, endpoint):
+        '''
+        The most recent alert received from <endpoint> by a subscription, as a dict with 'value_raw', 'value_cal',
+        'timestamp' (as sent), 'received' (local time) and 'routing_key'; None if there has been none
+        '''
+        entry = self._latest.get(endpoint)
+        return None if entry is None else dict(entry)
+
+    def _on_subscribed_alert(self, channel, method, properties, body):
+        with self._subscription_lock:
+            callbacks = self._subscriptions.match(method.routing_key)
+        if not callbacks:
+            # delivered by a binding widened from a partial-word pattern, without matching it
+            return
+        message = Message.from_encoded(body, properties.content_encoding)
+        payload = message.payload if isinstance(message.payload, dict) else {'value_raw': message.payload}
+        endpoint = method.routing_key.split('.', 1)[-1]
+        entry = {'value_raw': payload.get('value_raw'),
+                 'value_cal': payload.get('value_cal'),
+                 'timestamp': message.timestamp,
+                 'received': time.time(),
+                 'routing_key': method.routing_key,
+                }
+        self._latest[endpoint] = entry
+        for callback in callbacks:
+            if callback is None:
+                continue
+            try:
+                callback(endpoint, dict(entry))
+            except Exception as err:
+                logger.error('subscription callback for <{}> raised: {}'.format(method.routing_key, err))
 
-    def _send_request(self, target, msgop, payload, timeout=None, lockout_key=False):
+    def _consume_subscriptions(self):
+        '''
+        target of the subscription thread: consume alerts on a private queue, rebinding and reconnecting as needed
+        '''
+        connection = None
+        backoff = 1.
+        while not self._subscription_stop.is_set():
+            try:
+                if connection is None:
+                    connection = self._blocking_connection()
+                    channel = connection.channel()
+                    queue_name = channel.queue_declare(queue='subscription' + str(uuid.uuid4()), exclusive=True, auto_delete=True).method.queue
+                    channel.basic_consume(self._on_subscribed_alert, no_ack=True, queue=queue_name)
+                    bound = set()
+                with self._subscription_lock:
+                    keys = set(binding_key(pattern) for pattern in self._subscriptions.patterns)
+                for key in keys - bound:
+                    channel.queue_bind(exchange='alerts', queue=queue_name, routing_key=key)
+                    bound.add(key)
+                connection.process_data_events(time_limit=0.5)
+                backoff = 1.
+            except (DriplineAMQPConnectionError, pika.exceptions.AMQPError) as err:
+                logger.warning('subscription connection failed, retrying in {} s: {}'.format(backoff, err))
+                connection = None
+                self._subscription_stop.wait(backoff)
+                backoff = min(backoff * 2, 30.)
+        if connection is not None:
+            try:
+                connection.close()
+            except pika.exceptions.AMQPError:
+                pass
+
+    def _session_request(self, target, request, timeout=10, multi_reply=False):
+        '''
+        Send <request> to <target> over the persistent connection and wait up to <timeout> seconds for its reply.
+        If the connection has failed it is reopened, and the request resent if it had not been published.
+
+        With multi_reply, every reply received within <timeout> is returned, as a list; collection ends early once the
+        replies carry 'chunk' indices for all of 'n_chunks' (as those to a history query do).
+        '''
+        request.sender_info['service_name'] = self.name
+        correlation_id = str(uuid.uuid4())
+        for attempt in range(2):
+            published = False
+            try:
+                if self._session is None:
+                    self._open_session()
+                connection, channel, reply_queue = self._session
+                self._session_replies[correlation_id] = []
+                properties = pika.BasicProperties(reply_to=reply_queue,
+                                                  content_encoding='application/json',
+                                                  correlation_id=correlation_id,
+                                                  app_id='dripline.core.Interface',
+                                                 )
+                body = request.to_encoding(properties.content_encoding)
+                if not channel.basic_publish(exchange='requests', routing_key=target, body=body, properties=properties, mandatory=True):
+                    raise DriplineAMQPRoutingKeyError('not able to publish to: {}'.format(target))
+                published = True
+                self.request_metrics.record_publish('requests', len(body))
+                deadline = time.time() + timeout
+                replies = self._session_replies[correlation_id]
+                while not (replies and (not multi_reply or _chunks_complete(replies))):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        if multi_reply and replies:
+                            break
+                        raise DriplineTimeoutError('request response timed out')
+                    connection.process_data_events(time_limit=remaining)
+                return list(replies) if multi_reply else replies[0]
+            except (DriplineAMQPConnectionError, pika.exceptions.AMQPError) as err:
+                logger.warning('interface connection failed: {}'.format(err))
+                self.close()
+                if published or attempt:
+                    raise DriplineAMQPConnectionError('connection lost while sending request to <{}>: {}'.format(target, err))
+            finally:
+                self._session_replies.pop(correlation_id, None)
+
+    def request(self, target, request, timeout=10, multi_reply=False):
+        '''
+        Send a prepared RequestMessage to <target> and return its reply (a list of every reply with multi_reply),
+        over the persistent connection unless persistent_connection is False. Retcodes are not checked; a request
+        which is not answered within <timeout> seconds raises DriplineTimeoutError.
+        '''
+        if self.persistent_connection:
+            return self._session_request(target, request, timeout=timeout, multi_reply=multi_reply)
+        reply = self.send_request(target, request, timeout=timeout, multi_reply=multi_reply)
+        if multi_reply and not isinstance(reply, list):
+            reply = [reply]
+        return reply
+
+    def _send_request(self, target, msgop, payload, timeout=None, lockout_key=False, multi_reply=False):
         request = RequestMessage(msgop=msgop, payload=payload)
         request_kwargs = {'target':target,
                           'request':request,
+                          'multi_reply':multi_reply,
                          }
         if timeout is not None:
             request_kwargs.update({'timeout':timeout})
         if lockout_key:
             request.lockout_key = lockout_key
         try:
-            reply = self.send_request(**request_kwargs)#target, request)
+            reply = self.request(**request_kwargs)
         except DriplineTimeoutError as err:
             reply = ReplyMessage(retcode=DriplineTimeoutError.retcode, payload=str(err))
+        replies = reply if isinstance(reply, list) else [reply]
         if self._confirm_retcode:
-            if not reply.retcode == 0:
-                raise exception_map[reply.retcode](reply.return_msg, result=reply.payload)
-        return reply
+            for reply in replies:
+                if not reply.retcode == 0:
+                    raise exception_map[reply.retcode](reply.return_msg, result=reply.payload)
+        return replies if multi_reply else replies[0]
 
-    def get(self, endpoint, timeout=None):
+    def get(self, endpoint, timeout=None, multi_reply=False):
+        '''
+        Send a get request to <endpoint>; with multi_reply, a list of every reply (eg. each chunk of a ChunkedResult)
+        is returned instead of the first
+        '''
         msgop = OP_GET
         payload = {'values':[]}
         request_args = {'target': endpoint,
                         'msgop':msgop,
-                        'payload':payload
+                        'payload':payload,
+                        'multi_reply':multi_reply,
                        }
         if timeout is not None:
             request_args.update({'timeout':timeout})
@@ -89,14 +331,18 @@ class Interface(Service):
 
         Note that while a request message expects the method name to be provided as an RKS,
         here it is a separate argument which is combined with the endpoint name.
+        The keyword multi_reply is not passed on: if True, a list of every reply (eg. each chunk of a
+        ChunkedResult, as returned by a history query) is returned instead of the first.
         '''
         msgop = OP_CMD
+        multi_reply = kwargs.pop('multi_reply', False)
         payload = {'values': list(args)}
         payload.update(kwargs)
         request_args = {'target': endpoint + '.' + method_name,
                         'msgop':msgop,
                         'payload':payload,
-                        'lockout_key':lockout_key
+                        'lockout_key':lockout_key,
+                        'multi_reply':multi_reply,
                        }
         if timeout is not None:
             request_args.update({'timeout':timeout})
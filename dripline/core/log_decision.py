@@ -0,0 +1,283 @@
+'''
+Strategies used by a Spime to decide which of its scheduled readings to log.
+
+Each strategy sees every reading and returns the readings which should be broadcast. The compressing strategies
+guarantee that the logged points reconstruct every reading to within their configured error bound:
+  - DeadbandLogDecision: sample-and-hold reconstruction, |error| <= deadband
+  - SwingingDoorLogDecision: linear interpolation between logged points, |error| <= deviation
+  - LinearExtrapolationLogDecision: extrapolation of the last two logged points, |error| <= deviation
+'''
+
+from __future__ import absolute_import
+
+import logging
+
+from .exceptions import DriplineValueError
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+def _seconds(delta):
+    return delta.total_seconds()
+
+
+__all__.append('LogDecision')
+class LogDecision(object):
+    '''
+    Base class for Spime logging-decision strategies.
+
+    Derived classes implement _decide. The base class handles the first reading, values which are not numeric
+    (logged whenever they change) and the max_interval heartbeat.
+    '''
+
+    def __init__(self, max_interval=0, **kwargs):
+        '''
+        max_interval (float): if > 0, a reading is always logged if this many seconds have passed since the last log
+        '''
+        for key in kwargs:
+            logger.warning('log decision got unexpected kwarg <{}>, it will be ignored'.format(key))
+        self.max_interval = float(max_interval)
+        self.n_samples = 0
+        self.n_logged = 0
+        self._last_logged = None
+
+    def decide(self, timestamp, value, result):
+        '''
+        Consider a new reading, returning a (possibly empty) list of (timestamp, result) readings to log, oldest first.
+
+        timestamp (datetime): time of the reading
+        value (float|None): numeric value of the reading, or None if it is not numeric
+        result (any): the reading itself, returned as-is if it is to be logged
+        '''
+        self.n_samples += 1
+        if self._last_logged is None:
+            logger.debug("log b/c no last log")
+            to_log = self._force(timestamp, value, result)
+        elif self._heartbeat_due(timestamp):
+            logger.debug('log b/c too much time')
+            to_log = self._withheld_before(timestamp, value) + self._force(timestamp, value, result)
+        elif value is None or self._last_logged[1] is None:
+            to_log = self._decide_non_numeric(timestamp, value, result)
+        else:
+            to_log = self._decide(timestamp, value, result)
+        self.n_logged += len(to_log)
+        return to_log
+
+    def _heartbeat_due(self, timestamp):
+        return self.max_interval > 0 and _seconds(timestamp - self._last_logged[0]) > self.max_interval
+
+    def _force(self, timestamp, value, result):
+        '''
+        log the current reading unconditionally, resetting any compression state
+        '''
+        self._last_logged = (timestamp, value, result)
+        return [(timestamp, result)]
+
+    def _decide(self, timestamp, value, result):
+        raise NotImplementedError('_decide must be defined in derived class')
+
+    def _decide_non_numeric(self, timestamp, value, result):
+        if value != self._last_logged[1] or result != self._last_logged[2]:
+            return self._withheld_before(timestamp, value) + self._force(timestamp, value, result)
+        return []
+
+    def _withheld_before(self, timestamp, value):
+        '''
+        readings withheld so far which must be logged before the current one is logged unconditionally, to keep the error bound
+        '''
+        return []
+
+    def reset(self):
+        '''
+        forget the logging history, so that the next reading is logged
+        '''
+        self._last_logged = None
+
+    @property
+    def compression_ratio(self):
+        '''
+        number of readings per logged reading
+        '''
+        if not self.n_logged:
+            return 0.
+        return float(self.n_samples) / self.n_logged
+
+
+__all__.append('ThresholdLogDecision')
+class ThresholdLogDecision(LogDecision):
+    '''
+    The original Spime behavior: log if more than max_interval seconds have passed (note that with the default of 0
+    this means on essentially every reading), or if the value changed by more than max_fractional_change.
+    '''
+
+    def __init__(self, max_fractional_change=0, **kwargs):
+        '''
+        max_fractional_change (float): a reading which differs from the last logged value by more than this fraction is logged
+        '''
+        LogDecision.__init__(self, **kwargs)
+        self.max_fractional_change = float(max_fractional_change)
+
+    def _heartbeat_due(self, timestamp):
+        return (timestamp - self._last_logged[0]).seconds > self.max_interval
+
+    def _decide_non_numeric(self, timestamp, value, result):
+        # non-numeric readings are only logged by the heartbeat, but a numeric reading following one is a change
+        if value is not None:
+            logger.debug('log b/c value became numeric')
+            return self._force(timestamp, value, result)
+        return []
+
+    def _decide(self, timestamp, value, result):
+        last_value = self._last_logged[1]
+        if (last_value == 0 and value != 0) or\
+           (last_value != 0 and (abs(last_value - value)/last_value) > self.max_fractional_change):
+            logger.debug('log b/c change is too large')
+            return self._force(timestamp, value, result)
+        logger.debug('no log condition met, not logging')
+        return []
+
+
+__all__.append('DeadbandLogDecision')
+class DeadbandLogDecision(LogDecision):
+    '''
+    Log a reading when it differs from the last logged value by more than an absolute deadband.
+    '''
+
+    def __init__(self, deadband=0, **kwargs):
+        '''
+        deadband (float): maximum absolute difference from the last logged value which is not logged
+        '''
+        LogDecision.__init__(self, **kwargs)
+        self.deadband = float(deadband)
+
+    def _decide(self, timestamp, value, result):
+        if abs(value - self._last_logged[1]) > self.deadband:
+            return self._force(timestamp, value, result)
+        return []
+
+
+__all__.append('SwingingDoorLogDecision')
+class SwingingDoorLogDecision(LogDecision):
+    '''
+    Swinging-door compression: a reading is withheld as long as the straight line from the last logged reading to it
+    passes within <deviation> of every reading withheld since (the "door" of admissible slopes). When a reading falls
+    outside the door, the previous reading is logged (with its own timestamp) and becomes the new pivot, so logging
+    lags by one reading.
+    '''
+
+    def __init__(self, deviation=0, **kwargs):
+        '''
+        deviation (float): maximum absolute error of linear interpolation between logged readings
+        '''
+        LogDecision.__init__(self, **kwargs)
+        self.deviation = float(deviation)
+        self._previous = None
+        self._open_door()
+
+    def _open_door(self):
+        self._slope_upper = float('inf')
+        self._slope_lower = float('-inf')
+
+    def _force(self, timestamp, value, result):
+        self._previous = None
+        self._open_door()
+        return LogDecision._force(self, timestamp, value, result)
+
+    def _in_door(self, timestamp, value):
+        '''
+        True if the line from the pivot to this reading stays within deviation of every withheld reading
+        '''
+        dt = _seconds(timestamp - self._last_logged[0])
+        if dt <= 0:
+            return self._previous is None
+        slope = (value - self._last_logged[1]) / dt
+        return self._slope_lower <= slope <= self._slope_upper
+
+    def _withhold(self, timestamp, value, result):
+        '''
+        withhold a reading, narrowing the door to the slopes which pass within deviation of it
+        '''
+        dt = _seconds(timestamp - self._last_logged[0])
+        if dt > 0:
+            pivot_value = self._last_logged[1]
+            self._slope_upper = min(self._slope_upper, (value + self.deviation - pivot_value) / dt)
+            self._slope_lower = max(self._slope_lower, (value - self.deviation - pivot_value) / dt)
+        self._previous = (timestamp, value, result)
+
+    def _withheld_before(self, timestamp, value):
+        if self._previous is None or (value is not None and self._in_door(timestamp, value)):
+            return []
+        return self._force(*self._previous)
+
+    def _decide(self, timestamp, value, result):
+        to_log = []
+        if not self._in_door(timestamp, value):
+            to_log = self._force(*self._previous)
+        self._withhold(timestamp, value, result)
+        return to_log
+
+    def reset(self):
+        LogDecision.reset(self)
+        self._previous = None
+        self._open_door()
+
+
+__all__.append('LinearExtrapolationLogDecision')
+class LinearExtrapolationLogDecision(LogDecision):
+    '''
+    Log a reading when it differs by more than <deviation> from the straight line through the last two logged readings.
+    '''
+
+    def __init__(self, deviation=0, **kwargs):
+        '''
+        deviation (float): maximum absolute error of extrapolation from the last two logged readings
+        '''
+        LogDecision.__init__(self, **kwargs)
+        self.deviation = float(deviation)
+        self._second_last = None
+
+    def _force(self, timestamp, value, result):
+        self._second_last = self._last_logged
+        return LogDecision._force(self, timestamp, value, result)
+
+    def _decide(self, timestamp, value, result):
+        last_time, last_value = self._last_logged[0], self._last_logged[1]
+        predicted = last_value
+        if self._second_last is not None and self._second_last[1] is not None:
+            span = _seconds(last_time - self._second_last[0])
+            if span > 0:
+                predicted += (last_value - self._second_last[1]) / span * _seconds(timestamp - last_time)
+        if abs(value - predicted) > self.deviation:
+            return self._force(timestamp, value, result)
+        return []
+
+    def reset(self):
+        LogDecision.reset(self)
+        self._second_last = None
+
+
+_log_decision_types = {'threshold': ThresholdLogDecision,
+                       'deadband': DeadbandLogDecision,
+                       'swinging_door': SwingingDoorLogDecision,
+                       'linear_extrapolation': LinearExtrapolationLogDecision,
+                      }
+
+__all__.append('make_log_decision')
+def make_log_decision(config, **defaults):
+    '''
+    Build a LogDecision from a configuration dict, eg. {'type': 'swinging_door', 'deviation': 0.01}.
+    Values in <defaults> (eg. the Spime's max_interval) are used for any keys not present in <config>.
+    A LogDecision instance is returned unchanged.
+    '''
+    if isinstance(config, LogDecision):
+        return config
+    these_kwargs = dict(defaults)
+    these_kwargs.update(config)
+    decision_type = these_kwargs.pop('type', 'threshold')
+    if decision_type not in _log_decision_types:
+        raise DriplineValueError('unknown log decision type <{}>; valid types are {}'.format(decision_type, sorted(_log_decision_types)))
+    if decision_type != 'threshold':
+        these_kwargs.pop('max_fractional_change', None)
+    return _log_decision_types[decision_type](**these_kwargs)
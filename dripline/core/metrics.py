@@ -0,0 +1,154 @@
+'''
+Request and publish counters, with fixed-bucket histograms of request handling times, collected by every Service.
+'''
+
+from __future__ import absolute_import
+
+import bisect
+import logging
+import time
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+#: default histogram bucket upper bounds, in seconds: 1, 2.5 and 5 times each power of ten from 10 us to 50 s
+DEFAULT_BOUNDS = tuple(mantissa * 10. ** exponent for exponent in range(-5, 2) for mantissa in (1, 2.5, 5))
+
+
+__all__.append('Histogram')
+class Histogram(object):
+    '''
+    Counts of observations falling in fixed buckets, each counting the values up to (and including) its upper bound,
+    plus an overflow bucket. Observing is a bisect and two increments, without any lock: it is meant to be called from
+    the service's ioloop thread, and an observation made concurrently from another thread may, rarely, be lost.
+    '''
+    __slots__ = ('bounds', 'counts', 'total')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        '''
+        bounds (sequence): increasing upper bounds of the buckets
+        '''
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        '''
+        Upper bound of the bucket containing the <q> quantile (0 < q <= 1); None if there are no observations or it
+        falls in the overflow bucket
+        '''
+        counts = list(self.counts)
+        n = sum(counts)
+        if not n:
+            return None
+        rank = q * n
+        seen = 0
+        for bound, count in zip(self.bounds, counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def to_dict(self):
+        count = self.count
+        return {'bounds': list(self.bounds),
+                'counts': list(self.counts),
+                'count': count,
+                'sum': self.total,
+                'mean': self.total / count if count else None,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+               }
+
+
+class _OpMetrics(object):
+    __slots__ = ('requests', 'errors', 'handler_time', 'queue_wait')
+
+    def __init__(self, bounds):
+        self.requests = 0
+        self.errors = {}
+        self.handler_time = Histogram(bounds)
+        self.queue_wait = Histogram(bounds)
+
+    def to_dict(self):
+        return {'requests': self.requests,
+                'errors': sum(self.errors.values()),
+                'errors_by_retcode': {str(retcode): count for retcode, count in self.errors.items()},
+                'handler_time': self.handler_time.to_dict(),
+                'queue_wait': self.queue_wait.to_dict(),
+               }
+
+
+__all__.append('ServiceMetrics')
+class ServiceMetrics(object):
+    '''
+    Per endpoint and op request counts, error counts by retcode, and histograms of the time spent in the endpoint
+    method (handler_time, mostly waiting on hardware) and of the time between a request being sent and its handling
+    starting (queue_wait, which includes broker transit and is only meaningful if the clocks of the hosts agree);
+    plus the number and size of the messages published to each exchange.
+    '''
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        '''
+        bounds (sequence): upper bounds, in seconds, of the histogram buckets
+        '''
+        self.bounds = tuple(bounds)
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget everything collected so far
+        '''
+        self._ops = {}
+        self._published = {}
+        self.since = time.time()
+
+    def record_request(self, endpoint, op, retcode, handler_time, queue_wait=None):
+        '''
+        Count one handled request to <op> on <endpoint>, which took <handler_time> seconds and replied with <retcode>
+        '''
+        key = (endpoint, op)
+        metrics = self._ops.get(key)
+        if metrics is None:
+            metrics = self._ops.setdefault(key, _OpMetrics(self.bounds))
+        metrics.requests += 1
+        if retcode:
+            metrics.errors[retcode] = metrics.errors.get(retcode, 0) + 1
+        metrics.handler_time.observe(handler_time)
+        if queue_wait is not None:
+            metrics.queue_wait.observe(queue_wait)
+
+    def record_publish(self, exchange, n_bytes):
+        '''
+        Count one message of <n_bytes> published to <exchange>
+        '''
+        counts = self._published.get(exchange)
+        if counts is None:
+            counts = self._published.setdefault(exchange, [0, 0])
+        counts[0] += 1
+        counts[1] += n_bytes
+
+    def to_dict(self, endpoint=None):
+        '''
+        Everything collected since the last reset, as a JSON-serializable dict; restricted to one <endpoint> if given
+        '''
+        endpoints = {}
+        for (name, op), metrics in list(self._ops.items()):
+            if endpoint is None or name == endpoint:
+                endpoints.setdefault(name, {})[op] = metrics.to_dict()
+        now = time.time()
+        return {'since': self.since,
+                'elapsed': now - self.since,
+                'endpoints': endpoints,
+                'published': {exchange: {'messages': counts[0], 'bytes': counts[1]} for exchange, counts in list(self._published.items())},
+               }
@@ -1,11 +1,17 @@
 from __future__ import absolute_import
 
+import concurrent.futures
+import functools
+import math
+import threading
+import time
+
 from .constants import *
-from .endpoint import Endpoint
+from .endpoint import ChunkedResult, Endpoint
 from .message import RequestMessage
 from .spime import Spime
 from .utilities import fancy_doc
-from .exceptions import exception_map
+from .exceptions import exception_map, DriplineHardwareResponselessError, DriplineValueError
 
 import logging
 logger = logging.getLogger(__name__)
@@ -21,9 +27,32 @@ class Provider(Endpoint):
       sends them to hardware (or another provider), receives and parses the response, and sends a meaningful result back.
     '''
 
-    def __init__(self, **kwargs):
+    _lockout_key_cmds = Endpoint._lockout_key_cmds + ('sweep',)
+
+    def __init__(self, batch_window=0, batch_max_commands=20, batch_separator=';', executor_workers=0, **kwargs):
+        '''
+        batch_window (float): if > 0, commands submitted with send_batched within this many seconds are sent to hardware as one compound transaction
+        batch_max_commands (int): a pending batch is sent immediately once it holds this many commands
+        batch_separator (str): string used to join batched commands and to split their responses (';' for SCPI)
+        executor_workers (int): if > 0, scheduled work of this provider's endpoints which run_in_executor uses a dedicated pool of this many threads; otherwise a single thread is created on first use, serializing access to the instrument
+        '''
         Endpoint.__init__(self, **kwargs)
         self._endpoints = {}
+        self.batch_window = float(batch_window)
+        self.batch_max_commands = int(batch_max_commands)
+        self.batch_separator = batch_separator
+        self._batch_lock = threading.Lock()
+        self._batch_pending = []
+        self._batch_timeout_handle = None
+        self._batch_timer_armed = False
+        self._batch_counts = {'transactions': 0, 'commands': 0, 'failures': 0}
+        self._stagger_slots = {}
+        self._scan_anchors = {}
+        self._scan_pending = {}
+        self._scan_busy = {}
+        self.executor = None
+        if executor_workers > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(executor_workers))
 
     def add_endpoint(self, endpoint):
         if endpoint.name in self._endpoints:
@@ -57,6 +86,286 @@ class Provider(Endpoint):
     def on_set(self, *args, **kwargs):
         return self._on_set(*args, **kwargs)
 
+    def send_batched(self, commands):
+        '''
+        Queue a list of commands to be sent along with those from other endpoints in one hardware transaction.
+
+        Returns a concurrent.futures.Future which resolves to the list of responses to the query commands in <commands>
+        (see response_expected). Endpoint methods may return it directly to defer their reply, and an on_get returning it
+        may be decorated with calibrate and used by a Spime's scheduled get, which logs the value once the batch is sent.
+        If batch_window is not > 0, the commands are sent immediately with send().
+        '''
+        if isinstance(commands, str):
+            commands = [commands]
+        future = concurrent.futures.Future()
+        if self.batch_window <= 0:
+            try:
+                future.set_result(self.send(list(commands)))
+            except Exception as err:
+                future.set_exception(err)
+            return future
+        arm_timer = False
+        with self._batch_lock:
+            self._batch_pending.append((list(commands), future))
+            n_pending = sum(len(cmds) for cmds,_ in self._batch_pending)
+            flush_now = n_pending >= self.batch_max_commands
+            if not flush_now and not self._batch_timer_armed:
+                if self.service is not None and self.service._connection is not None:
+                    self._batch_timer_armed = arm_timer = True
+                else:
+                    flush_now = True
+        if arm_timer:
+            # the caller may be an executor thread, and the ioloop's timers may only be touched from the ioloop thread
+            self.service.call_threadsafe(self._arm_batch_timer)
+        if flush_now:
+            self.flush_batch()
+        return future
+
+    def _arm_batch_timer(self):
+        '''
+        on the ioloop: start the batch_window timer, unless the batch has been sent already
+        '''
+        with self._batch_lock:
+            if self._batch_pending and self._batch_timeout_handle is None:
+                self._batch_timeout_handle = self.service._connection.add_timeout(self.batch_window, self._on_batch_timeout)
+
+    def _on_batch_timeout(self):
+        with self._batch_lock:
+            self._batch_timeout_handle = None
+        # send() blocks on the hardware: send the batch from the provider's executor, serialized with its other work
+        self.service.executor_for(self).submit(self.flush_batch)
+
+    def response_expected(self, command):
+        '''
+        True if <command> produces a response when batched; by default SCPI queries (the header contains a '?')
+        '''
+        return '?' in command.strip().split(' ')[0]
+
+    def flush_batch(self):
+        '''
+        Send all pending batched commands as a single compound command and resolve each caller's future
+        '''
+        with self._batch_lock:
+            pending = self._batch_pending
+            self._batch_pending = []
+            self._batch_timer_armed = False
+            timeout_handle = self._batch_timeout_handle
+            self._batch_timeout_handle = None
+        if timeout_handle is not None:
+            self.service.call_threadsafe(self.service._connection.remove_timeout, timeout_handle)
+        if not pending:
+            return
+        all_commands = [cmd for cmds,_ in pending for cmd in cmds]
+        logger.debug('sending batch of {} commands from {} requests'.format(len(all_commands), len(pending)))
+        self._batch_counts['transactions'] += 1
+        self._batch_counts['commands'] += len(all_commands)
+        try:
+            response = self.send([self.batch_separator.join(all_commands)])
+            if isinstance(response, list):
+                response = response[0]
+            n_expected = len([cmd for cmd in all_commands if self.response_expected(cmd)])
+            responses = [r.strip() for r in response.split(self.batch_separator)] if n_expected else []
+            if len(responses) != n_expected:
+                raise DriplineHardwareResponselessError('batched transaction expected {} responses, got {}: {}'.format(n_expected, len(responses), repr(response)))
+        except Exception as err:
+            logger.warning('batched transaction failed: {}'.format(err))
+            self._batch_counts['failures'] += 1
+            for _,future in pending:
+                future.set_exception(err)
+            return
+        responses.reverse()
+        for cmds,future in pending:
+            future.set_result([responses.pop() for cmd in cmds if self.response_expected(cmd)])
+
+    @property
+    def batch_statistics(self):
+        '''
+        counts of batched hardware transactions and the commands they carried
+        '''
+        stats = dict(self._batch_counts)
+        stats['commands_per_transaction'] = float(stats['commands']) / stats['transactions'] if stats['transactions'] else 0.
+        return stats
+
+    def stagger_slot(self, scheduler):
+        '''
+        Return a stable index for <scheduler> among this provider's schedulers sharing its schedule_interval,
+        used by Scheduler to offset their phases
+        '''
+        slots = self._stagger_slots.setdefault(scheduler.schedule_interval, {})
+        # members of a scan group share a slot so that they come due together
+        key = getattr(scheduler, 'scan_group', None) or scheduler.name
+        if key not in slots:
+            slots[key] = len(slots)
+        return slots[key]
+
+    def scan_read(self, spimes):
+        '''
+        Read all of <spimes> in a single hardware transaction (eg. a muxer scan list), returning a dict mapping each
+        spime's name to its raw value.
+
+        By default, the spimes' scan_commands are sent with send() as one compound command, joined by batch_separator,
+        and the response is split the same way. Providers with a native scan mechanism may override this.
+        '''
+        commands = [getattr(spime, 'scan_command', None) for spime in spimes]
+        if None in commands:
+            raise NotImplementedError('provider <{}> cannot scan <{}>, which has no scan_command'.format(self.name, spimes[commands.index(None)].name))
+        response = self.send([self.batch_separator.join(commands)])
+        if isinstance(response, list):
+            response = response[0]
+        values = [value.strip() for value in response.split(self.batch_separator)]
+        if len(values) != len(spimes):
+            raise DriplineHardwareResponselessError('scan of {} spimes returned {} values: {}'.format(len(spimes), len(values), repr(response)))
+        return {spime.name: value for spime, value in zip(spimes, values)}
+
+    def scan_anchor(self, spime, due):
+        '''
+        The first grid point, at or after <due>, of the grid shared by <spime>'s scan group (for its interval); the grid is
+        anchored by the first member whose loop starts
+        '''
+        interval = spime.effective_interval
+        anchor = self._scan_anchors.setdefault((spime.scan_group, interval), due)
+        # the small tolerance keeps a due time already on the grid from being rounded up to the next point
+        return anchor + math.ceil((due - anchor) / interval - 1e-9) * interval
+
+    def queue_scan(self, spime):
+        '''
+        Add a due spime to its scan group; the group is read with scan_read once the current dispatch pass is complete
+        '''
+        group = self._scan_pending.setdefault(spime.scan_group, [])
+        group.append(spime)
+        if len(group) == 1:
+            self.service.dispatcher.call_after_pass(functools.partial(self._flush_scan, spime.scan_group))
+
+    def _flush_scan(self, group_name):
+        spimes = self._scan_pending.pop(group_name, [])
+        if not spimes:
+            return
+        if not spimes[0]._run_in_executor:
+            self._complete_scan(spimes, self._read_scan(spimes))
+            return
+        busy = self._scan_busy.get(group_name)
+        if busy is not None and not busy.done():
+            logger.warning('previous scan of group <{}> still running, skipping this tick'.format(group_name))
+            for spime in spimes:
+                spime._schedule_skipped += 1
+            return
+        future = self.service.executor_for(spimes[0]).submit(self._read_scan, spimes)
+        self._scan_busy[group_name] = future
+        future.add_done_callback(lambda f: self.service.call_threadsafe(self._complete_scan, spimes, f.result()))
+
+    def _read_scan(self, spimes):
+        '''
+        returns {name: raw value} for a scan group, or {name: exception} for every spime if the read failed
+        '''
+        logger.debug('scanning {} spimes of <{}>'.format(len(spimes), self.name))
+        try:
+            return self.scan_read(spimes)
+        except Exception as err:
+            logger.error('scan read of <{}> failed: {}'.format(self.name, err))
+            return {spime.name: err for spime in spimes}
+
+    def _complete_scan(self, spimes, raw_values):
+        for spime in spimes:
+            try:
+                value_raw = raw_values.get(spime.name)
+                if isinstance(value_raw, Exception):
+                    raise value_raw
+                spime.scheduled_result(spime.apply_calibration(value_raw))
+            except Exception as err:
+                logger.error('scanned value for <{}> not processed: {}'.format(spime.name, err))
+
+    def _sweep_target(self, target):
+        '''
+        the (endpoint, attribute) addressed by <target>, given as <endpoint name> or <endpoint name>.<attribute>
+        '''
+        name, _, attribute = target.partition('.')
+        if name not in self.endpoints:
+            raise DriplineValueError('sweep target <{}> is not an endpoint of <{}>'.format(name, self.name))
+        return self.endpoints[name], attribute.replace('-', '_')
+
+    def _sweep_result(self, result):
+        '''
+        the value of <result>, waiting for it if it is a Future (eg. from send_batched); a pending batch is sent at once,
+        as its timer would send it from this provider's executor, which may be the one running the sweep
+        '''
+        if not isinstance(result, concurrent.futures.Future):
+            return result
+        if not result.done():
+            self.flush_batch()
+        return result.result()
+
+    def _run_sweep(self, set_values, set_target, readbacks, settle_time, chunk_size):
+        endpoint, attribute = self._sweep_target(set_target)
+        readback_targets = [(name,) + self._sweep_target(name) for name in readbacks]
+        result = {'values': [], 'times': [], 'errors': []}
+        result.update({name: [] for name in readbacks})
+        for index, value in enumerate(set_values):
+            if attribute:
+                setattr(endpoint, attribute, value)
+            else:
+                self._sweep_result(endpoint.on_set(value))
+            if settle_time > 0:
+                time.sleep(settle_time)
+            result['values'].append(value)
+            result['times'].append(time.time())
+            for name, readback, readback_attribute in readback_targets:
+                try:
+                    reading = self._sweep_result(getattr(readback, readback_attribute) if readback_attribute else readback.on_get())
+                    if isinstance(reading, dict) and 'value_raw' in reading:
+                        reading = reading['value_cal'] if reading.get('value_cal') is not None else reading['value_raw']
+                except Exception as err:
+                    logger.warning('sweep readback of <{}> failed at point {}: {}'.format(name, index, err))
+                    result['errors'].append([index, name, str(err)])
+                    reading = None
+                result[name].append(reading)
+        if not chunk_size or len(result['values']) <= chunk_size:
+            return result
+        chunks = ChunkedResult()
+        n_chunks = -(-len(result['values']) // chunk_size)
+        for i_chunk in range(n_chunks):
+            these = slice(i_chunk * chunk_size, (i_chunk + 1) * chunk_size)
+            chunk = {key: values[these] for key, values in result.items() if key != 'errors'}
+            chunk['errors'] = [error for error in result['errors'] if these.start <= error[0] < these.stop]
+            chunk.update({'chunk': i_chunk, 'n_chunks': n_chunks})
+            chunks.append(chunk)
+        return chunks
+
+    def sweep(self, *values, set_target=None, readbacks=[], settle_time=0., start=None, stop=None, n_points=None, chunk_size=None,
+              lockout_key=None):
+        '''
+        Step <set_target> through a list of values, waiting settle_time seconds and then reading each of <readbacks>
+        at every step, all within this provider; eg. a cmd to <provider>.sweep with payload
+        {'set_target': 'hf_start_freq', 'start': 1e9, 'stop': 2e9, 'n_points': 101, 'readbacks': ['power'], 'settle_time': 0.1}.
+        Targets are endpoint names, or <endpoint name>.<attribute>; if the set_target's endpoint is locked, the request
+        must carry its lockout_key. A Future returned by a target's on_set or on_get is waited for at each step.
+
+        The values are those given in the request's values list or, if none are, n_points evenly spaced from start to stop.
+        The result holds the lists 'values', 'times' (of each step's readings), one list per readback (the calibrated value
+        where there is one, None if the reading failed) and 'errors'; with chunk_size, it is sent as replies of that many points.
+        If the service is running, the sweep runs in this provider's executor (see Service.executor_for), serialized with
+        the scheduled work of its endpoints, and the reply is deferred until it completes, so the ioloop is not blocked.
+        '''
+        if set_target is None:
+            raise DriplineValueError('sweep requires a <set_target>')
+        set_values = list(values)
+        if not set_values:
+            if start is None or stop is None or not n_points:
+                raise DriplineValueError('sweep requires either values, or start, stop and n_points')
+            n_points = int(n_points)
+            step = (stop - start) / float(n_points - 1) if n_points > 1 else 0.
+            set_values = [start + i * step for i in range(n_points)]
+        if isinstance(readbacks, str):
+            readbacks = [readbacks]
+        # check the targets before starting, so that bad requests are answered immediately
+        set_endpoint, _ = self._sweep_target(set_target)
+        set_endpoint._check_lockout_conditions(RequestMessage(msgop=OP_SET, lockout_key=lockout_key), set_values[:1], {})
+        for name in readbacks:
+            self._sweep_target(name)
+        sweep_args = (set_values, set_target, list(readbacks), float(settle_time), chunk_size)
+        if self.service is None or getattr(self.service, '_connection', None) is None:
+            return self._run_sweep(*sweep_args)
+        return self.service.executor_for(self).submit(self._run_sweep, *sweep_args)
+
     @property
     def endpoint_names(self):
         return list(self._endpoints.keys())
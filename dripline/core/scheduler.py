@@ -5,7 +5,9 @@ from __future__ import absolute_import
 __docformat__ = 'reStructuredText'
 
 import abc
+import concurrent.futures
 import logging
+import math
 import traceback
 
 from .utilities import fancy_doc
@@ -13,6 +15,9 @@ from .utilities import fancy_doc
 __all__ = []
 logger = logging.getLogger(__name__)
 
+#: fractional offset between consecutive staggered phases (golden ratio), which spreads any number of tasks evenly
+_STAGGER_STEP = (math.sqrt(5.) - 1.) / 2.
+
 
 __all__.append('Scheduler')
 @fancy_doc
@@ -25,18 +30,66 @@ class Scheduler(object):
     def __init__(self,
                  schedule_interval=0.,
                  delay_start=False,
+                 schedule_mode='fixed_rate',
+                 overrun_policy='skip',
+                 stagger=True,
+                 run_in_executor=False,
+                 min_schedule_interval=0.,
+                 max_schedule_interval=0.,
+                 adaptive_backoff=2.,
                  **kwargs):
         '''
         schedule_interval (float): time in seconds between scheduled events
+        delay_start (bool): if True, wait one schedule_interval before the first scheduled event
+        schedule_mode (str): 'fixed_rate' runs events on a fixed grid anchored to the loop start time; 'fixed_delay' waits schedule_interval after each event completes
+        overrun_policy (str): for fixed_rate, what to do when an event takes longer than schedule_interval; 'skip' drops the missed ticks and waits for the next grid point, 'immediate' runs once immediately and then resumes the grid
+        stagger (bool): if True, offset the start of loops which share a provider and schedule_interval so that they do not fire in the same instant
+        run_in_executor (bool): if True, run scheduled_work in an executor (see Service.executor_for; by default one thread per provider) instead of on the ioloop; a tick which fires while the previous one is still running is skipped
+        min_schedule_interval (float): if this and max_schedule_interval are > 0, the loop is adaptive: the interval drops to this value whenever adapt_interval reports a change
+        max_schedule_interval (float): upper limit of an adaptive loop's interval
+        adaptive_backoff (float): factor by which an adaptive loop's interval grows each time adapt_interval reports no change
         '''
+        if schedule_mode not in ('fixed_rate', 'fixed_delay'):
+            raise ValueError('schedule_mode must be one of fixed_rate or fixed_delay')
+        if overrun_policy not in ('skip', 'immediate'):
+            raise ValueError('overrun_policy must be one of skip or immediate')
         self._schedule_interval = schedule_interval
         self._delay_start = delay_start
+        self._schedule_mode = schedule_mode
+        self._overrun_policy = overrun_policy
+        self._stagger = stagger
         self._is_looping = False
         self._timeout_handle = None
+        self._schedule_anchor = None
+        self._schedule_tick = 0
+        self._schedule_overruns = 0
+        self._schedule_skipped = 0
+        self._run_in_executor = run_in_executor
+        self._pending_work = None
+        self._min_schedule_interval = float(min_schedule_interval)
+        self._max_schedule_interval = float(max_schedule_interval)
+        self._adaptive_backoff = float(adaptive_backoff)
+        if self.is_adaptive and (self._min_schedule_interval > self._max_schedule_interval or self._adaptive_backoff < 1):
+            raise ValueError('adaptive scheduling requires min_schedule_interval <= max_schedule_interval and adaptive_backoff >= 1')
+        self._effective_interval = self._initial_interval()
 
     def scheduled_action(self):
         raise NotImplementedError("scheduled_action must be defined in derived class")
 
+    def scheduled_work(self):
+        '''
+        The part of a scheduled event which may run off the ioloop when run_in_executor is set (eg. hardware access).
+        Its return value is passed to scheduled_result on the ioloop; if it is a concurrent.futures.Future (eg. from a
+        get through Provider.send_batched), its result is, once available. By default this is the whole scheduled_action.
+        '''
+        return self.scheduled_action()
+
+    def scheduled_result(self, result):
+        '''
+        The part of a scheduled event which runs on the ioloop with the return value of scheduled_work
+        '''
+        pass
+
     @property
     def schedule_interval(self):
         return self._schedule_interval
@@ -46,10 +99,55 @@ class Scheduler(object):
         if value < 0:
             raise ValueError('Schedule loop interval cannot be < 0')
         self._schedule_interval = value
+        self._effective_interval = self._initial_interval()
         if self.schedule_status:
             logger.info('Restarting schedule loop with new interval')
             self._restart_loop()
 
+    @property
+    def is_adaptive(self):
+        return self._min_schedule_interval > 0 and self._max_schedule_interval > 0
+
+    def _initial_interval(self):
+        if not self.is_adaptive:
+            return self._schedule_interval
+        return min(max(self._schedule_interval, self._min_schedule_interval), self._max_schedule_interval)
+
+    @property
+    def effective_interval(self):
+        '''
+        current time in seconds between scheduled events; differs from schedule_interval only for adaptive loops
+        '''
+        return self._effective_interval
+
+    @property
+    def effective_rate(self):
+        '''
+        current rate of scheduled events, in Hz
+        '''
+        if self._effective_interval <= 0:
+            return 0.
+        return 1. / self._effective_interval
+
+    def adapt_interval(self, changing):
+        '''
+        For adaptive loops, drop to min_schedule_interval if <changing>, otherwise back off by adaptive_backoff up to max_schedule_interval
+        '''
+        if not self.is_adaptive:
+            return
+        if changing:
+            new_interval = self._min_schedule_interval
+        else:
+            new_interval = min(self._effective_interval * self._adaptive_backoff, self._max_schedule_interval)
+        if new_interval == self._effective_interval:
+            return
+        logger.debug('<{}> schedule interval adapted to {} s'.format(getattr(self, 'name', self), new_interval))
+        if self._is_looping and self._schedule_anchor is not None:
+            # restart the grid from the most recent tick
+            self._schedule_anchor += self._schedule_tick * self._effective_interval
+            self._schedule_tick = 0
+        self._effective_interval = new_interval
+
     @property
     def schedule_status(self):
         return self._is_looping
@@ -65,30 +163,133 @@ class Scheduler(object):
         else:
             raise ValueError('unrecognized schedule state setting')
 
+    @property
+    def schedule_phase(self):
+        '''
+        offset in seconds of this loop's grid relative to its start time, used to stagger loops sharing a provider
+        '''
+        if not self._stagger or self._schedule_interval <= 0:
+            return 0.
+        provider = getattr(self, 'provider', None)
+        if provider is None or not hasattr(provider, 'stagger_slot'):
+            return 0.
+        slot = provider.stagger_slot(self)
+        return ((slot * _STAGGER_STEP) % 1.) * self._schedule_interval
+
+    @property
+    def schedule_overruns(self):
+        '''
+        number of scheduled events which ran past the following tick
+        '''
+        return self._schedule_overruns
+
+    @property
+    def schedule_skipped_ticks(self):
+        '''
+        number of ticks dropped because of overruns, or because the previous event was still running in the executor
+        '''
+        return self._schedule_skipped
+
     def single_schedule(self, delay):
         if self._is_looping:
             logger.warning('single_schedule will break existing schedule loop')
             self._stop_loop()
-        self._timeout_handle = self.service._connection.add_timeout(delay, self._process_schedule)
+        self._timeout_handle = self.service.dispatcher.add(self._process_schedule, delay)
 
     def _process_schedule(self):
         logger.info("beginning scheduled sequence")
+        if self._run_in_executor:
+            self._dispatch_to_executor()
+            self._schedule_next()
+            return
         try:
             result = self.scheduled_action()
         except Exception as err:
             logger.error('got a: {}'.format(str(err)))
             logger.error('traceback follows:\n{}'.format(traceback.format_exc()))
         logger.debug("scheduled sequence complete")
-        if self._is_looping and (self._schedule_interval > 0):
-            self._timeout_handle = self.service._connection.add_timeout(self._schedule_interval, self._process_schedule)
+        self._schedule_next()
+
+    def _dispatch_to_executor(self):
+        if self._pending_work is not None and not self._pending_work.done():
+            self._schedule_skipped += 1
+            logger.warning('previous scheduled event for <{}> still running, skipping this tick'.format(getattr(self, 'name', self)))
+            return
+        self._pending_work = self.service.executor_for(self).submit(self.scheduled_work)
+        self._pending_work.add_done_callback(lambda future: self.service.call_threadsafe(self._complete_schedule, future))
+
+    def _defer_result(self, result):
+        '''
+        If <result> is a Future, arrange for _complete_schedule to be called with it on the ioloop once it completes, and return True
+        '''
+        if not isinstance(result, concurrent.futures.Future):
+            return False
+        result.add_done_callback(lambda future: self.service.call_threadsafe(self._complete_schedule, future))
+        return True
+
+    def _complete_schedule(self, future):
+        '''
+        called on the ioloop once scheduled_work has finished in the executor, or a Future it returned has completed
+        '''
+        try:
+            result = future.result()
+            if self._defer_result(result):
+                return
+            self.scheduled_result(result)
+        except Exception as err:
+            logger.error('got a: {}'.format(str(err)))
+            logger.error('traceback follows:\n{}'.format(traceback.format_exc()))
+        logger.debug("scheduled sequence complete")
+
+    def _schedule_next(self):
+        '''
+        register the next event of the loop with the dispatcher, if looping
+        '''
+        if not (self._is_looping and (self._effective_interval > 0)):
+            return
+        dispatcher = self.service.dispatcher
+        if self._schedule_mode == 'fixed_delay':
+            self._timeout_handle = dispatcher.add(self._process_schedule, self._effective_interval)
+            return
+        now = dispatcher.clock()
+        self._schedule_tick += 1
+        next_due = self._schedule_anchor + self._schedule_tick * self._effective_interval
+        if next_due <= now:
+            missed = int((now - next_due) // self._effective_interval) + 1
+            self._schedule_overruns += 1
+            logger.warning('scheduled event for <{}> overran its interval ({} tick(s) missed)'.format(getattr(self, 'name', self), missed))
+            if self._overrun_policy == 'immediate':
+                self._schedule_skipped += missed - 1
+                self._schedule_tick += missed - 1
+                next_due = now
+            else:
+                self._schedule_skipped += missed
+                self._schedule_tick += missed
+                next_due = self._schedule_anchor + self._schedule_tick * self._effective_interval
+        self._timeout_handle = dispatcher.add_at(self._process_schedule, next_due)
+
+    def _first_due(self, now):
+        '''
+        time of the first event of a loop started at <now>, which anchors its grid: offset by schedule_phase, and a
+        whole interval later with delay_start
+        '''
+        due = now + self.schedule_phase
+        if self._delay_start:
+            due += self._effective_interval
+        return due
 
     def _start_loop(self):
-        if self._schedule_interval <= 0:
+        if self._effective_interval <= 0:
             raise Warning("schedule loop interval must be > 0")
-        self.service._connection.remove_timeout(self._timeout_handle)
+        dispatcher = self.service.dispatcher
+        dispatcher.cancel(self._timeout_handle)
         self._is_looping = True
-        if self._delay_start:
-            self._timeout_handle = self.service._connection.add_timeout(self._schedule_interval, self._process_schedule)
+        self._schedule_tick = 0
+        self._effective_interval = self._initial_interval()
+        now = dispatcher.clock()
+        self._schedule_anchor = self._first_due(now)
+        if self._schedule_anchor > now:
+            self._timeout_handle = dispatcher.add_at(self._process_schedule, self._schedule_anchor)
             logger.info("schedule loop started with delay")
         else:
             self._process_schedule()
@@ -96,7 +297,7 @@ class Scheduler(object):
 
     def _stop_loop(self):
         try:
-            self.service._connection.remove_timeout(self._timeout_handle)
+            self.service.dispatcher.cancel(self._timeout_handle)
             self._is_looping = False
         except Warning:
             pass
@@ -4,22 +4,34 @@ This file is based upon the example in the pika docs.
 
 from __future__ import absolute_import
 
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import inspect
 import json
 import logging
 import multiprocessing
 import os
+import random
+import socket
+import threading
 import traceback
 import uuid
 
 try:
     import pika
+    from pika.adapters.select_connection import READ as _IOLOOP_READ
 except ImportError:
     pass
 
 from . import constants, exceptions
+from .dispatcher import ScheduleDispatcher
+from .endpoint import get_query
 from .message import Message, AlertMessage, RequestMessage, ReplyMessage
+from .metrics import ServiceMetrics
 from .provider import Provider
+from .spool import AlertSpool
 from .utilities import fancy_doc
 
 logger = logging.getLogger(__name__)
@@ -41,8 +53,12 @@ class Service(Provider):
     """
     #: Service class constant setting what type of exchanges to ensure when they are "ensured"
     EXCHANGE_TYPE = 'topic'
+    _ack_modes = ('early', 'late', 'batched')
 
-    def __init__(self, broker=None, exchange=None, keys=None, setup_calls=[], **kwargs):
+    def __init__(self, broker=None, exchange=None, keys=None, setup_calls=[], deferred_timeout=None, scheduler_workers=4,
+                 alert_spool_path=None, alert_spool_size=64*1024*1024, alert_replay_rate=100, alert_replay_interval=1.,
+                 max_alert_replay_backoff=60., prefetch_count=0, ack_mode='early', ack_batch_size=100, ack_batch_interval=50,
+                 metrics_interval=0, metrics_routing_key='metrics', **kwargs):
         """
         broker (str): The AMQP url to connect with
         exchange (str): Name of the AMQP exchange to connect to
@@ -53,6 +69,19 @@ class Service(Provider):
             Valid keys are target, method, args, and kwargs, which will be called as
             service.endpoints[target].method(*args,**kwargs). Note that on_set can be used to
             assign values to attributes in this syntax.
+        deferred_timeout (float|None): if > 0, requests whose handlers return a future or awaitable are answered with a DriplineTimeoutError after this many seconds
+        scheduler_workers (int): number of threads in the shared executor used by schedulers with run_in_executor attached directly to the service (the endpoints of other providers without an executor of their own share one thread per provider)
+        alert_spool_path (str|None): if given, alerts which cannot be published are stored in a file at this path and replayed when the broker is reachable; new alerts are still published directly during the replay
+        alert_spool_size (int): size in bytes of the alert spool file; alerts which do not fit are dropped
+        alert_replay_rate (float): maximum number of spooled alerts replayed per second
+        alert_replay_interval (float): seconds between replay batches
+        max_alert_replay_backoff (float): replay attempts which fail are retried after a delay which doubles up to this many seconds
+        prefetch_count (int): if > 0, the most unacknowledged messages the broker will deliver to this service at once (basic_qos)
+        ack_mode (str): when messages are acknowledged: 'early' (on receipt, before decoding), 'late' (each once its handler has returned, or for a deferred reply once the reply is sent), or 'batched' (once handlers return, including deferring ones, with one multiple ack per ack_batch_size messages or ack_batch_interval); with 'late' and 'batched', a message whose handler raises is rejected, and requeued unless it was already redelivered
+        ack_batch_size (int): with ack_mode 'batched', the most handled messages left unacknowledged
+        ack_batch_interval (float): with ack_mode 'batched', the most milliseconds a handled message is left unacknowledged
+        metrics_interval (float): if > 0, the request and publish metrics (see the metrics query) are also sent as an alert every this many seconds
+        metrics_routing_key (str): routing key prefix of the metrics alerts, which are sent to <metrics_routing_key>.<name>
         """
         self._broker = broker
         if exchange is None:
@@ -73,6 +102,38 @@ class Service(Provider):
         self._channel = None
         self._closing = False
         self._consumer_tag = None
+        self.deferred_timeout = deferred_timeout
+        self._async_loop = None
+        self._threadsafe_callbacks = collections.deque()
+        self._wakeup_sockets = None
+        self._dispatcher = None
+        self._scheduler_workers = scheduler_workers
+        self._executor = None
+        self._provider_executors = []
+        self.alert_spool = None
+        if alert_spool_path is not None:
+            self.alert_spool = AlertSpool(path=alert_spool_path, max_bytes=alert_spool_size)
+        self.alert_replay_rate = alert_replay_rate
+        self.alert_replay_interval = alert_replay_interval
+        self.max_alert_replay_backoff = max_alert_replay_backoff
+        self._replay_task = None
+        self._replay_backoff = alert_replay_interval
+        self.prefetch_count = prefetch_count
+        #: name of the queue to consume from, and whether it is private to this service (otherwise it is declared durable)
+        self.queue_name = self.name
+        self.queue_exclusive = True
+        if ack_mode not in self._ack_modes:
+            raise exceptions.DriplineValueError('ack_mode must be one of {}, not <{}>'.format(self._ack_modes, ack_mode))
+        self.ack_mode = ack_mode
+        self.ack_batch_size = ack_batch_size
+        self.ack_batch_interval = ack_batch_interval
+        self._pending_ack = None
+        self._n_pending_acks = 0
+        self._ack_flush_task = None
+        self.request_metrics = ServiceMetrics()
+        self.metrics_interval = metrics_interval
+        self.metrics_routing_key = metrics_routing_key
+        self._metrics_task = None
 
     def __get_credentials(self):
         '''
@@ -109,6 +170,13 @@ class Service(Provider):
 
         """
         logger.debug('Connection opened')
+        if self._dispatcher is not None:
+            self._dispatcher.rearm()
+        self._register_wakeup()
+        if self.alert_spool is not None and len(self.alert_spool):
+            self._schedule_alert_replay(self._replay_backoff)
+        if self.metrics_interval > 0 and not (self._metrics_task is not None and self._metrics_task.active):
+            self._metrics_task = self.dispatcher.add(self._send_metrics_alert, self.metrics_interval)
         self.add_on_connection_close_callback()
         self.open_channel()
 
@@ -174,7 +242,12 @@ class Service(Provider):
         """
         logger.debug('Channel opened')
         self._channel = channel
+        # delivery tags from a previous channel can no longer be acknowledged
+        self._pending_ack = None
+        self._n_pending_acks = 0
         self._channel.confirm_delivery()
+        if self.prefetch_count > 0:
+            self._channel.basic_qos(prefetch_count=self.prefetch_count)
         self.add_on_channel_close_callback()
         self.setup_exchange('requests')
         self.setup_exchange('alerts')
@@ -226,7 +299,7 @@ class Service(Provider):
 
         """
         logger.debug('Exchange declared')
-        self.setup_queue(self.name)
+        self.setup_queue(self.queue_name)
 
     def setup_queue(self, queue_name):
         """Setup the queue on RabbitMQ by invoking the Queue.Declare RPC
@@ -237,10 +310,12 @@ class Service(Provider):
 
         """
         logger.debug('Declaring queue {}'.format(queue_name))
+        # a queue shared between services must outlive any one of them, and the broker
         self._channel.queue_declare(self.on_queue_declareok,
                                     queue_name,
-                                    exclusive=True,
-                                    auto_delete=True,
+                                    durable=not self.queue_exclusive,
+                                    exclusive=self.queue_exclusive,
+                                    auto_delete=self.queue_exclusive,
                                    )
 
     def on_queue_declareok(self, method_frame):
@@ -254,8 +329,8 @@ class Service(Provider):
 
         """
         for a_binding in self._bindings:
-            logger.debug('Binding {} to {} with {}'.format(a_binding[0], self.name, a_binding[1]))
-            self._channel.queue_bind(self.on_bindok, self.name,a_binding[0], a_binding[1])
+            logger.debug('Binding {} to {} with {}'.format(a_binding[0], self.queue_name, a_binding[1]))
+            self._channel.queue_bind(self.on_bindok, self.queue_name, a_binding[0], a_binding[1])
 
 
     def on_bindok(self, unused_frame):
@@ -282,7 +357,7 @@ class Service(Provider):
         logger.debug('Issuing consumer related RPC commands')
         self.add_on_cancel_callback()
         self._consumer_tag = self._channel.basic_consume(self.on_message,
-                                                         self.name)
+                                                         self.queue_name)
 
     def add_on_cancel_callback(self):
         """Add a callback that will be invoked if RabbitMQ cancels the consumer
@@ -321,17 +396,32 @@ class Service(Provider):
 
         """
         logger.info('received a message')
-        self.acknowledge_message(basic_deliver.delivery_tag)
+        if self.ack_mode == 'early':
+            self.acknowledge_message(basic_deliver.delivery_tag)
         msg_type_handlers = {
                              constants.T_REPLY: self.on_reply_message,
                              constants.T_REQUEST: self.on_request_message,
                              constants.T_ALERT: self.on_alert_message,
                             }
-        message = Message.from_encoded(body, properties.content_encoding)
         try:
-            msg_type_handlers[message.msgtype](unused_channel, basic_deliver, properties, body)
-        except exceptions.DriplineMethodNotSupportedError:
-            self.on_any_message(unused_channel, basic_deliver, properties, body)
+            message = Message.from_encoded(body, properties.content_encoding)
+            try:
+                handled = msg_type_handlers[message.msgtype](unused_channel, basic_deliver, properties, body)
+            except exceptions.DriplineMethodNotSupportedError:
+                handled = self.on_any_message(unused_channel, basic_deliver, properties, body)
+        except Exception:
+            # the failed delivery is rejected (requeued once, in case the failure was transient), after acknowledging
+            # the handled ones before it so that they are not redelivered with it
+            if self.ack_mode != 'early':
+                if self.ack_mode == 'batched':
+                    self.flush_acks()
+                self.reject_message(basic_deliver.delivery_tag, requeue=not basic_deliver.redelivered)
+            raise
+        if self.ack_mode == 'late' and isinstance(handled, concurrent.futures.Future):
+            # a deferred reply (see Endpoint.handle_request): acknowledge once it has been sent
+            handled.add_done_callback(lambda replied: self.acknowledge_handled(basic_deliver, message))
+        elif self.ack_mode != 'early':
+            self.acknowledge_handled(basic_deliver, message)
         logger.info('Ready for next message\n{}'.format('-'*29))
 
     def on_request_message(*args, **kwargs):
@@ -354,15 +444,56 @@ class Service(Provider):
         '''
         raise exceptions.DriplineMethodNotSupportedError('base service does not handle generic messages')
 
-    def acknowledge_message(self, delivery_tag):
+    def acknowledge_message(self, delivery_tag, multiple=False):
         """Acknowledge the message delivery from RabbitMQ by sending a
         Basic.Ack RPC method for the delivery tag.
 
         :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool multiple: also acknowledge every earlier unacknowledged delivery
 
         """
         logger.debug('Acknowledging message {}'.format(delivery_tag))
-        self._channel.basic_ack(delivery_tag)
+        self._channel.basic_ack(delivery_tag, multiple=multiple)
+
+    def reject_message(self, delivery_tag, multiple=False, requeue=True):
+        """Negatively acknowledge the message delivery by sending a
+        Basic.Nack RPC method for the delivery tag, so that RabbitMQ
+        redelivers it (if requeue) or drops it.
+
+        :param int delivery_tag: The delivery tag from the Basic.Deliver frame
+        :param bool multiple: also reject every earlier unacknowledged delivery
+        :param bool requeue: return the message(s) to the queue
+
+        """
+        logger.debug('Rejecting message {}'.format(delivery_tag))
+        self._channel.basic_nack(delivery_tag, multiple=multiple, requeue=requeue)
+
+    def acknowledge_handled(self, basic_deliver, message):
+        '''
+        Called by on_message, unless ack_mode is 'early', once the handler for <message> has returned
+        '''
+        if self.ack_mode != 'batched':
+            self.acknowledge_message(basic_deliver.delivery_tag)
+            return
+        self._pending_ack = basic_deliver.delivery_tag
+        self._n_pending_acks += 1
+        if self._n_pending_acks >= self.ack_batch_size:
+            self.flush_acks()
+        elif self._ack_flush_task is None:
+            self._ack_flush_task = self.dispatcher.add(self.flush_acks, self.ack_batch_interval / 1000.)
+
+    def flush_acks(self):
+        '''
+        Acknowledge every handled message now, with a single multiple ack
+        '''
+        self.dispatcher.cancel(self._ack_flush_task)
+        self._ack_flush_task = None
+        if self._pending_ack is None:
+            return
+        logger.debug('acknowledging {} messages'.format(self._n_pending_acks))
+        self.acknowledge_message(self._pending_ack, multiple=True)
+        self._pending_ack = None
+        self._n_pending_acks = 0
 
     def stop_consuming(self):
         """Tell RabbitMQ that you would like to stop consuming by sending the
@@ -407,6 +538,11 @@ class Service(Provider):
     def _do_setup_calls(self):
         '''
         '''
+        for endpoint in list(self.endpoints.values()):
+            try:
+                endpoint.on_service_start()
+            except Exception as err:
+                logger.error('on_service_start of <{}> failed: {}'.format(endpoint.name, err))
         logger.info('calling setup methods')
         for a_call in self._setup_calls:
             this_endpoint = self.endpoints[a_call['target']]
@@ -449,28 +585,136 @@ class Service(Provider):
         """
         logger.debug('Stopping')
         self._closing = True
+        if self._async_loop is not None:
+            self._async_loop.call_soon_threadsafe(self._async_loop.stop)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        for executor in self._provider_executors:
+            executor.shutdown(wait=False)
+        if self.alert_spool is not None:
+            self.alert_spool.flush()
+        if self._channel and self._pending_ack is not None:
+            self.flush_acks()
         self.stop_consuming()
         self._connection.ioloop.start()
         logger.debug('Stopped')
 
+    def call_threadsafe(self, callback, *args):
+        '''
+        Schedule callback(*args) to run on the ioloop thread; safe to call from any thread.
+        If the service is not connected, the callback is run immediately in the calling thread.
+        '''
+        this_callback = functools.partial(callback, *args)
+        if self._connection is None or self._wakeup_sockets is None:
+            this_callback()
+            return
+        self._threadsafe_callbacks.append(this_callback)
+        try:
+            self._wakeup_sockets[1].send(b'x')
+        except (BlockingIOError, socket.error):
+            # the wakeup socket is already full of unread bytes, so the ioloop will wake anyway
+            pass
+
+    def _register_wakeup(self):
+        '''
+        Watch a socket pair on the (new) ioloop, used by call_threadsafe to wake it; pika 0.11 has no thread-safe callback mechanism
+        '''
+        if self._wakeup_sockets is None:
+            self._wakeup_sockets = socket.socketpair()
+            for a_socket in self._wakeup_sockets:
+                a_socket.setblocking(False)
+        self._connection.ioloop.add_handler(self._wakeup_sockets[0].fileno(), self._on_wakeup, _IOLOOP_READ)
+
+    def _on_wakeup(self, fileno, events):
+        '''
+        ioloop handler running the callbacks queued by call_threadsafe
+        '''
+        try:
+            while self._wakeup_sockets[0].recv(4096):
+                pass
+        except (BlockingIOError, socket.error):
+            pass
+        while self._threadsafe_callbacks:
+            this_callback = self._threadsafe_callbacks.popleft()
+            try:
+                this_callback()
+            except Exception as err:
+                logger.error('threadsafe callback raised: {}'.format(err))
+                logger.debug('traceback follows:\n{}'.format(traceback.format_exc()))
+
+    @property
+    def dispatcher(self):
+        '''
+        ScheduleDispatcher owning the ioloop timers of every Scheduler attached to this service
+        '''
+        if self._dispatcher is None:
+            self._dispatcher = ScheduleDispatcher(add_timeout=lambda delay, callback: self._connection.add_timeout(delay, callback),
+                                                  remove_timeout=lambda handle: self._connection.remove_timeout(handle),
+                                                 )
+        return self._dispatcher
+
+    def executor_for(self, scheduler):
+        '''
+        Return the executor in which to run <scheduler>'s scheduled_work: its provider's executor, or if the provider has none,
+        a single thread created for it, so that the work of all of an instrument's endpoints is serialized. A Provider
+        passed itself (eg. for a sweep) gets its own executor in the same way. Schedulers attached directly to the service
+        share an executor of scheduler_workers threads.
+        '''
+        provider = scheduler if isinstance(scheduler, Provider) else getattr(scheduler, 'provider', None)
+        if provider is not None and provider is not self and hasattr(provider, 'executor'):
+            if provider.executor is None:
+                logger.debug('creating a single-thread executor for provider <{}>'.format(provider.name))
+                provider.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                self._provider_executors.append(provider.executor)
+            return provider.executor
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._scheduler_workers)
+        return self._executor
+
+    @property
+    def async_loop(self):
+        '''
+        asyncio event loop, run in a daemon thread, used to execute awaitables returned by endpoint methods.
+        The loop is only created (and its thread started) on first use.
+        '''
+        if self._async_loop is None:
+            self._async_loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=self._async_loop.run_forever, name='{}-asyncio'.format(self.name))
+            loop_thread.daemon = True
+            loop_thread.start()
+        return self._async_loop
+
+    def run_awaitable(self, awaitable):
+        '''
+        Run an awaitable on the service's asyncio loop, returning a concurrent.futures.Future for its result
+        '''
+        async def _await():
+            return await awaitable
+        return asyncio.run_coroutine_threadsafe(_await(), self.async_loop)
+
     def close_connection(self):
         """This method closes the connection to RabbitMQ."""
         logger.debug('Closing connection')
         self._connection.close()
 
-    def send_message(self, target, message, return_queue=None, properties=None, exchange=None, return_connection=False, ensure_delivery=True):
+    def _blocking_connection(self):
         '''
+        open a new BlockingConnection to the broker
         '''
-        if exchange is None:
-            exchange = self._exchange
-        if not isinstance(message, Message):
-            raise TypeError('message must be a dripline.core.Message')
         parameters = pika.ConnectionParameters(host=self._broker, credentials=self.__get_credentials())
         try:
-            connection = pika.BlockingConnection(parameters)
+            return pika.BlockingConnection(parameters)
         except pika.exceptions.AMQPConnectionError:
             raise exceptions.DriplineAMQPConnectionError('unable to connect to broker: {}'.format(self._broker))
 
+    def send_message(self, target, message, return_queue=None, properties=None, exchange=None, return_connection=False, ensure_delivery=True):
+        '''
+        '''
+        if exchange is None:
+            exchange = self._exchange
+        if not isinstance(message, Message):
+            raise TypeError('message must be a dripline.core.Message')
+        connection = self._blocking_connection()
         channel = connection.channel()
         channel.confirm_delivery()
         result = channel.queue_declare(queue='request_reply'+str(uuid.uuid4()),
@@ -496,12 +740,14 @@ class Service(Provider):
                                               correlation_id=correlation_id,
                                               app_id='dripline.core.Service'
                                              )
+        body = message.to_encoding(properties.content_encoding)
         publish_success = channel.basic_publish(exchange=exchange,
                                                 routing_key=target,
-                                                body=message.to_encoding(properties.content_encoding),
+                                                body=body,
                                                 properties=properties,
                                                 mandatory=True,
                                                )
+        self.request_metrics.record_publish(exchange, len(body))
         if not publish_success and ensure_delivery:
             if return_queue is not None:
                 return_queue.put(ReplyMessage(retcode=exceptions.DriplineAMQPRoutingKeyError.retcode,
@@ -556,8 +802,95 @@ class Service(Provider):
             alert = AlertMessage(payload=alert)
         alert.sender_info['service_name'] = self.name
         logger.debug('to {} sending {}'.format(severity,alert))
-        self.send_message(target=severity, message=alert, exchange='alerts', ensure_delivery=False)
+        if self.alert_spool is None:
+            self.send_message(target=severity, message=alert, exchange='alerts', ensure_delivery=False)
+            return
+        # live alerts are published directly even while older ones are being replayed, so that a backlog never delays
+        # them; replayed alerts keep their original timestamps, so consumers can still order them
+        try:
+            self.send_message(target=severity, message=alert, exchange='alerts', ensure_delivery=False)
+            return
+        except exceptions.DriplineAMQPConnectionError as err:
+            logger.warning('unable to publish alert, spooling it: {}'.format(err))
+        self.alert_spool.append(severity, alert)
+        if self._connection is not None:
+            self.call_threadsafe(self._schedule_alert_replay, self._replay_backoff)
 
+    def _schedule_alert_replay(self, delay):
+        '''
+        arrange for spooled alerts to be replayed after <delay> seconds, unless a replay is already pending
+        '''
+        if self._replay_task is not None and self._replay_task.active:
+            return
+        # jitter spreads out the replays of services which all lost the broker at the same time
+        self._replay_task = self.dispatcher.add(self._replay_alerts, delay * random.uniform(0.5, 1.))
+
+    def _replay_alerts(self):
+        '''
+        publish one rate-limited batch of spooled alerts over a single connection, with their original timestamps;
+        alerts are only removed from the spool once the broker has confirmed them
+        '''
+        self._replay_task = None
+        batch_size = max(int(self.alert_replay_rate * self.alert_replay_interval), 1)
+        records = self.alert_spool.peek(batch_size)
+        n_published = 0
+        try:
+            connection = self._blocking_connection()
+            try:
+                channel = connection.channel()
+                channel.confirm_delivery()
+                properties = pika.BasicProperties(content_encoding='application/json', app_id='dripline.core.Service')
+                for routing_key, alert, offset in records:
+                    body = alert.to_encoding(properties.content_encoding)
+                    confirmed = channel.basic_publish(exchange='alerts',
+                                                      routing_key=routing_key,
+                                                      body=body,
+                                                      properties=properties,
+                                                     )
+                    self.request_metrics.record_publish('alerts', len(body))
+                    if not confirmed:
+                        logger.warning('broker did not confirm replayed alert to <{}>'.format(routing_key))
+                        break
+                    n_published += 1
+            finally:
+                connection.close()
+        except (exceptions.DriplineAMQPConnectionError, pika.exceptions.AMQPError) as err:
+            logger.warning('alert replay interrupted after {} alerts: {}'.format(n_published, err))
+        if n_published:
+            self.alert_spool.consume(records[n_published - 1][2], n_published)
+            logger.info('replayed {} spooled alerts, {} bytes remain'.format(n_published, len(self.alert_spool)))
+        if n_published < len(records):
+            self._replay_backoff = min(self._replay_backoff * 2, self.max_alert_replay_backoff)
+        else:
+            self._replay_backoff = self.alert_replay_interval
+        if len(self.alert_spool):
+            self._schedule_alert_replay(self._replay_backoff)
+
+    @get_query
+    def metrics(self, endpoint=None, reset=False):
+        '''
+        Request counts, error counts by retcode and handling time histograms (in seconds) per endpoint and op, and the
+        number and bytes of messages published per exchange, since the service started or the last reset.
+
+        endpoint (str|None): if given, only report the requests to this endpoint
+        reset (bool): if True, start collecting afresh once reported
+        '''
+        result = self.request_metrics.to_dict(endpoint=endpoint)
+        if reset:
+            self.request_metrics.reset()
+        return result
+
+    def _send_metrics_alert(self):
+        '''
+        send the metrics as an alert, then schedule the next one
+        '''
+        self._metrics_task = None
+        try:
+            self.send_alert(self.metrics(), '{}.{}'.format(self.metrics_routing_key, self.name))
+        except exceptions.DriplineException as err:
+            logger.warning('unable to send metrics alert: {}'.format(err))
+        if not self._closing:
+            self._metrics_task = self.dispatcher.add(self._send_metrics_alert, self.metrics_interval)
 
     def send_status_message(self, alert, severity):
         '''
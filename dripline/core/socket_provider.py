@@ -0,0 +1,248 @@
+'''
+Provider base class for instruments reached over TCP sockets, with a pool of persistent connections.
+'''
+
+from __future__ import absolute_import
+
+import ast
+import logging
+import queue
+import socket
+import time
+
+from .exceptions import DriplineHardwareConnectionError, DriplineHardwareResponselessError, DriplineValueError
+from .provider import Provider
+from .utilities import fancy_doc
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+__all__.append('PooledConnection')
+class PooledConnection(object):
+    '''
+    One persistent socket to an instrument, reconnected on failure with exponential backoff and tracking its own latency
+    '''
+
+    def __init__(self, socket_info, timeout, reconnect_backoff, max_reconnect_backoff, index=0):
+        self.socket_info = socket_info
+        self.timeout = timeout
+        self.index = index
+        self._reconnect_backoff = reconnect_backoff
+        self._max_reconnect_backoff = max_reconnect_backoff
+        self._backoff = reconnect_backoff
+        self._next_attempt = 0.
+        self._socket = None
+        self._has_connected = False
+        self._stats = {'transactions': 0,
+                       'errors': 0,
+                       'reconnects': 0,
+                       'last_latency': None,
+                       'mean_latency': None,
+                       'max_latency': None,
+                      }
+
+    @property
+    def is_connected(self):
+        return self._socket is not None
+
+    def connect(self):
+        '''
+        Open the socket if it is not open; raises DriplineHardwareConnectionError while backing off after a failure
+        '''
+        if self._socket is not None:
+            return
+        now = time.time()
+        if now < self._next_attempt:
+            raise DriplineHardwareConnectionError('connection {} to {} backing off for {:.1f} s'.format(self.index, self.socket_info, self._next_attempt - now))
+        try:
+            self._socket = socket.create_connection(self.socket_info, timeout=self.timeout)
+        except (socket.error, socket.timeout) as err:
+            self._next_attempt = now + self._backoff
+            self._backoff = min(2 * self._backoff, self._max_reconnect_backoff)
+            self._stats['errors'] += 1
+            raise DriplineHardwareConnectionError('unable to connect to {}: {}'.format(self.socket_info, err))
+        self._backoff = self._reconnect_backoff
+        if self._has_connected:
+            self._stats['reconnects'] += 1
+        self._has_connected = True
+        logger.info('connection {} to {} opened'.format(self.index, self.socket_info))
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except socket.error:
+                pass
+        self._socket = None
+
+    def transact(self, data, response_terminator):
+        '''
+        Send <data> (bytes) and read until <response_terminator> (bytes); if the terminator is empty nothing is read.
+        Any socket failure closes the connection so that the next use reconnects.
+        '''
+        self.connect()
+        start = time.time()
+        try:
+            self._socket.sendall(data)
+            response = b''
+            if response_terminator:
+                while not response.endswith(response_terminator):
+                    chunk = self._socket.recv(1024)
+                    if not chunk:
+                        raise socket.error('connection closed by instrument')
+                    response += chunk
+                response = response[:-len(response_terminator)]
+        except socket.timeout:
+            self._stats['errors'] += 1
+            self.close()
+            raise DriplineHardwareResponselessError('no response from {} within {} s'.format(self.socket_info, self.timeout))
+        except socket.error as err:
+            self._stats['errors'] += 1
+            self.close()
+            raise DriplineHardwareConnectionError('connection to {} failed: {}'.format(self.socket_info, err))
+        self._record_latency(time.time() - start)
+        return response
+
+    def _record_latency(self, latency):
+        stats = self._stats
+        stats['transactions'] += 1
+        stats['last_latency'] = latency
+        if stats['mean_latency'] is None:
+            stats['mean_latency'] = latency
+            stats['max_latency'] = latency
+        else:
+            stats['mean_latency'] += (latency - stats['mean_latency']) / stats['transactions']
+            stats['max_latency'] = max(stats['max_latency'], latency)
+
+    @property
+    def statistics(self):
+        stats = dict(self._stats)
+        stats.update({'index': self.index, 'connected': self.is_connected})
+        return stats
+
+
+__all__.append('SocketPoolProvider')
+@fancy_doc
+class SocketPoolProvider(Provider):
+    '''
+    Base class for providers which talk to an instrument over TCP.
+
+    Connections are opened lazily, kept open between commands and reconnected with exponential backoff after a failure.
+    Instruments which accept parallel sessions may use pool_size > 1, in which case concurrent callers each check out their own connection.
+    Per-connection latency statistics are available as the <connection_statistics> property (ie. with a get on <name>.connection_statistics).
+    With health_check_interval > 0, idle connections are checked (see check_connections) periodically once the service is running.
+    '''
+
+    def __init__(self,
+                 socket_info=None,
+                 socket_timeout=1.,
+                 pool_size=1,
+                 command_terminator='\n',
+                 response_terminator='\n',
+                 reconnect_backoff=1.,
+                 max_reconnect_backoff=60.,
+                 health_check_command=None,
+                 health_check_interval=0,
+                 **kwargs):
+        '''
+        socket_info (tuple|str): (host, port) of the instrument, or a string representation of that tuple
+        socket_timeout (float): seconds to wait for a response before raising DriplineHardwareResponselessError
+        pool_size (int): number of persistent connections to maintain
+        command_terminator (str): string appended to each command sent
+        response_terminator (str): string marking the end of a response; if empty no response is read
+        reconnect_backoff (float): seconds to wait before the first reconnect attempt after a failure, doubling on each further failure
+        max_reconnect_backoff (float): upper limit for the reconnect backoff
+        health_check_command (str|None): command sent by check_connections to verify each connection is responsive
+        health_check_interval (float): if > 0, seconds between the checks of the idle connections, run in the service's executor (see Service.executor_for)
+        '''
+        Provider.__init__(self, **kwargs)
+        if isinstance(socket_info, str):
+            socket_info = ast.literal_eval(socket_info)
+        if socket_info is None:
+            raise DriplineValueError('<socket_info> is required for SocketPoolProvider <{}>'.format(self.name))
+        self.socket_info = tuple(socket_info)
+        self.command_terminator = command_terminator
+        self.response_terminator = response_terminator
+        self.health_check_command = health_check_command
+        self.health_check_interval = float(health_check_interval)
+        self._health_check_task = None
+        self._health_check_pending = None
+        self._connections = [PooledConnection(self.socket_info, socket_timeout, reconnect_backoff, max_reconnect_backoff, index=i)
+                             for i in range(int(pool_size))]
+        self._available = queue.Queue()
+        for connection in self._connections:
+            self._available.put(connection)
+
+    def _checkout(self):
+        '''
+        Take a connection from the pool, waiting up to the socket timeout if all are in use
+        '''
+        try:
+            return self._available.get(timeout=self._connections[0].timeout)
+        except queue.Empty:
+            raise DriplineHardwareConnectionError('no free connection to {} in pool of {}'.format(self.socket_info, len(self._connections)))
+
+    def send(self, commands, **kwargs):
+        '''
+        Send each command on one pooled connection, returning the responses joined with ';'
+        '''
+        if isinstance(commands, str):
+            commands = [commands]
+        connection = self._checkout()
+        try:
+            responses = [self._send_command(connection, command) for command in commands]
+        finally:
+            self._available.put(connection)
+        return ';'.join(responses)
+
+    def _send_command(self, connection, command):
+        logger.debug('sending to {}: {}'.format(self.socket_info, repr(command)))
+        data = (command + self.command_terminator).encode('utf-8')
+        response = connection.transact(data, self.response_terminator.encode('utf-8')).decode('utf-8', 'replace')
+        logger.debug('response is: {}'.format(repr(response)))
+        return response
+
+    def check_connections(self):
+        '''
+        Verify each idle connection, (re)opening it if needed and sending health_check_command if one is configured.
+        Connections which fail are closed and will be retried according to the backoff.
+        '''
+        results = {}
+        for _ in range(self._available.qsize()):
+            connection = self._available.get()
+            try:
+                if self.health_check_command is None:
+                    connection.connect()
+                else:
+                    self._send_command(connection, self.health_check_command)
+                results[connection.index] = True
+            except (DriplineHardwareConnectionError, DriplineHardwareResponselessError) as err:
+                logger.warning('connection {} failed health check: {}'.format(connection.index, err))
+                results[connection.index] = False
+            finally:
+                self._available.put(connection)
+        return results
+
+    def on_service_start(self):
+        if self.health_check_interval > 0 and self._health_check_task is None:
+            self._health_check_task = self.service.dispatcher.add(self._scheduled_health_check, self.health_check_interval)
+
+    def _scheduled_health_check(self):
+        '''
+        on the ioloop: start a check_connections in the executor, unless the previous one is still running, and schedule the next
+        '''
+        if self._health_check_pending is not None and not self._health_check_pending.done():
+            logger.warning('previous health check of <{}> still running, skipping this one'.format(self.name))
+        else:
+            self._health_check_pending = self.service.executor_for(self).submit(self.check_connections)
+        self._health_check_task = self.service.dispatcher.add(self._scheduled_health_check, self.health_check_interval)
+
+    def close_connections(self):
+        for connection in self._connections:
+            connection.close()
+
+    @property
+    def connection_statistics(self):
+        return [connection.statistics for connection in self._connections]
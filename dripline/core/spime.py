@@ -6,10 +6,16 @@ from __future__ import absolute_import
 import datetime
 import logging
 import functools
+import time
 
+from .constants import TIME_FORMAT
+from .aggregation import StreamingStatistics
 from .scheduler import Scheduler
 from .exceptions import *
-from .endpoint import Endpoint, calibrate
+from .endpoint import Endpoint, calibrate, get_query
+from .history import RingHistory
+from .log_decision import make_log_decision
+from .message import AlertMessage
 from .utilities import fancy_doc
 
 __all__ = ['Spime']
@@ -51,6 +57,12 @@ class Spime(Endpoint, Scheduler):
                  max_interval=0,
                  max_fractional_change=0,
                  alert_routing_key='sensor_value',
+                 scan_group=None,
+                 scan_command=None,
+                 log_decision=None,
+                 history_length=0,
+                 publish_interval=0,
+                 adaptive_threshold=0,
                  **kwargs
                 ):
         '''
@@ -58,6 +70,12 @@ class Spime(Endpoint, Scheduler):
         max_interval (float): If > 0, any log event exceding this number of seconds since the last broadcast will trigger a broadcast.
         max_fractional_change (float): If > 0, any log event which produces a value which differs from the previous value by more than this amount (expressed as a fraction, ie 10% change is 0.1) will trigger a broadcast
         alert_routing_key (str): routing key for the alert message send when broadcasting a logging event result. The default value of 'sensor_value' is valid for DataLoggers which represent physical quantities being stored to the slow controls database tables
+        scan_group (str|None): if set, scheduled gets of spimes with the same provider and scan_group which come due together are done as one provider scan_read, rather than one on_get each
+        scan_command (str|None): query command reading this spime's raw value, used by the default Provider.scan_read
+        log_decision (dict|None): configuration of the strategy deciding which scheduled readings to log, eg. {'type': 'swinging_door', 'deviation': 0.01}; valid types are threshold (the default, using max_fractional_change), deadband, swinging_door and linear_extrapolation (see dripline.core.log_decision)
+        history_length (int): if > 0, keep the last this many scheduled readings (logged or not) in memory, queryable with a get on <name>.history (requires numpy)
+        publish_interval (float): if > 0, scheduled readings (taken every schedule_interval) are not logged individually; instead their count, min, max, mean and standard deviation are published once every publish_interval seconds
+        adaptive_threshold (float): for adaptive loops (see min_schedule_interval), a change in value_raw between consecutive readings larger than this speeds sampling up; smaller changes let it back off
         '''
         if 'log_interval' in kwargs:
             if 'schedule_interval' in kwargs:
@@ -68,11 +86,22 @@ class Spime(Endpoint, Scheduler):
         Scheduler.__init__(self, **kwargs)
 
         self.alert_routing_key=alert_routing_key + '.' + self.name
-        self._max_interval = max_interval
-        self._max_fractional_change = max_fractional_change
-        self._last_log_time = None
-        self._last_log_value = None
+        self._log_decision = make_log_decision(log_decision or {},
+                                               max_interval=max_interval,
+                                               max_fractional_change=max_fractional_change,
+                                              )
+        self._history = None
+        if history_length > 0:
+            self._history = RingHistory(history_length)
+        self._publish_interval = float(publish_interval)
+        self._raw_statistics = StreamingStatistics()
+        self._cal_statistics = StreamingStatistics()
+        self._window_start = None
+        self.adaptive_threshold = float(adaptive_threshold)
+        self._last_reading_value = None
         self._log_on_set = log_on_set
+        self.scan_group = scan_group
+        self.scan_command = scan_command
         if log_on_set:
             self.on_set = _log_on_set_decoration(self, self.on_set)
 
@@ -105,23 +134,103 @@ class Spime(Endpoint, Scheduler):
 
     @property
     def max_interval(self):
-        return self._max_interval
+        return self._log_decision.max_interval
     @max_interval.setter
     def max_interval(self, value):
         value = float(value)
         if value < 0:
             raise ValueError('max log interval cannot be < 0')
-        self._max_interval = value
+        self._log_decision.max_interval = value
 
     @property
     def max_fractional_change(self):
-        return self._max_fractional_change
+        return getattr(self._log_decision, 'max_fractional_change', None)
     @max_fractional_change.setter
     def max_fractional_change(self, value):
         value = float(value)
         if value < 0:
             raise ValueError('fractional change cannot be < 0')
-        self._max_fractional_change = value
+        if not hasattr(self._log_decision, 'max_fractional_change'):
+            raise ValueError('max_fractional_change is not used by the {} log decision'.format(self._log_decision.__class__.__name__))
+        self._log_decision.max_fractional_change = value
+
+    @property
+    def log_decision(self):
+        return self._log_decision
+    @log_decision.setter
+    def log_decision(self, value):
+        self._log_decision = make_log_decision(value, max_interval=self.max_interval)
+
+    @property
+    def compression_ratio(self):
+        '''
+        number of scheduled readings per logged reading
+        '''
+        return self._log_decision.compression_ratio
+
+    @property
+    def publish_interval(self):
+        return self._publish_interval
+    @publish_interval.setter
+    def publish_interval(self, value):
+        value = float(value)
+        if value < 0:
+            raise ValueError('publish interval cannot be < 0')
+        self._publish_interval = value
+        self._reset_window(None)
+
+    @property
+    def window_statistics(self):
+        '''
+        statistics of the readings aggregated so far in the current publish window
+        '''
+        return {'value_raw': self._raw_statistics.as_dict(),
+                'value_cal': self._cal_statistics.as_dict(),
+               }
+
+    def _reset_window(self, start):
+        self._raw_statistics.reset()
+        self._cal_statistics.reset()
+        self._window_start = start
+
+    def _aggregate(self, result):
+        '''
+        Add a reading to the current publish window, publishing and starting a new window once publish_interval has elapsed
+        '''
+        now = time.time()
+        if self._window_start is None:
+            self._window_start = now
+        self._raw_statistics.add(result.get('value_raw'))
+        self._cal_statistics.add(result.get('value_cal'))
+        elapsed = now - self._window_start
+        if elapsed < self._publish_interval:
+            return
+        # publish statistics of the calibrated value if there is one, falling back to the raw value
+        stats = self._cal_statistics if self._cal_statistics.count else self._raw_statistics
+        values = stats.as_dict()
+        values.update({'value_raw': self._raw_statistics.mean,
+                       'window_start': datetime.datetime.utcfromtimestamp(self._window_start).strftime(TIME_FORMAT),
+                       'window_length': elapsed,
+                      })
+        if self._cal_statistics.count:
+            values['value_cal'] = self._cal_statistics.mean
+        if values['value_raw'] is None:
+            logger.warning('no numeric readings for <{}> in publish window, nothing published'.format(self.name))
+        else:
+            self.store_value(values, severity=self.alert_routing_key)
+        # keep windows on a fixed grid, so that publishing does not drift
+        self._reset_window(self._window_start + self._publish_interval * (elapsed // self._publish_interval))
+
+    @get_query
+    def history(self, start=None, stop=None, max_points=None, **kwargs):
+        '''
+        Return the recorded readings between start and stop (seconds since the epoch or TIME_FORMAT strings, either
+        may be omitted), decimated to at most max_points while preserving the extremes, as lists keyed by time,
+        value_raw and value_cal
+        '''
+        if self._history is None:
+            raise DriplineValueError('<{}> does not keep a history; set history_length > 0'.format(self.name))
+        return self._history.query(start=start, stop=stop, max_points=max_points)
 
     @staticmethod
     def store_value(alert, severity):
@@ -134,28 +243,61 @@ class Spime(Endpoint, Scheduler):
         '''
         Override Scheduler method with Spime-specific get and log
         '''
-        result = self.on_get()
+        result = self.scheduled_work()
+        if not self._defer_result(result):
+            self.scheduled_result(result)
+
+    def _first_due(self, now):
+        '''
+        Override Scheduler method; members of a scan group keep to a grid shared by the group, so that they come due together
+        however far apart their loops were started
+        '''
+        due = Scheduler._first_due(self, now)
+        if self.scan_group is None or self.provider is None:
+            return due
+        return self.provider.scan_anchor(self, due)
+
+    def _process_schedule(self):
+        '''
+        Override Scheduler method; members of a scan group are read by their provider rather than individually
+        '''
+        if self.scan_group is None or self.provider is None:
+            return Scheduler._process_schedule(self)
+        self.provider.queue_scan(self)
+        self._schedule_next()
+
+    def scheduled_work(self):
+        '''
+        Override Scheduler method; the scheduled get, which may run in an executor
+        '''
+        return self.on_get()
+
+    def scheduled_result(self, result):
+        '''
+        Override Scheduler method; decide whether to log the result of the scheduled get and do so
+        '''
         if result is None:
             logger.warning('Spime scheduled get returned None for <{}>'.format(self.name))
             return
-        # Create float cast of value_raw for max_fractional_change test
+        if self._history is not None:
+            self._history.append(time.time(), result.get('value_raw'), result.get('value_cal'))
+        # Create float cast of value_raw for the adaptive interval and the log decision
         try:
             this_value = float(result['value_raw'])
         except (TypeError, ValueError):
-            this_value = False
-        # Check if this value should be logged
-        if self._last_log_value is None:
-            logger.debug("log b/c no last log")
-        elif (datetime.datetime.utcnow() - self._last_log_time).seconds > self._max_interval:
-            logger.debug('log b/c too much time')
-        elif (this_value is not False) and\
-             ((self._last_log_value == 0 and this_value != 0) or
-              (self._last_log_value != 0 and\
-                (abs(self._last_log_value - this_value)/self._last_log_value)>self.max_fractional_change)):
-            logger.debug('log b/c change is too large')
-        else:
-            logger.debug('no log condition met, not logging')
+            this_value = None
+        if self.is_adaptive:
+            if this_value is None or self._last_reading_value is None:
+                self.adapt_interval(this_value != self._last_reading_value)
+            else:
+                self.adapt_interval(abs(this_value - self._last_reading_value) > self.adaptive_threshold)
+            self._last_reading_value = this_value
+        if self._publish_interval > 0:
+            self._aggregate(result)
             return
-        self.store_value(result, severity=self.alert_routing_key)
-        self._last_log_time = datetime.datetime.utcnow()
-        self._last_log_value = this_value
+        for log_time, log_result in self._log_decision.decide(datetime.datetime.utcnow(), this_value, result):
+            if log_result is result:
+                self.store_value(result, severity=self.alert_routing_key)
+            else:
+                # an earlier reading, logged late by a compressing log decision, keeps its own timestamp
+                self.store_value(AlertMessage(payload=log_result, timestamp=log_time.strftime(TIME_FORMAT)), severity=self.alert_routing_key)
@@ -63,10 +63,11 @@ class Spimescape(Service):
         # messages to "broadcast" should be handled by the service
         if target == 'broadcast':
             method.routing_key = method.routing_key.replace('broadcast', self.name)
-            self.handle_request(channel, method, header, body)
+            handled = self.handle_request(channel, method, header, body)
         else:
-            self.endpoints[target].handle_request(channel, method, header, body)
+            handled = self.endpoints[target].handle_request(channel, method, header, body)
         logger.info('request processing complete\n{}')
+        return handled
 
     def _handle_reply(self, channel, method, header, body):
         logger.info("got a reply")
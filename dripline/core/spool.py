@@ -0,0 +1,171 @@
+'''
+Disk-backed store-and-forward spool, holding alerts which could not be published until the broker is reachable again.
+'''
+
+from __future__ import absolute_import
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from .message import Message
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+__all__.append('AlertSpool')
+class AlertSpool(object):
+    '''
+    Memory-mapped ring buffer of spooled alerts, in a file of bounded size.
+
+    Records are appended at the write offset and consumed from the read offset; both are kept in the file header so
+    that a spool survives a restart. A record which does not fit before the end of the file wraps around to the start
+    (marked with a wrap length), so the space freed by consuming records is reused while others are still pending.
+    When a record does not fit in the free space it is dropped (and counted), so disk usage never exceeds max_bytes.
+    Each record is the routing key and the encoded alert, so the alert's original timestamp is preserved on replay.
+    '''
+    _MAGIC = b'DLSPOOL2'
+    _HEADER = struct.Struct('<8sQQ')
+    _LENGTH = struct.Struct('<I')
+    _WRAP = 0xffffffff
+
+    def __init__(self, path, max_bytes=64*1024*1024):
+        '''
+        path (str): spool file location; created if it does not exist
+        max_bytes (int): size of the spool file, which bounds the disk space used; an existing file of another size is resized, keeping as many of its alerts as fit
+        '''
+        self.path = os.path.expanduser(path)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self.n_spooled = 0
+        self.n_replayed = 0
+        self.n_dropped = 0
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else None
+        pending = []
+        if size is not None and size != self.max_bytes:
+            pending = self._load_resized(size)
+        exists = size == self.max_bytes
+        self._file = open(self.path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self._file.truncate(self.max_bytes)
+        self._map = mmap.mmap(self._file.fileno(), self.max_bytes)
+        magic, self._read, self._write = self._HEADER.unpack_from(self._map, 0)
+        if magic != self._MAGIC:
+            if exists:
+                logger.warning('spool file <{}> has an invalid header, discarding its contents'.format(self.path))
+            self._read = self._write = self._HEADER.size
+            self._store_header()
+        elif len(self):
+            logger.info('spool <{}> holds {} bytes of alerts from a previous run'.format(self.path, len(self)))
+        if pending:
+            logger.warning('spool file <{}> was resized from {} to {} bytes, re-spooling its {} alerts'.format(self.path, size, self.max_bytes, len(pending)))
+            for routing_key, alert in pending:
+                self.append(routing_key, alert)
+            # only alerts spooled during this run are counted; any which no longer fit are counted as dropped
+            self.n_spooled = 0
+
+    def _load_resized(self, size):
+        '''
+        the pending (routing_key, alert) records of the existing spool file, which is <size> bytes rather than max_bytes
+        '''
+        if size < self._HEADER.size:
+            logger.warning('spool file <{}> is too small to be a spool, discarding it'.format(self.path))
+            return []
+        previous = AlertSpool(self.path, size)
+        try:
+            return [(routing_key, alert) for routing_key, alert, offset in previous.peek(previous.max_bytes)]
+        finally:
+            previous.close()
+
+    def _store_header(self):
+        self._HEADER.pack_into(self._map, 0, self._MAGIC, self._read, self._write)
+
+    def __len__(self):
+        '''
+        number of bytes waiting to be replayed
+        '''
+        if self._write >= self._read:
+            return self._write - self._read
+        return self.max_bytes - self._read + self._write - self._HEADER.size
+
+    def append(self, routing_key, alert):
+        '''
+        Spool an alert for later publication to <routing_key>; returns False if the spool is full and it was dropped
+        '''
+        record = json.dumps([routing_key, alert.to_json()]).encode('utf-8')
+        size = self._LENGTH.size + len(record)
+        with self._lock:
+            start = self._write
+            # the write offset may only reach the read offset from behind when the spool is empty
+            if start >= self._read and start + size > self.max_bytes:
+                start = self._HEADER.size
+                if start + size >= self._read:
+                    start = None
+            elif start < self._read and start + size >= self._read:
+                start = None
+            if start is None:
+                self.n_dropped += 1
+                logger.error('alert spool <{}> is full, dropping alert to <{}>'.format(self.path, routing_key))
+                return False
+            if start < self._write and self.max_bytes - self._write >= self._LENGTH.size:
+                self._LENGTH.pack_into(self._map, self._write, self._WRAP)
+            self._LENGTH.pack_into(self._map, start, len(record))
+            self._map[start + self._LENGTH.size:start + size] = record
+            self._write = start + size
+            self._store_header()
+            self.n_spooled += 1
+        return True
+
+    def peek(self, max_records):
+        '''
+        Return up to max_records (routing_key, Message, offset) tuples, oldest first, without consuming them;
+        offset is the value to pass to consume once that record (and all before it) has been published
+        '''
+        records = []
+        with self._lock:
+            offset = self._read
+            while offset != self._write and len(records) < max_records:
+                if self.max_bytes - offset < self._LENGTH.size:
+                    offset = self._HEADER.size
+                    continue
+                length, = self._LENGTH.unpack_from(self._map, offset)
+                if length == self._WRAP:
+                    offset = self._HEADER.size
+                    continue
+                start = offset + self._LENGTH.size
+                routing_key, body = json.loads(self._map[start:start + length].decode('utf-8'))
+                offset = start + length
+                records.append((routing_key, Message.from_json(body), offset))
+        return records
+
+    def consume(self, offset, n_records):
+        '''
+        Mark the <n_records> records before <offset> (as returned by peek) as published
+        '''
+        with self._lock:
+            self._read = offset
+            self.n_replayed += n_records
+            if self._read == self._write:
+                self._read = self._write = self._HEADER.size
+            self._store_header()
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+    @property
+    def statistics(self):
+        return {'pending_bytes': len(self),
+                'spooled': self.n_spooled,
+                'replayed': self.n_replayed,
+                'dropped': self.n_dropped,
+               }
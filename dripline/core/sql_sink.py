@@ -0,0 +1,162 @@
+'''
+Gogol which writes sensor_value alerts to SQL tables in buffered bulk inserts, through any DB-API 2.0 driver.
+'''
+
+from __future__ import absolute_import
+
+import importlib
+import logging
+import time
+
+from .exceptions import DriplineValueError
+from .gogol import Gogol
+from .utilities import fancy_doc
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+def _placeholders(paramstyle, names):
+    '''
+    the VALUES placeholders for the columns <names> in a DB-API <paramstyle>
+    '''
+    if paramstyle == 'qmark':
+        return ['?'] * len(names)
+    if paramstyle == 'format':
+        return ['%s'] * len(names)
+    if paramstyle == 'numeric':
+        return [':{}'.format(i + 1) for i in range(len(names))]
+    if paramstyle == 'named':
+        return [':{}'.format(name) for name in names]
+    if paramstyle == 'pyformat':
+        return ['%({})s'.format(name) for name in names]
+    raise DriplineValueError('unsupported DB-API paramstyle <{}>'.format(paramstyle))
+
+
+__all__.append('SQLSink')
+@fancy_doc
+class SQLSink(Gogol):
+    '''
+    Store sensor_value alerts as rows in SQL tables, one table per kind of value (numeric or string), following the
+    data_tables_dict convention of the SensorLogger configuration.
+
+    Alerts are consumed in batches (see Gogol's consume_batch_size and consume_batch_latency); each batch is written with
+    one executemany per table inside a single transaction, and is only acknowledged once committed. A failed batch is
+    rolled back and its alerts retried one at a time, so that a row which cannot be inserted does not stop the others
+    (see Gogol.consume_singly). The insert statement of each table is built once and reused, so drivers which cache
+    prepared statements (eg. sqlite3) only parse it once.
+    '''
+
+    def __init__(self, dbapi_module='sqlite3', connect_args=[], connect_kwargs={}, data_tables_dict={'numeric': 'numeric_data', 'string': 'string_data'},
+                 schema=None, insert_names=['endpoint_name', 'timestamp', 'value_raw', 'value_cal', 'memo'], create_tables=False,
+                 keys=['sensor_value.#'], consume_batch_size=500, **kwargs):
+        '''
+        dbapi_module (str): name of the DB-API 2.0 driver module, eg. 'sqlite3' or 'psycopg2'
+        connect_args (list): positional args to the driver's connect(), eg. the database file for sqlite3
+        connect_kwargs (dict): keyword args to the driver's connect()
+        data_tables_dict (dict): table name for each kind of value, 'numeric' and/or 'string'; values of a kind without a table are dropped
+        schema (str|None): schema containing the tables
+        insert_names (list): columns to insert, from 'endpoint_name' (the routing key after 'sensor_value.'), 'timestamp', and the alert payload's fields
+        create_tables (bool): create any missing tables when first connecting (untyped columns, which only SQLite accepts)
+        '''
+        Gogol.__init__(self, keys=keys, consume_batch_size=consume_batch_size, **kwargs)
+        self._dbapi = importlib.import_module(dbapi_module)
+        self._connect_args = connect_args
+        self._connect_kwargs = connect_kwargs
+        self.data_tables_dict = data_tables_dict
+        self.insert_names = list(insert_names)
+        self.create_tables = create_tables
+        self._connection_db = None
+        placeholders = _placeholders(self._dbapi.paramstyle, self.insert_names)
+        self._by_name = self._dbapi.paramstyle in ('named', 'pyformat')
+        self._statements = {}
+        for kind, table in data_tables_dict.items():
+            if kind not in ('numeric', 'string'):
+                raise DriplineValueError('data_tables_dict keys must be "numeric" or "string", not <{}>'.format(kind))
+            table = table if schema is None else '{}.{}'.format(schema, table)
+            self._statements[kind] = (table, 'INSERT INTO {} ({}) VALUES ({})'.format(table, ', '.join(self.insert_names), ', '.join(placeholders)))
+        self.n_rows_inserted = 0
+        self.n_rows_dropped = 0
+        self.n_failed_batches = 0
+        self._insert_seconds = 0.
+        self._last_batch_rate = None
+
+    def _connect(self):
+        if self._connection_db is None:
+            logger.info('connecting to database with {}'.format(self._dbapi.__name__))
+            self._connection_db = self._dbapi.connect(*self._connect_args, **self._connect_kwargs)
+            if self.create_tables:
+                cursor = self._connection_db.cursor()
+                for table, _ in self._statements.values():
+                    cursor.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(table, ', '.join(self.insert_names)))
+                self._connection_db.commit()
+        return self._connection_db
+
+    def _row(self, message, method):
+        '''
+        the (kind, row) to insert for one alert; row is a tuple, or a dict for named paramstyles
+        '''
+        payload = message.payload if isinstance(message.payload, dict) else {'value_raw': message.payload}
+        values = dict(payload)
+        values['endpoint_name'] = method.routing_key.split('.', 1)[-1]
+        values['timestamp'] = message.timestamp
+        value_raw = payload.get('value_raw')
+        kind = 'numeric' if isinstance(value_raw, (int, float)) and not isinstance(value_raw, bool) else 'string'
+        if kind == 'string':
+            for name in ('value_raw', 'value_cal'):
+                if values.get(name) is not None:
+                    values[name] = str(values[name])
+        if self._by_name:
+            return kind, {name: values.get(name) for name in self.insert_names}
+        return kind, tuple(values.get(name) for name in self.insert_names)
+
+    def this_consume_batch(self, messages):
+        rows = {kind: [] for kind in self._statements}
+        for message, method in messages:
+            kind, row = self._row(message, method)
+            if kind in rows:
+                rows[kind].append(row)
+            else:
+                self.n_rows_dropped += 1
+        n_rows = sum(len(these_rows) for these_rows in rows.values())
+        if not n_rows:
+            return
+        start = time.time()
+        connection = self._connect()
+        try:
+            cursor = connection.cursor()
+            for kind, these_rows in rows.items():
+                if these_rows:
+                    cursor.executemany(self._statements[kind][1], these_rows)
+            connection.commit()
+        except Exception:
+            self.n_failed_batches += 1
+            try:
+                connection.rollback()
+            except Exception:
+                # the connection itself has failed; reconnect for the next batch
+                self._connection_db = None
+            raise
+        elapsed = time.time() - start
+        self._insert_seconds += elapsed
+        self.n_rows_inserted += n_rows
+        self._last_batch_rate = n_rows / elapsed if elapsed > 0 else None
+        logger.debug('inserted {} rows in {:.4f} s'.format(n_rows, elapsed))
+
+    def this_consume(self, message, method):
+        self.this_consume_batch([(message, method)])
+
+    @property
+    def sink_statistics(self):
+        '''
+        insert counters and rates (rows per second of time spent inserting)
+        '''
+        return {'rows_inserted': self.n_rows_inserted,
+                'rows_dropped': self.n_rows_dropped,
+                'batches': self.n_consumed_batches,
+                'failed_batches': self.n_failed_batches,
+                'insert_seconds': self._insert_seconds,
+                'mean_rows_per_second': self.n_rows_inserted / self._insert_seconds if self._insert_seconds else None,
+                'last_batch_rows_per_second': self._last_batch_rate,
+               }
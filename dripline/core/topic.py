@@ -0,0 +1,111 @@
+'''
+Matching of AMQP routing keys against many topic patterns at once, using a trie of the patterns' words.
+'''
+
+from __future__ import absolute_import
+
+import fnmatch
+import itertools
+import logging
+
+__all__ = []
+
+logger = logging.getLogger(__name__)
+
+
+__all__.append('binding_key')
+def binding_key(pattern):
+    '''
+    The AMQP binding key delivering every message which <pattern> can match: words containing a partial
+    wildcard (eg. '*_temp'), which the broker does not support, are widened to '*'
+    '''
+    return '.'.join('*' if ('*' in word and word != '*') else word for word in pattern.split('.'))
+
+
+class _Node(object):
+    __slots__ = ('exact', 'star', 'hash', 'globs', 'values')
+
+    def __init__(self):
+        self.exact = {}
+        self.star = None
+        self.hash = None
+        self.globs = {}
+        self.values = []
+
+
+__all__.append('TopicTrie')
+class TopicTrie(object):
+    '''
+    Values registered against AMQP topic patterns, where '*' matches exactly one word and '#' zero or more words.
+    A word may also contain '*' as a partial wildcard (eg. 'sensor_value.*_temp'), matched with fnmatch.
+
+    Matching walks the trie word by word, so its cost grows with the length of the routing key rather than the number
+    of patterns; results are also cached per routing key, since a stream usually has a limited set of them.
+    '''
+
+    def __init__(self, cache_size=4096):
+        '''
+        cache_size (int): number of routing keys whose matches are remembered
+        '''
+        self._root = _Node()
+        self._order = itertools.count()
+        self._cache = {}
+        self.cache_size = cache_size
+        self.patterns = []
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def add(self, pattern, value):
+        '''
+        Register <value> to be returned by match for routing keys matching <pattern>
+        '''
+        node = self._root
+        for word in pattern.split('.'):
+            if word == '*':
+                node.star = node.star or _Node()
+                node = node.star
+            elif word == '#':
+                node.hash = node.hash or _Node()
+                node = node.hash
+            elif '*' in word:
+                node = node.globs.setdefault(word, _Node())
+            else:
+                node = node.exact.setdefault(word, _Node())
+        node.values.append((next(self._order), value))
+        self.patterns.append(pattern)
+        self._cache.clear()
+
+    def match(self, routing_key):
+        '''
+        Return the values of every pattern matching <routing_key>, each once, in the order they were added
+        '''
+        try:
+            return self._cache[routing_key]
+        except KeyError:
+            pass
+        found = {}
+        self._match(self._root, routing_key.split('.'), 0, found)
+        result = [found[order] for order in sorted(found)]
+        if len(self._cache) >= self.cache_size:
+            self._cache.clear()
+        self._cache[routing_key] = result
+        return result
+
+    def _match(self, node, words, index, found):
+        if node.hash is not None:
+            # '#' may consume any number of the remaining words, including none
+            for next_index in range(index, len(words) + 1):
+                self._match(node.hash, words, next_index, found)
+        if index == len(words):
+            found.update(node.values)
+            return
+        word = words[index]
+        child = node.exact.get(word)
+        if child is not None:
+            self._match(child, words, index + 1, found)
+        if node.star is not None:
+            self._match(node.star, words, index + 1, found)
+        for glob, child in node.globs.items():
+            if fnmatch.fnmatchcase(word, glob):
+                self._match(child, words, index + 1, found)
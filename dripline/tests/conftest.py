@@ -0,0 +1,159 @@
+""" conftest.py
+Fixtures shared by the test modules: stand-ins for the service of an endpoint, for pika's method and properties objects,
+and for the ioloop timers of a running service, optionally driven by a simulated clock.
+"""
+import concurrent.futures
+import types
+
+import pytest
+from dripline.core import ScheduleDispatcher, ServiceMetrics
+
+
+class MockService(object):
+    """
+    Records the replies sent by the endpoints attached to it, and collects their request metrics.
+    """
+    def __init__(self):
+        self.request_metrics = ServiceMetrics()
+        self.replies = []
+
+    def send_reply(self, properties, reply):
+        self.replies.append(reply)
+
+
+class FakeConnection(object):
+    """
+    Stand-in for the service's pika connection, keeping its timers to be fired by the test.
+    """
+    def __init__(self):
+        self.timeouts = {}
+
+    def add_timeout(self, delay, callback):
+        handle = object()
+        self.timeouts[handle] = callback
+        return handle
+
+    def remove_timeout(self, handle):
+        self.timeouts.pop(handle, None)
+
+    def fire(self):
+        for handle, callback in list(self.timeouts.items()):
+            del self.timeouts[handle]
+            callback()
+
+
+class SimulatedLoop(object):
+    """
+    Stand-in for the pika ioloop timers, driven by a simulated clock.
+    """
+    def __init__(self):
+        self.now = 0.
+        self.timers = {}
+        self.n_added = 0
+
+    def clock(self):
+        return self.now
+
+    def add_timeout(self, delay, callback):
+        self.n_added += 1
+        handle = object()
+        self.timers[handle] = (self.now + delay, callback)
+        return handle
+
+    def remove_timeout(self, handle):
+        self.timers.pop(handle, None)
+
+    def step(self, stop):
+        """
+        Advance the clock to the earliest timer due by <stop> and run it; False if there is none.
+        """
+        if not self.timers:
+            return False
+        handle, (due, callback) = min(self.timers.items(), key=lambda item: item[1][0])
+        if due > stop:
+            return False
+        del self.timers[handle]
+        self.now = max(self.now, due)
+        callback()
+        return True
+
+    def run_until(self, stop):
+        while self.step(stop):
+            pass
+        self.now = stop
+
+
+class SimulatedService(object):
+    """
+    Stand-in for a running service: a dispatcher on a SimulatedLoop, which also serves as its connection's timers,
+    a single-thread executor, and call_threadsafe queueing callbacks for the simulated ioloop.
+    """
+    def __init__(self):
+        self.loop = SimulatedLoop()
+        self._connection = self.loop
+        self.threadsafe = []
+        self.dispatcher = ScheduleDispatcher(add_timeout=self.loop.add_timeout,
+                                             remove_timeout=self.loop.remove_timeout,
+                                             clock=self.loop.clock,
+                                            )
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def now(self):
+        return self.loop.now
+
+    def call_threadsafe(self, callback, *args):
+        self.threadsafe.append((callback, args))
+
+    def executor_for(self, scheduler):
+        return self.executor
+
+    def run_pending(self):
+        """
+        Let executor work finish, then run what it handed back to the ioloop, until neither has anything left.
+        """
+        while True:
+            self.executor.submit(lambda: None).result()
+            if not self.threadsafe:
+                return
+            while self.threadsafe:
+                callback, args = self.threadsafe.pop(0)
+                callback(*args)
+
+    def run_until(self, stop):
+        self.run_pending()
+        while self.loop.step(stop):
+            self.run_pending()
+        self.loop.now = stop
+
+
+@pytest.fixture
+def mock_service():
+    return MockService()
+
+@pytest.fixture
+def fake_connection():
+    return FakeConnection()
+
+@pytest.fixture
+def sim_loop():
+    return SimulatedLoop()
+
+@pytest.fixture
+def simulated_service():
+    service = SimulatedService()
+    yield service
+    service.executor.shutdown()
+
+@pytest.fixture
+def request_properties():
+    return types.SimpleNamespace(content_encoding='application/json', correlation_id='0', reply_to='test_reply')
+
+@pytest.fixture
+def send_request(request_properties):
+    """
+    Hand a request to <endpoint>.handle_request as the service would, for the routing key <routing_key>.
+    """
+    def send(endpoint, routing_key, request):
+        endpoint.handle_request(None, types.SimpleNamespace(routing_key=routing_key), request_properties, request.to_json())
+    return send
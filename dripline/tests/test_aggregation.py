@@ -0,0 +1,100 @@
+""" test_aggregation.py
+Tests for StreamingStatistics and for the publish window of Spimes which publish statistics of their readings.
+"""
+import datetime
+import statistics
+import types
+
+import pytest
+from dripline.core import Spime, StreamingStatistics, constants
+from dripline.core import spime as spime_module
+
+
+def test_streaming_statistics():
+    """
+    Count, min, max, mean and sample standard deviation match a direct computation; non-numeric values are only counted.
+    """
+    values = [3., 1.5, 4., 1., 5.5, 9., 2.5]
+    stats = StreamingStatistics()
+    for value in values[:3] + ['OPEN', None, float('nan')] + values[3:]:
+        stats.add(value)
+    assert stats.count == len(values)
+    assert stats.n_non_numeric == 3
+    assert stats.min == 1.
+    assert stats.max == 9.
+    assert stats.mean == pytest.approx(statistics.mean(values))
+    assert stats.std == pytest.approx(statistics.stdev(values))
+    stats.reset()
+    stats.add('2')
+    assert stats.as_dict() == {'count': 1, 'min': 2., 'max': 2., 'mean': 2., 'std': None}
+
+
+class PublishingSpime(Spime):
+    def __init__(self, **kwargs):
+        Spime.__init__(self, **kwargs)
+        self.published = []
+
+    def store_value(self, alert, severity):
+        self.published.append(alert)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.)
+    monkeypatch.setattr(spime_module, 'time', types.SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+def read(spime, clock, when, value_raw, value_cal=None):
+    clock.now = when
+    result = {'value_raw': value_raw}
+    if value_cal is not None:
+        result['value_cal'] = value_cal
+    spime.scheduled_result(result)
+
+def time_string(when):
+    return datetime.datetime.utcfromtimestamp(when).strftime(constants.TIME_FORMAT)
+
+def test_publish_window_payload(clock):
+    """
+    Readings are published once per window as statistics of the calibrated values, with the mean raw value.
+    """
+    spime = PublishingSpime(name='fast_sensor', log_interval=2., publish_interval=10.)
+    for i in range(6):
+        read(spime, clock, 1000. + 2 * i, i, 10. * i)
+        assert len(spime.published) == (1 if i == 5 else 0)
+    (payload,) = spime.published
+    assert payload['count'] == 6
+    assert (payload['min'], payload['max']) == (0., 50.)
+    assert payload['mean'] == payload['value_cal'] == pytest.approx(25.)
+    assert payload['std'] == pytest.approx(statistics.stdev([10. * i for i in range(6)]))
+    assert payload['value_raw'] == pytest.approx(2.5)
+    assert payload['window_start'] == time_string(1000.)
+    assert payload['window_length'] == 10.
+    assert spime.window_statistics['value_raw']['count'] == 0
+
+def test_publish_window_grid(clock):
+    """
+    After a gap in the readings, the next window starts on the grid of publish_interval rather than at the late reading.
+    """
+    spime = PublishingSpime(name='fast_sensor', log_interval=2., publish_interval=10.)
+    read(spime, clock, 1000., 1.)
+    read(spime, clock, 1010., 2.)
+    read(spime, clock, 1025., 3.)
+    read(spime, clock, 1030., 4.)
+    assert [payload['window_start'] for payload in spime.published] == [time_string(1000.), time_string(1010.), time_string(1020.)]
+    assert [payload['window_length'] for payload in spime.published] == [10., 15., 10.]
+    assert [payload['count'] for payload in spime.published] == [2, 1, 1]
+
+def test_publish_window_non_numeric(clock):
+    """
+    Without calibrated values, statistics are of the raw values; a window without numeric readings publishes nothing.
+    """
+    spime = PublishingSpime(name='fast_sensor', log_interval=2., publish_interval=10.)
+    read(spime, clock, 1000., '1.5')
+    read(spime, clock, 1010., 'OPEN')
+    assert spime.published[0]['count'] == 1
+    assert spime.published[0]['mean'] == 1.5
+    assert 'value_cal' not in spime.published[0]
+    read(spime, clock, 1015., 'OPEN')
+    read(spime, clock, 1020., 'OPEN')
+    assert len(spime.published) == 1
+    assert spime.window_statistics['value_raw'] == {'count': 0, 'min': None, 'max': None, 'mean': None, 'std': None}
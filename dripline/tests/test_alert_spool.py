@@ -0,0 +1,143 @@
+""" test_alert_spool.py
+Tests for the disk-backed AlertSpool used to store alerts while the broker is unreachable, and for their replay by a Service.
+"""
+import pytest
+from dripline.core import AlertMessage, AlertSpool, Service
+
+
+@pytest.fixture
+def spool_path(tmpdir):
+    return str(tmpdir.join('alerts.spool'))
+
+def test_spool_replays_in_order_with_timestamps(spool_path):
+    """
+    Spooled alerts come back oldest first, with their original timestamps.
+    """
+    spool = AlertSpool(spool_path, max_bytes=4096)
+    alerts = [AlertMessage(payload={'value_raw': i}) for i in range(3)]
+    for alert in alerts:
+        assert spool.append('sensor_value.x', alert)
+    records = spool.peek(10)
+    assert [r[1].payload for r in records] == [a.payload for a in alerts]
+    assert [r[1].timestamp for r in records] == [a.timestamp for a in alerts]
+    spool.consume(records[1][2], 2)
+    assert [r[1].payload for r in spool.peek(10)] == [alerts[2].payload]
+    spool.consume(spool.peek(10)[0][2], 1)
+    assert len(spool) == 0
+
+def test_spool_is_bounded_and_persistent(spool_path):
+    """
+    Alerts which do not fit are dropped, and the spooled ones survive reopening the file.
+    """
+    spool = AlertSpool(spool_path, max_bytes=1024)
+    n_kept = sum(spool.append('sensor_value.x', AlertMessage(payload={'value_raw': i})) for i in range(100))
+    assert 0 < n_kept < 100
+    assert spool.statistics['dropped'] == 100 - n_kept
+    spool.close()
+    reopened = AlertSpool(spool_path, max_bytes=1024)
+    assert len(reopened.peek(1000)) == n_kept
+
+def test_spool_reuses_consumed_space(spool_path):
+    """
+    Space freed by consuming the oldest alerts is reused by new ones while the others are still pending.
+    """
+    spool = AlertSpool(spool_path, max_bytes=1024)
+    n_fit = 0
+    while spool.append('sensor_value.x', AlertMessage(payload={'value_raw': n_fit})):
+        n_fit += 1
+    replayed = []
+    for i in range(n_fit, 10 * n_fit):
+        records = spool.peek(2)
+        spool.consume(records[-1][2], 2)
+        replayed.extend(r[1].payload['value_raw'] for r in records)
+        assert spool.append('sensor_value.x', AlertMessage(payload={'value_raw': i}))
+    assert spool.statistics['dropped'] == 1
+    spool.close()
+    reopened = AlertSpool(spool_path, max_bytes=1024)
+    replayed.extend(r[1].payload['value_raw'] for r in reopened.peek(1000))
+    assert replayed == list(range(10 * n_fit))
+
+@pytest.mark.parametrize('new_size', [8192, 512])
+def test_spool_resize_keeps_alerts(spool_path, new_size):
+    """
+    Reopening a spool with another max_bytes keeps its alerts, oldest first, dropping those which no longer fit.
+    """
+    spool = AlertSpool(spool_path, max_bytes=4096)
+    for i in range(10):
+        assert spool.append('sensor_value.x', AlertMessage(payload={'value_raw': i}))
+    spool.close()
+    resized = AlertSpool(spool_path, max_bytes=new_size)
+    kept = [r[1].payload['value_raw'] for r in resized.peek(1000)]
+    assert 0 < len(kept)
+    assert kept == list(range(len(kept)))
+    assert resized.statistics['dropped'] == 10 - len(kept)
+    assert (len(kept) == 10) == (new_size == 8192)
+    resized.close()
+    assert len(AlertSpool(spool_path, max_bytes=new_size).peek(1000)) == len(kept)
+
+
+class FakeChannel(object):
+    def __init__(self, published, confirms):
+        self.published = published
+        self.confirms = confirms
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        confirmed = self.confirms.pop(0) if self.confirms else True
+        if confirmed:
+            self.published.append(routing_key)
+        return confirmed
+
+
+class FakeBlockingConnection(object):
+    def __init__(self, channel):
+        self._channel = channel
+
+    def channel(self):
+        return self._channel
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def service(spool_path, fake_connection):
+    service = Service(name='spooling_service', broker='localhost', exchange='requests', keys=[], alert_spool_path=spool_path, alert_spool_size=4096,
+                      alert_replay_rate=2, alert_replay_interval=1.)
+    service.published = []
+    service.confirms = []
+    service._blocking_connection = lambda: FakeBlockingConnection(FakeChannel(service.published, service.confirms))
+    service._connection = fake_connection
+    yield service
+    service.alert_spool.close()
+
+def test_live_alerts_bypass_replay(service):
+    """
+    While spooled alerts wait to be replayed, new alerts are published directly rather than queued behind them.
+    """
+    for i in range(3):
+        service.alert_spool.append('sensor_value.old', AlertMessage(payload={'value_raw': i}))
+    sent = []
+    service.send_message = lambda target, message, **kwargs: sent.append(target)
+    service.send_alert({'value_raw': 3}, 'sensor_value.new')
+    assert sent == ['sensor_value.new']
+    assert len(service.alert_spool.peek(10)) == 3
+
+def test_replay_consumes_only_confirmed(service):
+    """
+    Replay publishes at most alert_replay_rate*alert_replay_interval alerts per batch, and an alert the broker did not
+    confirm stays in the spool, with the ones after it.
+    """
+    for i in range(3):
+        service.alert_spool.append('sensor_value.{}'.format(i), AlertMessage(payload={'value_raw': i}))
+    service.confirms[:] = [True, False]
+    service._replay_alerts()
+    assert service.published == ['sensor_value.0']
+    assert [r[0] for r in service.alert_spool.peek(10)] == ['sensor_value.1', 'sensor_value.2']
+    assert service._replay_task.active
+    service.dispatcher.cancel(service._replay_task)
+    service._replay_alerts()
+    assert service.published == ['sensor_value.0', 'sensor_value.1', 'sensor_value.2']
+    assert len(service.alert_spool) == 0
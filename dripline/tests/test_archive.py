@@ -0,0 +1,135 @@
+""" test_archive.py
+Tests for the SegmentArchive, the history queries of ArchivedEndpoint and the ArchiveQueryService.
+"""
+import numpy
+import pytest
+from dripline.core import (ArchivedEndpoint, ArchiveQueryService, ChunkedResult, DriplineInternalError, DriplineValueError,
+                           SegmentArchive, decimate_minmax)
+
+
+@pytest.fixture
+def archive(tmpdir):
+    archive = SegmentArchive(str(tmpdir), segment_rows=100, segment_duration=50.)
+    for i in range(1000):
+        archive.append('sensor', 1000. + i * 0.2, i, 2 * i if i % 10 else 'not a number')
+    archive.flush()
+    return archive
+
+def test_rotation_and_read(archive):
+    """
+    Segments rotate on size and duration, and reads span them.
+    """
+    assert len(archive.index('sensor')) == 10
+    data = archive.read('sensor', start=1010., stop=1090.)
+    assert len(data['time']) == 401
+    assert data['time'][0] == 1010.
+    assert data['value_raw'][-1] == 450.
+
+def test_reopen_recovers_unindexed_rows(archive, tmpdir):
+    """
+    Rows written after the index was last saved are recovered when the archive is reopened.
+    """
+    archive.append('sensor', 2000., 1.)
+    archive._open['sensor'][1].flush()
+    reopened = SegmentArchive(str(tmpdir), segment_rows=100, segment_duration=50.)
+    reopened.append('sensor', 2000.5, 2.)
+    assert len(reopened.read('sensor')['time']) == 1002
+
+def test_segments_grow(tmpdir):
+    """
+    Segments start small and double in size as they fill, up to segment_rows.
+    """
+    archive = SegmentArchive(str(tmpdir), segment_rows=100, initial_segment_rows=4)
+    for i in range(10):
+        archive.append('sensor', 1000. + i, i)
+    archive.flush()
+    (segment,) = archive.index('sensor')
+    assert len(numpy.load(str(tmpdir.join('sensor', segment['file'])), mmap_mode='r')) == 16
+    reopened = SegmentArchive(str(tmpdir), segment_rows=100, initial_segment_rows=4)
+    assert reopened.read('sensor')['value_raw'].tolist() == list(range(10))
+
+def test_small_disorder_inserted_in_order(tmpdir):
+    archive = SegmentArchive(str(tmpdir), reorder_window=5.)
+    for timestamp in [100., 102., 101., 103., 101.5]:
+        archive.append('sensor', timestamp, timestamp)
+    assert len(archive.index('sensor')) == 1
+    assert archive.read('sensor')['time'].tolist() == [100., 101., 101.5, 102., 103.]
+
+def test_late_reading_starts_new_segment(tmpdir):
+    """
+    A reading older than the reorder window starts a segment of its own, which must not replace one with the same start.
+    """
+    archive = SegmentArchive(str(tmpdir), reorder_window=0.)
+    for timestamp, value in [(100., 1), (101., 2), (100., 3)]:
+        archive.append('sensor', timestamp, value)
+    archive.flush()
+    files = [segment['file'] for segment in archive.index('sensor')]
+    assert len(set(files)) == 2
+    data = SegmentArchive(str(tmpdir)).read('sensor')
+    assert data['time'].tolist() == [100., 100., 101.]
+    assert data['value_raw'].tolist() == [1., 3., 2.]
+
+def test_history_decimation_and_chunks(archive):
+    """
+    History queries decimate to max_points, and results larger than chunk_points are chunked.
+    """
+    endpoint = ArchivedEndpoint(name='archive_sensor', archive=archive, archive_name='sensor', chunk_points=300)
+    decimated = endpoint.history(max_points=20)
+    assert len(decimated['time']) <= 20
+    assert None in endpoint.history(stop=1002.)['value_cal']
+    chunks = endpoint.history(max_points=0)
+    assert isinstance(chunks, ChunkedResult)
+    assert [len(chunk['time']) for chunk in chunks] == [300, 300, 300, 100]
+    assert endpoint.on_get()['value_raw'] == 999.
+
+@pytest.mark.parametrize('max_points', [2, 3, 7, 20])
+def test_decimation_bound(max_points):
+    values = numpy.sin(numpy.arange(1000) / 10.)
+    indices = decimate_minmax(values, max_points)
+    assert 2 <= len(indices) <= max_points
+    assert values[indices].max() == values.max()
+    assert values[indices].min() == values.min()
+
+def test_decimation_needs_two_points():
+    with pytest.raises(DriplineValueError):
+        decimate_minmax(numpy.arange(10.), 1)
+
+def test_reader_sees_new_rows(archive, tmpdir):
+    """
+    A reading archive reloads an index which the writing one has saved since.
+    """
+    reader = SegmentArchive(str(tmpdir))
+    assert len(reader.read('sensor')['time']) == 1000
+    archive.append('sensor', 1200., 1.)
+    archive.flush()
+    assert reader.read('sensor')['time'][-1] == 1200.
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.bindings = []
+
+    def queue_bind(self, callback, queue, exchange, routing_key):
+        self.bindings.append((exchange, routing_key))
+
+def test_query_service_serves_new_endpoints(archive, tmpdir):
+    """
+    Endpoints archived after the ArchiveQueryService started are added, and bound, by refresh_endpoints.
+    """
+    service = ArchiveQueryService(name='archive_query', broker='localhost', keys=[], archive_root=str(tmpdir))
+    assert 'archive_sensor' in service.endpoints
+    service._channel = FakeChannel()
+    assert service.refresh_endpoints() == []
+    archive.append('pressure', 1000., 1e-6)
+    archive.flush()
+    assert service.refresh_endpoints() == ['pressure']
+    assert service._channel.bindings == [('requests', 'archive_pressure.#')]
+    assert service.endpoints['archive_pressure'].on_get()['value_raw'] == 1e-6
+
+def test_numpy_required(tmpdir, monkeypatch):
+    from dripline.core import history
+    monkeypatch.setattr(history, 'numpy', None)
+    with pytest.raises(DriplineInternalError, match='numpy extra'):
+        SegmentArchive(str(tmpdir))
+    with pytest.raises(DriplineInternalError, match='numpy extra'):
+        history.RingHistory(10)
@@ -0,0 +1,42 @@
+""" test_bench.py
+Tests for dripline-bench: parsing the op mix, the latency summaries, and a short run through the in-memory loopback.
+"""
+import pytest
+from dripline.bench import parse_mix, percentile, run_benchmark, summarize
+
+
+def test_parse_mix_normalized():
+    assert parse_mix('get=3,set=1') == [('get', 0.75), ('set', 0.25)]
+    assert parse_mix('get') == [('get', 1.)]
+
+def test_parse_mix_bad_op():
+    with pytest.raises(ValueError):
+        parse_mix('get=0.5,cmd=0.5')
+
+def test_percentile():
+    values = list(range(101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99.9) == 100
+    assert percentile([], 50) is None
+
+def test_summarize():
+    """
+    Latencies in seconds are summarized in milliseconds; an empty list has no statistics.
+    """
+    summary = summarize([0.003, 0.001, 0.002])
+    assert summary['count'] == 3
+    assert summary['mean'] == pytest.approx(2.)
+    assert summary['p50'] == pytest.approx(2.)
+    assert summary['p999'] == pytest.approx(3.)
+    assert summarize([]) == {'count': 0, 'mean': None, 'p50': None, 'p95': None, 'p99': None, 'p999': None}
+
+def test_loopback_run():
+    """
+    Every request of a short loopback run is answered without error, and counted by op.
+    """
+    results = run_benchmark(n_clients=2, n_endpoints=3, mix='get=0.5,set=0.5', duration=30., max_requests=25)
+    assert results['requests'] == 50
+    assert results['errors'] == 0
+    latency = results['latency_ms']
+    assert latency['all']['count'] == 50
+    assert latency['get']['count'] + latency['set']['count'] == 50
@@ -0,0 +1,235 @@
+""" test_benchmarks.py
+Micro-benchmarks of the dripline.core hot paths, compared against the baselines in benchmark_baselines.json.
+
+They are skipped unless DRIPLINE_BENCHMARK is set, to one of:
+    run      time each benchmark and print the results
+    compare  also fail any benchmark slower than its baseline by more than its tolerance
+    record   write the results as the new baselines
+
+Times are compared relative to a pure-python reference loop timed alongside each benchmark, so that baselines recorded
+on one machine remain meaningful on another (and under varying load); absolute times are printed and stored for information.
+Each benchmark is timed in several repeats and compared by its median. A baseline is the middle of three such sessions,
+and its tolerance is recorded with it: the larger of DRIPLINE_BENCHMARK_THRESHOLD (default 0.35, ie. 35%) and twice
+the spread of the recorded timings (the interquartile range of the repeats, or the range of the sessions), so that
+benchmarks which are noisy on the recording machine are not gated tighter than their own noise.
+In compare mode, a benchmark over its tolerance is retimed up to twice before it fails.
+"""
+import json
+import os
+import statistics
+import timeit
+import types
+
+import pytest
+from dripline.core import (AlertMessage, Endpoint, Message, ReplyMessage, RequestMessage, Spime,
+                           calibrate, constants, fancy_doc)
+
+
+MODE = os.environ.get('DRIPLINE_BENCHMARK', '')
+THRESHOLD = float(os.environ.get('DRIPLINE_BENCHMARK_THRESHOLD', 0.35))
+RETRIES = 2
+RECORD_SESSIONS = 3
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baselines.json')
+
+pytestmark = pytest.mark.skipif(MODE not in ('run', 'compare', 'record'),
+                                reason='set DRIPLINE_BENCHMARK to run, compare or record to run the benchmarks')
+
+results = {}
+
+
+def _reference_work():
+    total = 0
+    for i in range(1000):
+        total += i * i
+    return total
+
+def _median_times(fun, repeat=7):
+    """
+    Median per-call times (in seconds) of <fun> and of the reference loop, and the median and spread (interquartile range
+    over median) of their ratio, from <repeat> runs each long enough (>= 0.2 s) to time reliably; the runs alternate, so that each
+    ratio is of times taken under the same load on the machine.
+    """
+    timer = timeit.Timer(fun)
+    number, _ = timer.autorange()
+    reference_timer = timeit.Timer(_reference_work)
+    reference_number, _ = reference_timer.autorange()
+    times = []
+    reference_times = []
+    for i in range(repeat):
+        times.append(timer.timeit(number) / number)
+        reference_times.append(reference_timer.timeit(reference_number) / reference_number)
+    ratios = [seconds / reference_seconds for seconds, reference_seconds in zip(times, reference_times)]
+    relative = statistics.median(ratios)
+    # quartiles as the medians of the lower and upper halves (statistics.quantiles needs python 3.8)
+    ratios.sort()
+    half = len(ratios) // 2
+    lower = statistics.median(ratios[:half])
+    upper = statistics.median(ratios[-half:])
+    return statistics.median(times), statistics.median(reference_times), relative, (upper - lower) / relative
+
+@pytest.fixture(scope='module')
+def baselines():
+    """
+    The stored baselines; on teardown in record mode, updated with this session's results.
+    """
+    stored = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as baseline_file:
+            stored = json.load(baseline_file)
+    yield stored
+    if MODE == 'record' and results:
+        stored.update(results)
+        with open(BASELINE_FILE, 'w') as baseline_file:
+            json.dump(stored, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write('\n')
+
+@pytest.fixture
+def benchmark(request, baselines):
+    """
+    Time a callable under the current test's name and check it against its baseline.
+    """
+    def run(fun):
+        if MODE == 'record':
+            # the baseline is the middle of several sessions, which also give the spread between sessions
+            sessions = sorted((_median_times(fun) for i in range(RECORD_SESSIONS)), key=lambda session: session[2])
+            seconds, reference_seconds, relative, spread = sessions[len(sessions) // 2]
+            spread = max(spread, (sessions[-1][2] - sessions[0][2]) / relative)
+        else:
+            seconds, reference_seconds, relative, spread = _median_times(fun)
+        name = request.node.name
+        results[name] = {'seconds': seconds, 'reference_seconds': reference_seconds, 'relative': relative,
+                         'tolerance': round(max(THRESHOLD, 2 * spread), 2)}
+        baseline = baselines.get(name)
+        if baseline is None:
+            print('\n{}: {:.2f} us ({:.2f} x reference; no baseline)'.format(name, 1e6 * seconds, relative))
+            return seconds
+        tolerance = baseline.get('tolerance', THRESHOLD)
+        change = relative / baseline['relative'] - 1
+        for retry in range(RETRIES if MODE == 'compare' else 0):
+            if change <= tolerance:
+                break
+            # a real regression persists, while a burst of load on the machine rarely outlasts a few retimings
+            relative = min(relative, _median_times(fun)[2])
+            change = relative / baseline['relative'] - 1
+        print('\n{}: {:.2f} us ({:.2f} x reference; {:+.1%} vs baseline, tolerance {:.0%})'.format(name, 1e6 * seconds, relative, change, tolerance))
+        if MODE == 'compare':
+            assert change <= tolerance, '{} is {:.1%} slower than its baseline (tolerance {:.0%})'.format(name, change, tolerance)
+        return seconds
+    return run
+
+
+### messages
+
+MESSAGES = {
+    'request': lambda: RequestMessage(msgop=constants.OP_GET, payload={'values': []}, lockout_key='c4b2ca5f1a2d4a2b9b1e5d3c2f1a0b9c'),
+    'reply': lambda: ReplyMessage(retcode=0, payload={'value_raw': 1.5, 'value_cal': 3.}, return_msg=''),
+    'alert': lambda: AlertMessage(payload={'value_raw': 1.5, 'value_cal': 3.}),
+}
+
+@pytest.mark.parametrize('msgtype', sorted(MESSAGES))
+def test_message_construct(benchmark, msgtype):
+    benchmark(MESSAGES[msgtype])
+
+@pytest.mark.parametrize('msgtype', sorted(MESSAGES))
+def test_message_encode(benchmark, msgtype):
+    message = MESSAGES[msgtype]()
+    benchmark(lambda: message.to_encoding('application/json'))
+
+@pytest.mark.parametrize('msgtype', sorted(MESSAGES))
+def test_message_decode(benchmark, msgtype):
+    encoded = MESSAGES[msgtype]().to_json().encode('utf-8')
+    benchmark(lambda: Message.from_encoded(encoded, 'application/json'))
+
+
+### request dispatch
+
+class BenchEndpoint(Endpoint):
+    def __init__(self, **kwargs):
+        Endpoint.__init__(self, **kwargs)
+        self.value = 1.5
+        self.units = 'K'
+
+    def on_get(self):
+        return {'value_raw': self.value}
+
+    def on_set(self, value):
+        self.value = value
+
+REQUESTS = {
+    'get': ('bench', RequestMessage(msgop=constants.OP_GET, payload={'values': []})),
+    'set': ('bench', RequestMessage(msgop=constants.OP_SET, payload={'values': [2.5]})),
+    'get_attribute': ('bench.units', RequestMessage(msgop=constants.OP_GET, payload={'values': []})),
+    'cmd': ('bench.on_get', RequestMessage(msgop=constants.OP_CMD, payload={'values': []})),
+}
+
+@pytest.mark.parametrize('kind', sorted(REQUESTS))
+def test_handle_request(benchmark, mock_service, request_properties, kind):
+    endpoint = BenchEndpoint(name='bench')
+    endpoint.service = mock_service
+    routing_key, request = REQUESTS[kind]
+    method = types.SimpleNamespace(routing_key=routing_key)
+    body = request.to_json().encode('utf-8')
+    def handle():
+        endpoint.handle_request(None, method, request_properties, body)
+        del mock_service.replies[:-1]
+    benchmark(handle)
+    assert mock_service.replies[-1].retcode == 0
+
+
+### calibration
+
+class CalibratedEndpoint(Endpoint):
+    @calibrate()
+    def on_get(self):
+        return self.raw
+
+@pytest.mark.parametrize('calibration,raw', [
+    ('2.*{}+1', 1.5),
+    ('{}**2 - 1', ' 3 '),
+    ({'0': 'off', '1': 'on'}, '1'),
+], ids=['string_numeric', 'string_text', 'dict'])
+def test_calibrate(benchmark, calibration, raw):
+    endpoint = CalibratedEndpoint(name='calibrated', calibration=calibration)
+    endpoint.raw = raw
+    benchmark(endpoint.on_get)
+    assert 'value_cal' in endpoint.on_get()
+
+
+### log decision
+
+class BenchSpime(Spime):
+    def on_get(self):
+        self.reading += 1
+        return {'value_raw': 100. + self.reading % 7}
+
+    def store_value(self, alert, severity):
+        self.n_logged += 1
+
+@pytest.mark.parametrize('log_decision', [
+    None,
+    {'type': 'deadband', 'deadband': 3.},
+    {'type': 'swinging_door', 'deviation': 1.},
+], ids=['threshold', 'deadband', 'swinging_door'])
+def test_scheduled_action(benchmark, log_decision):
+    spime = BenchSpime(name='bench_spime', log_interval=1., max_interval=60, max_fractional_change=0.02, log_decision=log_decision)
+    spime.reading = 0
+    spime.n_logged = 0
+    benchmark(spime.scheduled_action)
+    assert 0 < spime.n_logged < spime.reading
+
+
+### class creation
+
+def test_fancy_doc_class_creation(benchmark):
+    def make_class():
+        class DocumentedSpime(Spime):
+            '''
+            a spime subclass as defined by an instrument module
+            '''
+            def __init__(self, channel=None, **kwargs):
+                '''
+                channel (str): instrument channel to read
+                '''
+                Spime.__init__(self, **kwargs)
+        return fancy_doc(DocumentedSpime)
+    benchmark(make_class)
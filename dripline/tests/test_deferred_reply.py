@@ -0,0 +1,143 @@
+""" test_deferred_reply.py
+Tests for replies deferred until a future or awaitable returned by an endpoint method completes.
+"""
+import asyncio
+import concurrent.futures
+import threading
+import time
+import types
+
+import pytest
+from dripline.core import (DriplineTimeoutError, DriplineValueError, Endpoint, RequestMessage, Spimescape,
+                           constants)
+
+
+class DeferringEndpoint(Endpoint):
+    def __init__(self, **kwargs):
+        Endpoint.__init__(self, **kwargs)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.release = threading.Event()
+
+    def from_future(self):
+        return self.executor.submit(lambda: {'value_raw': 1})
+
+    def failing_future(self):
+        def fail():
+            raise DriplineValueError('bad value')
+        return self.executor.submit(fail)
+
+    def crashing_future(self):
+        def crash():
+            raise RuntimeError('unexpected')
+        return self.executor.submit(crash)
+
+    def blocked_future(self):
+        return self.executor.submit(self.release.wait)
+
+    async def from_coroutine(self):
+        await asyncio.sleep(0.01)
+        return {'value_raw': 2}
+
+
+@pytest.fixture
+def service(fake_connection):
+    service = Spimescape(name='deferring_service', broker='localhost', keys=[], deferred_timeout=5)
+    service.replies = []
+    service.send_reply = lambda properties, reply: service.replies.append(reply)
+    service._connection = fake_connection
+    endpoint = DeferringEndpoint(name='deferring')
+    service.add_endpoint(endpoint)
+    yield service
+    endpoint.release.set()
+    endpoint.executor.shutdown()
+    if service._async_loop is not None:
+        service._async_loop.call_soon_threadsafe(service._async_loop.stop)
+
+def wait_for_reply(service, timeout=5.):
+    deadline = time.time() + timeout
+    while not service.replies and time.time() < deadline:
+        time.sleep(0.005)
+    assert service.replies, 'no reply was sent'
+    return service.replies[0]
+
+def send_cmd(send_request, service, method_name):
+    send_request(service.endpoints['deferring'], 'deferring.' + method_name, RequestMessage(msgop=constants.OP_CMD, payload={'values': []}))
+
+@pytest.mark.parametrize('method_name,value', [('from_future', 1), ('from_coroutine', 2)])
+def test_deferred_result(send_request, service, method_name, value):
+    """
+    The reply is sent once the future or coroutine completes, with its result.
+    """
+    send_cmd(send_request, service, method_name)
+    reply = wait_for_reply(service)
+    assert reply.retcode == 0
+    assert reply.payload['value_raw'] == value
+    assert not service._connection.timeouts
+
+@pytest.mark.parametrize('method_name,retcode', [
+    ('failing_future', DriplineValueError.retcode),
+    ('crashing_future', 999),
+])
+def test_deferred_exception_retcodes(send_request, service, method_name, retcode):
+    """
+    Exceptions raised while completing map to retcodes as in the synchronous path.
+    """
+    send_cmd(send_request, service, method_name)
+    reply = wait_for_reply(service)
+    assert reply.retcode == retcode
+
+def test_deferred_timeout(send_request, service):
+    """
+    A request still pending after deferred_timeout is answered with a timeout error, and its late result discarded.
+    """
+    send_cmd(send_request, service, 'blocked_future')
+    assert not service.replies
+    (on_timeout,) = service._connection.timeouts.values()
+    on_timeout()
+    assert len(service.replies) == 1
+    assert service.replies[0].retcode == DriplineTimeoutError.retcode
+    service.endpoints['deferring'].release.set()
+    time.sleep(0.05)
+    assert len(service.replies) == 1
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append(('ack', delivery_tag))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.acks.append(('nack', delivery_tag, requeue))
+
+def deliver(service, request_properties, routing_key, delivery_tag, redelivered=False):
+    request = RequestMessage(msgop=constants.OP_CMD, payload={'values': []})
+    service.on_message(None, types.SimpleNamespace(routing_key=routing_key, delivery_tag=delivery_tag, redelivered=redelivered),
+                       request_properties, request.to_json())
+
+def test_late_ack_after_deferred_reply(service, request_properties):
+    """
+    With ack_mode 'late', a request whose reply is deferred is acknowledged once the reply has been sent.
+    """
+    service.ack_mode = 'late'
+    service._channel = FakeChannel()
+    deliver(service, request_properties, 'deferring.blocked_future', 1)
+    assert service._channel.acks == []
+    service.endpoints['deferring'].release.set()
+    wait_for_reply(service)
+    deadline = time.time() + 5.
+    while not service._channel.acks and time.time() < deadline:
+        time.sleep(0.005)
+    assert service._channel.acks == [('ack', 1)]
+
+def test_failed_delivery_rejected(service, request_properties):
+    """
+    A delivery whose handling raises is rejected, and requeued only the first time.
+    """
+    service.ack_mode = 'late'
+    service._channel = FakeChannel()
+    for redelivered in (False, True):
+        with pytest.raises(KeyError):
+            deliver(service, request_properties, 'missing.endpoint', 2, redelivered=redelivered)
+    assert service._channel.acks == [('nack', 2, True), ('nack', 2, False)]
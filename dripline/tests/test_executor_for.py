@@ -0,0 +1,68 @@
+""" test_executor_for.py
+Tests for the choice of executor running scheduled work off the ioloop.
+"""
+import threading
+import time
+
+import pytest
+from dripline.core import Provider, Spime, Spimescape
+
+
+class CountingProvider(Provider):
+    """
+    A provider whose send() is not thread-safe: it records the largest number of concurrent calls.
+    """
+    def __init__(self, **kwargs):
+        Provider.__init__(self, **kwargs)
+        self._lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def send(self, commands):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.01)
+        with self._lock:
+            self.active -= 1
+        return commands
+
+class ReadingSpime(Spime):
+    def on_get(self):
+        return self.provider.send(['read?'])
+
+
+@pytest.fixture
+def service():
+    service = Spimescape(name='executing_service', broker='localhost', keys=[], scheduler_workers=4)
+    yield service
+    for executor in [service._executor] + service._provider_executors:
+        if executor is not None:
+            executor.shutdown()
+
+def test_provider_work_serialized(service):
+    """
+    Scheduled work of a provider's endpoints runs one at a time, in a thread of that provider.
+    """
+    provider = CountingProvider(name='instrument')
+    service.add_endpoint(provider)
+    spimes = [ReadingSpime(name='reading_{}'.format(i), run_in_executor=True) for i in range(4)]
+    for spime in spimes:
+        provider.add_endpoint(spime)
+    executors = set(service.executor_for(spime) for spime in spimes)
+    assert executors == set([provider.executor])
+    futures = [service.executor_for(spime).submit(spime.scheduled_work) for spime in spimes * 2]
+    for future in futures:
+        future.result(5)
+    assert provider.max_active == 1
+
+def test_dedicated_and_shared_executors(service):
+    provider = CountingProvider(name='parallel_instrument', executor_workers=2)
+    service.add_endpoint(provider)
+    spime = ReadingSpime(name='parallel_reading', run_in_executor=True)
+    provider.add_endpoint(spime)
+    assert service.executor_for(spime) is provider.executor
+    assert not service._provider_executors
+    direct = ReadingSpime(name='direct_reading', run_in_executor=True)
+    service.add_endpoint(direct)
+    assert service.executor_for(direct) is service._executor
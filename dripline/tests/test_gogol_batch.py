@@ -0,0 +1,79 @@
+""" test_gogol_batch.py
+Tests for batched alert consumption by a Gogol: buffering, flushing on size or latency, acks, and failed batches.
+"""
+import types
+
+import pytest
+from dripline.core import AlertMessage, Gogol, ScheduleDispatcher
+
+
+class FakeChannel(object):
+    def __init__(self):
+        self.acks = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append(('ack', delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.acks.append(('nack', delivery_tag, requeue))
+
+
+class BatchGogol(Gogol):
+    """
+    Records each batch it consumes; fails any batch holding an alert with value_raw 'poison'.
+    """
+    def __init__(self, **kwargs):
+        Gogol.__init__(self, **kwargs)
+        self.batches = []
+
+    def this_consume_batch(self, messages):
+        values = [message.payload['value_raw'] for message, method in messages]
+        if 'poison' in values:
+            raise ValueError('cannot store <poison>')
+        self.batches.append(values)
+
+@pytest.fixture
+def gogol(sim_loop):
+    gogol = BatchGogol(name='batch_gogol', broker='localhost', consume_batch_size=3, consume_batch_latency=1.)
+    gogol._dispatcher = ScheduleDispatcher(add_timeout=sim_loop.add_timeout, remove_timeout=sim_loop.remove_timeout, clock=sim_loop.clock)
+    gogol._channel = FakeChannel()
+    return gogol
+
+def deliver(gogol, delivery_tag, value_raw, redelivered=False):
+    method = types.SimpleNamespace(routing_key='sensor_value.x', delivery_tag=delivery_tag, redelivered=redelivered)
+    properties = types.SimpleNamespace(content_encoding='application/json')
+    gogol.on_alert_message(gogol._channel, method, properties, AlertMessage(payload={'value_raw': value_raw}).to_json())
+
+def test_full_batch_acked_once(gogol):
+    """
+    A full batch is consumed in one call and acknowledged with a single multiple ack.
+    """
+    for tag in (1, 2, 3):
+        deliver(gogol, tag, tag)
+    assert gogol.batches == [[1, 2, 3]]
+    assert gogol._channel.acks == [('ack', 3, True)]
+    assert gogol.ack_mode == 'late'
+
+def test_partial_batch_flushed_after_latency(gogol, sim_loop):
+    deliver(gogol, 1, 1)
+    deliver(gogol, 2, 2)
+    sim_loop.run_until(0.5)
+    assert gogol.batches == []
+    sim_loop.run_until(1.)
+    assert gogol.batches == [[1, 2]]
+    assert gogol._channel.acks == [('ack', 2, True)]
+
+def test_poison_alert_isolated(gogol, sim_loop):
+    """
+    When a batch fails, its alerts are retried one at a time: the others are stored and acknowledged, and the failing
+    one is requeued once, then dropped when it fails again.
+    """
+    for tag, value in [(1, 1), (2, 'poison'), (3, 3)]:
+        deliver(gogol, tag, value)
+    assert gogol.batches == [[1], [3]]
+    assert gogol._channel.acks == [('ack', 1, False), ('nack', 2, True), ('ack', 3, False)]
+    deliver(gogol, 4, 'poison', redelivered=True)
+    sim_loop.run_until(1.)
+    assert gogol._channel.acks[-1] == ('nack', 4, False)
+    assert gogol.n_failed_alerts == 2
+    assert gogol.n_batched_alerts == 2
@@ -0,0 +1,147 @@
+""" test_gogol_pool.py
+Tests for the GogolSupervisor: the kwargs of its workers, the queues and bindings each sets up, and the aggregation
+of their metric reports.
+"""
+import queue
+import types
+
+import pytest
+from dripline.core import DriplineValueError, Gogol, GogolSupervisor
+
+
+class FakeChannel(object):
+    """
+    Records the queue and exchange setup of a Gogol, completing each declaration at once.
+    """
+    def __init__(self):
+        self.queue_bindings = []
+        self.exchange_bindings = []
+        self.declared = []
+        self.consumed = []
+
+    def queue_declare(self, callback, queue, **kwargs):
+        self.declared.append((queue, kwargs))
+        callback(None)
+
+    def exchange_declare(self, callback, exchange, exchange_type):
+        self.declared.append((exchange, exchange_type))
+        callback(None)
+
+    def queue_bind(self, callback, queue, exchange, routing_key):
+        self.queue_bindings.append((queue, exchange, routing_key))
+        if callback is not None:
+            callback(None)
+
+    def exchange_bind(self, callback, destination, source, routing_key):
+        self.exchange_bindings.append((destination, source, routing_key))
+
+    def add_on_cancel_callback(self, callback):
+        pass
+
+    def basic_consume(self, callback, queue):
+        self.consumed.append(queue)
+        return 'ctag-{}'.format(queue)
+
+
+def setup_worker(supervisor, index):
+    gogol = Gogol(broker='localhost', keys=['sensor_value.#'], **supervisor._worker_kwargs(index))
+    gogol._channel = FakeChannel()
+    gogol.setup_queue(gogol.queue_name)
+    return gogol
+
+def test_worker_kwargs():
+    """
+    Workers are named after the supervisor, share its queue and prefetch_count, and acknowledge late by default.
+    """
+    supervisor = GogolSupervisor(Gogol, n_workers=3, name='logger', prefetch_count=20)
+    kwargs = [supervisor._worker_kwargs(index) for index in range(3)]
+    assert [these_kwargs['name'] for these_kwargs in kwargs] == ['logger-0', 'logger-1', 'logger-2']
+    for these_kwargs in kwargs:
+        assert these_kwargs['shared_queue'] == 'logger'
+        assert these_kwargs['prefetch_count'] == 20
+        assert these_kwargs['ack_mode'] == 'late'
+        assert 'hash_exchange' not in these_kwargs
+    assert GogolSupervisor('dripline.core.Gogol', ack_mode='batched')._worker_kwargs(0)['ack_mode'] == 'batched'
+    assert GogolSupervisor('dripline.core.Gogol').name == 'Gogol'
+
+def test_shared_queue_bindings():
+    """
+    Only alerts are bound to the shared queue; each worker's requests and broadcasts go to its own private queue.
+    """
+    supervisor = GogolSupervisor(Gogol, name='logger')
+    workers = [setup_worker(supervisor, index) for index in range(2)]
+    for index, gogol in enumerate(workers):
+        name = 'logger-{}'.format(index)
+        assert gogol.ack_mode == 'late'
+        assert gogol._channel.declared == [('logger', {'durable': True, 'exclusive': False, 'auto_delete': False}),
+                                           (name, {'exclusive': True, 'auto_delete': True}),
+                                          ]
+        assert sorted(gogol._channel.queue_bindings) == sorted([('logger', 'alerts', 'sensor_value.#'),
+                                                                (name, 'requests', 'broadcast.#'),
+                                                                (name, 'requests', name + '.#'),
+                                                               ])
+        assert gogol._channel.consumed == ['logger', name]
+
+def test_hash_exchange_bindings():
+    """
+    With a hash_exchange, each worker's own queue is bound to it with weight 1, and the exchange to the alerts.
+    """
+    supervisor = GogolSupervisor(Gogol, name='logger', hash_exchange='alert_hash')
+    assert 'shared_queue' not in supervisor._worker_kwargs(0)
+    gogol = setup_worker(supervisor, 1)
+    assert gogol.queue_name == 'logger-1'
+    assert gogol._channel.declared == [('logger-1', {'durable': False, 'exclusive': True, 'auto_delete': True}),
+                                       ('alert_hash', 'x-consistent-hash'),
+                                      ]
+    assert gogol._channel.exchange_bindings == [('alert_hash', 'alerts', 'sensor_value.#')]
+    assert sorted(gogol._channel.queue_bindings) == sorted([('logger-1', 'requests', 'broadcast.#'),
+                                                            ('logger-1', 'requests', 'logger-1.#'),
+                                                            ('logger-1', 'alert_hash', '1'),
+                                                           ])
+
+def test_shared_queue_excludes_hash_exchange():
+    with pytest.raises(DriplineValueError):
+        Gogol(broker='localhost', shared_queue='logger', hash_exchange='alert_hash')
+
+def report(name, time, received, lags=()):
+    count = len(lags)
+    return {'name': name,
+            'time': time,
+            'received': received,
+            'lag': {'count': count,
+                    'mean': sum(lags) / count if count else None,
+                    'max': max(lags) if count else None,
+                   },
+           }
+
+class FakeQueue(object):
+    def __init__(self, reports):
+        self.reports = list(reports)
+
+    def get(self, block, timeout):
+        if not self.reports:
+            raise queue.Empty
+        return self.reports.pop(0)
+
+def test_collect():
+    """
+    Rates come from successive reports of each worker, and the lag is combined over the latest reports of all of them.
+    """
+    supervisor = GogolSupervisor(Gogol, name='logger')
+    supervisor._workers = {0: types.SimpleNamespace(is_alive=lambda: True),
+                           1: types.SimpleNamespace(is_alive=lambda: False),
+                          }
+    supervisor._metrics_queue = FakeQueue([report('logger-0', 0., 0), report('logger-1', 0., 0)])
+    statistics = supervisor.collect()
+    assert statistics['rate'] == 0.
+    assert statistics['mean_lag'] is None
+    supervisor._metrics_queue = FakeQueue([report('logger-0', 10., 100, [1., 3.]),
+                                           report('logger-1', 10., 50, [4.]),
+                                          ])
+    statistics = supervisor.collect()
+    assert statistics == {'workers_alive': 1,
+                          'received': 150,
+                          'rate': pytest.approx(15.),
+                          'mean_lag': pytest.approx(8. / 3.),
+                          'max_lag': 4.,
+                         }
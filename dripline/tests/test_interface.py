@@ -0,0 +1,135 @@
+""" test_interface.py
+Tests for the Interface's persistent request session and its alert subscriptions, against a fake broker connection.
+"""
+import types
+
+import pytest
+from dripline.core import AlertMessage, DriplineTimeoutError, DriplineValueError, Interface, ReplyMessage, RequestMessage
+
+
+class FakeChannel(object):
+    """
+    Answers each request published with the replies which <responder>(routing_key, request) returns.
+    """
+    def __init__(self, responder):
+        self.responder = responder
+        self.consumer = None
+        self.pending = []
+        self.n_published = 0
+
+    def confirm_delivery(self):
+        pass
+
+    def queue_declare(self, queue, **kwargs):
+        return types.SimpleNamespace(method=types.SimpleNamespace(queue=queue))
+
+    def queue_bind(self, **kwargs):
+        pass
+
+    def basic_consume(self, callback, no_ack, queue):
+        self.consumer = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties, mandatory=False):
+        self.n_published += 1
+        request = RequestMessage.from_encoded(body, properties.content_encoding)
+        for reply in self.responder(routing_key, request):
+            reply_properties = types.SimpleNamespace(correlation_id=properties.correlation_id, content_encoding='application/json')
+            self.pending.append((reply_properties, reply.to_json()))
+        return True
+
+
+class FakeConnection(object):
+    def __init__(self, channel):
+        self._channel = channel
+        self.n_opened = 0
+
+    def channel(self):
+        self.n_opened += 1
+        return self._channel
+
+    def process_data_events(self, time_limit=0):
+        while self._channel.pending:
+            properties, body = self._channel.pending.pop(0)
+            self._channel.consumer(self._channel, None, properties, body)
+
+    def close(self):
+        pass
+
+
+def history_responder(routing_key, request):
+    if routing_key == 'sensor.history':
+        return [ReplyMessage(payload={'time': [i], 'chunk': i, 'n_chunks': 3}) for i in range(3)]
+    if routing_key == 'bad':
+        return [ReplyMessage(retcode=DriplineValueError.retcode, return_msg='bad request')]
+    if routing_key == 'silent':
+        return []
+    return [ReplyMessage(payload={'value_raw': routing_key}), ReplyMessage(payload={'value_raw': 'extra'})]
+
+@pytest.fixture
+def interface():
+    interface = Interface('localhost')
+    channel = FakeChannel(history_responder)
+    interface.connection = FakeConnection(channel)
+    interface._blocking_connection = lambda: interface.connection
+    return interface
+
+def test_session_reused(interface):
+    """
+    Requests share one connection and channel, and get the first reply to each.
+    """
+    assert interface.get('sensor').payload == {'value_raw': 'sensor'}
+    assert interface.get('other').payload == {'value_raw': 'other'}
+    assert interface.connection.n_opened == 1
+
+def test_multi_reply_collects_chunks(interface):
+    """
+    With multi_reply, every chunk of a chunked result is returned, without waiting for the timeout once all arrived.
+    """
+    replies = interface.cmd('sensor', 'history', start=0, multi_reply=True, timeout=60)
+    assert [reply.payload['chunk'] for reply in replies] == [0, 1, 2]
+
+def test_multi_reply_unnumbered_until_timeout(interface):
+    replies = interface.get('sensor', multi_reply=True, timeout=0.05)
+    assert [reply.payload['value_raw'] for reply in replies] == ['sensor', 'extra']
+
+def test_retcode_and_timeout(interface):
+    with pytest.raises(DriplineValueError):
+        interface.get('bad')
+    interface._confirm_retcode = False
+    assert interface.get('silent', timeout=0.05).retcode == DriplineTimeoutError.retcode
+
+
+def deliver_alert(interface, routing_key, payload):
+    alert = AlertMessage(payload=payload)
+    interface._on_subscribed_alert(None, types.SimpleNamespace(routing_key=routing_key),
+                                   types.SimpleNamespace(content_encoding='application/json'), alert.to_json())
+
+def test_subscription_latest_and_callbacks(interface, monkeypatch):
+    """
+    Alerts matching a subscribed pattern update latest() and reach its callback; others, delivered by the widened
+    binding of a partial-word pattern, are ignored.
+    """
+    monkeypatch.setattr(interface, '_consume_subscriptions', lambda: None)
+    received = []
+    interface.subscribe('sensor_value.*_temp', callback=lambda endpoint, entry: received.append((endpoint, entry['value_cal'])))
+    deliver_alert(interface, 'sensor_value.cold_temp', {'value_raw': 1, 'value_cal': 2.})
+    deliver_alert(interface, 'sensor_value.cold_pressure', {'value_raw': 3})
+    deliver_alert(interface, 'sensor_value.cold_temp', {'value_raw': 4, 'value_cal': 5.})
+    assert received == [('cold_temp', 2.), ('cold_temp', 5.)]
+    assert interface.latest('cold_temp')['value_raw'] == 4
+    assert interface.latest('cold_temp')['routing_key'] == 'sensor_value.cold_temp'
+    assert interface.latest('cold_pressure') is None
+    interface.unsubscribe()
+    assert interface.latest('cold_temp')['value_cal'] == 5.
+
+def test_request_prepared_message(interface):
+    """
+    request sends a prepared message without checking its retcode, over the session or with a new connection.
+    """
+    assert interface.request('bad', RequestMessage(msgop=1)).retcode == DriplineValueError.retcode
+    assert [reply.payload['chunk'] for reply in interface.request('sensor.history', RequestMessage(msgop=1), multi_reply=True)] == [0, 1, 2]
+    interface.persistent_connection = False
+    sent = []
+    interface.send_request = lambda target, request, **kwargs: sent.append(target) or ReplyMessage(payload={'value_raw': target})
+    assert interface.request('sensor', RequestMessage(msgop=1), multi_reply=True)[0].payload == {'value_raw': 'sensor'}
+    assert sent == ['sensor']
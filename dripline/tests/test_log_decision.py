@@ -0,0 +1,96 @@
+""" test_log_decision.py
+Tests for the Spime logging-decision strategies, and the error bound of the readings reconstructed from what they log.
+"""
+import datetime
+import math
+import random
+
+import pytest
+from dripline.core import DriplineValueError, make_log_decision
+
+
+START = datetime.datetime(2020, 1, 1)
+
+def readings(n=2000, seed=1):
+    """
+    A slow drift with steps and noise, sampled every second.
+    """
+    generator = random.Random(seed)
+    for i in range(n):
+        value = math.sin(i / 50.) + (0.5 if (i // 400) % 2 else 0.) + generator.gauss(0, 0.01)
+        yield START + datetime.timedelta(seconds=i), value
+
+def run(decision, samples):
+    logged = []
+    for timestamp, value in samples:
+        logged.extend(decision.decide(timestamp, value, {'value_raw': value}))
+    return [(timestamp, result['value_raw']) for timestamp, result in logged]
+
+def seconds(timestamp):
+    return (timestamp - START).total_seconds()
+
+def hold(logged, timestamp):
+    return [value for log_time, value in logged if log_time <= timestamp][-1]
+
+def interpolate(logged, timestamp):
+    for (t0, v0), (t1, v1) in zip(logged, logged[1:]):
+        if t0 <= timestamp <= t1:
+            return v0 + (v1 - v0) * (seconds(timestamp) - seconds(t0)) / (seconds(t1) - seconds(t0))
+    return None
+
+def extrapolate(logged, timestamp):
+    earlier = [point for point in logged if point[0] <= timestamp]
+    if len(earlier) < 2:
+        return earlier[-1][1]
+    (t0, v0), (t1, v1) = earlier[-2:]
+    return v1 + (v1 - v0) / (seconds(t1) - seconds(t0)) * (seconds(timestamp) - seconds(t1))
+
+@pytest.mark.parametrize('config,reconstruct', [
+    ({'type': 'deadband', 'deadband': 0.05}, hold),
+    ({'type': 'swinging_door', 'deviation': 0.05}, interpolate),
+    ({'type': 'linear_extrapolation', 'deviation': 0.05}, extrapolate),
+])
+def test_reconstruction_error(config, reconstruct):
+    """
+    Every reading is reconstructed from the logged ones to within the configured bound, while logging far fewer.
+    """
+    decision = make_log_decision(config)
+    samples = list(readings())
+    logged = run(decision, samples)
+    assert logged == sorted(logged)
+    errors = [abs(value - reconstruct(logged, timestamp)) for timestamp, value in samples if timestamp <= logged[-1][0]]
+    assert max(errors) <= 0.05 + 1e-9
+    assert decision.compression_ratio > 3
+
+def test_swinging_door_logs_turning_points():
+    """
+    A straight ramp logs only its first point until it turns, when the point before the turn is logged.
+    """
+    decision = make_log_decision({'type': 'swinging_door', 'deviation': 0.1})
+    samples = [(START + datetime.timedelta(seconds=i), float(min(i, 18 - i))) for i in range(15)]
+    assert [seconds(timestamp) for timestamp, _ in run(decision, samples)] == [0., 9.]
+
+def test_threshold_fractional_change():
+    decision = make_log_decision({'max_fractional_change': 0.1, 'max_interval': 3600})
+    samples = [(START + datetime.timedelta(seconds=i), value) for i, value in enumerate([1., 1.05, 1.2, 1.25, 0.])]
+    assert [value for _, value in run(decision, samples)] == [1., 1.2, 0.]
+
+def test_threshold_non_numeric_transitions():
+    """
+    With the threshold strategy, a non-numeric reading is not logged after a numeric one, but the reverse is.
+    """
+    decision = make_log_decision({'max_interval': 3600})
+    samples = [(START + datetime.timedelta(seconds=i), value) for i, value in enumerate([1., None, None, 1.])]
+    assert [value for _, value in run(decision, samples)] == [1.]
+    decision = make_log_decision({'max_interval': 3600})
+    assert [value for _, value in run(decision, samples[1:])] == [None, 1.]
+
+@pytest.mark.parametrize('decision_type', ['deadband', 'swinging_door', 'linear_extrapolation'])
+def test_non_numeric_changes_logged(decision_type):
+    decision = make_log_decision({'type': decision_type})
+    samples = [(START + datetime.timedelta(seconds=i), value) for i, value in enumerate([1., None, None, 1., 1.])]
+    assert len(run(decision, samples)) == 3
+
+def test_unknown_type():
+    with pytest.raises(DriplineValueError):
+        make_log_decision({'type': 'psychic'})
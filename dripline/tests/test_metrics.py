@@ -0,0 +1,49 @@
+""" test_metrics.py
+Tests for the request metrics collected by services.
+"""
+import pytest
+from dripline.core import DriplineValueError, Endpoint, Histogram, RequestMessage, ServiceMetrics, constants
+
+
+def test_histogram_buckets():
+    """
+    Values count in the first bucket whose upper bound they do not exceed, or in the overflow bucket.
+    """
+    histogram = Histogram([1, 2, 5])
+    for value in [0.5, 1, 1.5, 3, 9]:
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(1.) is None
+    assert histogram.to_dict()['mean'] == pytest.approx(3.)
+
+
+class CountedEndpoint(Endpoint):
+    def on_get(self):
+        return {'value_raw': 1}
+
+    def on_set(self, value):
+        raise DriplineValueError('read only')
+
+def test_requests_counted_by_op_and_retcode(mock_service, send_request):
+    """
+    Handled requests are counted per endpoint and op, with errors by retcode.
+    """
+    endpoint = CountedEndpoint(name='counted')
+    endpoint.service = mock_service
+    for msgop, values in [(constants.OP_GET, []), (constants.OP_GET, []), (constants.OP_SET, [2])]:
+        send_request(endpoint, 'counted', RequestMessage(msgop=msgop, payload={'values': values}))
+    metrics = mock_service.request_metrics.to_dict()['endpoints']['counted']
+    assert metrics['get']['requests'] == 2
+    assert metrics['get']['errors'] == 0
+    assert metrics['get']['handler_time']['count'] == 2
+    assert metrics['get']['queue_wait']['count'] == 2
+    assert metrics['set']['errors_by_retcode'] == {str(DriplineValueError.retcode): 1}
+
+def test_publish_counts_and_reset():
+    metrics = ServiceMetrics()
+    metrics.record_publish('alerts', 100)
+    metrics.record_publish('alerts', 50)
+    assert metrics.to_dict()['published'] == {'alerts': {'messages': 2, 'bytes': 150}}
+    metrics.reset()
+    assert metrics.to_dict()['published'] == {}
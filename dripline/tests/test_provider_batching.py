@@ -0,0 +1,111 @@
+""" test_provider_batching.py
+Tests for Provider.send_batched, which combines commands from several endpoints into one hardware transaction.
+"""
+import concurrent.futures
+import threading
+
+import pytest
+from dripline.core import DriplineHardwareResponselessError, Provider, Spime, calibrate
+
+
+class EchoProvider(Provider):
+    """
+    Answers each query command 'name?' with the value in readings, in one response joined by the separator.
+    """
+    def __init__(self, **kwargs):
+        Provider.__init__(self, **kwargs)
+        self.transactions = []
+        self.threads = set()
+        self.readings = {}
+
+    def send(self, commands):
+        self.transactions.append(commands)
+        self.threads.add(threading.current_thread())
+        queries = [command for command in commands[0].split(self.batch_separator) if command.endswith('?')]
+        return [self.batch_separator.join(self.readings[query[:-1]] for query in queries)]
+
+
+@pytest.fixture
+def service(simulated_service):
+    return simulated_service
+
+@pytest.fixture
+def provider(service):
+    provider = EchoProvider(name='echo', batch_window=0.01, batch_max_commands=4)
+    provider.service = service
+    provider.readings = {'a': '1', 'b': '2', 'c': '3'}
+    return provider
+
+def test_unbatched_sent_immediately(provider):
+    provider.batch_window = 0
+    assert provider.send_batched('a?').result(0) == ['1']
+    assert provider.transactions == [['a?']]
+
+def test_commands_combined_in_one_transaction(service, provider):
+    """
+    Commands from several callers go out together when the window closes, each caller getting its own responses.
+    """
+    first = provider.send_batched(['a?', 'SET 5'])
+    second = provider.send_batched('b?')
+    # the window's timer is only started from the ioloop
+    assert not service.loop.timers
+    assert not first.done()
+    service.run_until(1.)
+    assert provider.transactions == [['a?;SET 5;b?']]
+    assert first.result(0) == ['1']
+    assert second.result(0) == ['2']
+    assert provider.batch_statistics['commands_per_transaction'] == 3.
+    # sent when the window closed, from the provider's executor rather than the ioloop
+    assert threading.current_thread() not in provider.threads
+
+def test_full_batch_sent_at_once(service, provider):
+    futures = [provider.send_batched(name + '?') for name in 'abca']
+    assert [future.result(0) for future in futures] == [['1'], ['2'], ['3'], ['1']]
+    service.run_until(1.)
+    assert len(provider.transactions) == 1
+    assert not service.loop.timers
+
+def test_missing_responses_fail_every_caller(service, provider):
+    provider.send = lambda commands: ['1']
+    futures = [provider.send_batched('a?'), provider.send_batched('b?')]
+    service.run_until(1.)
+    for future in futures:
+        with pytest.raises(DriplineHardwareResponselessError):
+            future.result(0)
+    assert provider.batch_statistics['failures'] == 1
+
+
+class BatchedSpime(Spime):
+    def __init__(self, channel, **kwargs):
+        Spime.__init__(self, **kwargs)
+        self.channel = channel
+        self.logged = []
+
+    @calibrate()
+    def on_get(self):
+        return self.provider.send_batched(self.channel + '?')
+
+    def store_value(self, alert, severity):
+        self.logged.append(alert)
+
+def test_calibrated_batched_get(service, provider):
+    spime = BatchedSpime(channel='c', name='c_reading', calibration='2*{}')
+    provider.add_endpoint(spime)
+    result = spime.on_get()
+    assert isinstance(result, concurrent.futures.Future)
+    service.run_until(1.)
+    assert result.result(0) == {'value_raw': '3', 'value_cal': 6}
+
+def test_scheduled_batched_gets(service, provider):
+    """
+    Scheduled gets of spimes sharing a provider are read in one transaction and logged once it completes.
+    """
+    spimes = [BatchedSpime(channel=channel, name=channel + '_reading', calibration='{}+0.5') for channel in 'abc']
+    for spime in spimes:
+        provider.add_endpoint(spime)
+        spime.service = service
+        spime.scheduled_action()
+    assert not any(spime.logged for spime in spimes)
+    service.run_until(1.)
+    assert provider.transactions == [['a?;b?;c?']]
+    assert [spime.logged[0]['value_cal'] for spime in spimes] == [1.5, 2.5, 3.5]
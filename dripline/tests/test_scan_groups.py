@@ -0,0 +1,116 @@
+""" test_scan_groups.py
+Tests for provider scan groups: spimes of one provider which come due together are read in one scan_read.
+"""
+import concurrent.futures
+
+import pytest
+from dripline.core import DriplineHardwareResponselessError, Provider, Spime
+
+
+class MuxProvider(Provider):
+    """
+    Answers a compound command of channel queries with their readings; fails when told to.
+    """
+    def __init__(self, **kwargs):
+        Provider.__init__(self, **kwargs)
+        self.transactions = []
+        self.readings = {}
+        self.fail = False
+
+    def send(self, commands):
+        self.transactions.append(commands[0])
+        if self.fail:
+            raise IOError('instrument not responding')
+        return ';'.join(self.readings[command] for command in commands[0].split(';'))
+
+
+class ScannedSpime(Spime):
+    def __init__(self, **kwargs):
+        Spime.__init__(self, **kwargs)
+        self.logged = []
+
+    def on_get(self):
+        raise AssertionError('scan group members are not read individually')
+
+    def store_value(self, alert, severity):
+        self.logged.append(alert)
+
+
+@pytest.fixture
+def service(simulated_service):
+    return simulated_service
+
+@pytest.fixture
+def provider(service):
+    provider = MuxProvider(name='mux')
+    provider.service = service
+    provider.readings = {'MEAS? (@101)': '1.5', 'MEAS? (@102)': '2.5', 'MEAS? (@103)': 'OPEN'}
+    return provider
+
+def make_spimes(service, provider, start=True, **kwargs):
+    spimes = []
+    for channel in (101, 102, 103):
+        spime = ScannedSpime(name='channel_{}'.format(channel), scan_group='scan', scan_command='MEAS? (@{})'.format(channel),
+                             log_interval=10., calibration='2*{}', **kwargs)
+        provider.add_endpoint(spime)
+        spime.service = service
+        spimes.append(spime)
+    if start:
+        for spime in spimes:
+            spime.schedule_status = 'on'
+    return spimes
+
+@pytest.mark.parametrize('run_in_executor', [False, True])
+def test_group_read_in_one_scan(service, provider, run_in_executor):
+    """
+    Every tick, the group's spimes are read with one compound command, and each logs its own calibrated value.
+    """
+    spimes = make_spimes(service, provider, run_in_executor=run_in_executor)
+    service.run_until(5.)
+    provider.readings['MEAS? (@101)'] = '3.5'
+    service.run_until(15.)
+    assert provider.transactions == ['MEAS? (@101);MEAS? (@102);MEAS? (@103)'] * 2
+    assert [alert['value_cal'] for alert in spimes[0].logged] == [3., 7.]
+    assert spimes[1].logged == [{'value_raw': '2.5', 'value_cal': 5.}]
+    assert spimes[2].logged[0]['value_raw'] == 'OPEN'
+
+def test_failed_scan_logs_nothing(service, provider):
+    spimes = make_spimes(service, provider)
+    provider.fail = True
+    service.run_until(15.)
+    assert len(provider.transactions) == 2
+    assert not any(spime.logged for spime in spimes)
+
+def test_busy_scan_skips_tick(service, provider):
+    """
+    With run_in_executor, a tick which comes while the previous scan of the group is still running is skipped.
+    """
+    spimes = make_spimes(service, provider, run_in_executor=True)
+    service.run_until(1.)
+    provider._scan_busy['scan'] = concurrent.futures.Future()
+    service.run_until(15.)
+    assert len(provider.transactions) == 1
+    assert all(spime.schedule_skipped_ticks == 1 for spime in spimes)
+
+def test_scan_read_requires_scan_commands(provider):
+    spime = ScannedSpime(name='unscannable', scan_group='scan')
+    with pytest.raises(NotImplementedError):
+        provider.scan_read([spime])
+
+def test_scan_read_short_response(provider):
+    spimes = [ScannedSpime(name=name, scan_group='scan', scan_command=command) for name, command in [('a', 'MEAS? (@101)'), ('b', 'MEAS? (@102)')]]
+    provider.send = lambda commands: ['1.5']
+    with pytest.raises(DriplineHardwareResponselessError):
+        provider.scan_read(spimes)
+
+def test_staggered_starts_share_grid(service, provider):
+    """
+    Members whose loops start a few milliseconds apart join the grid of the first, and are read together from then on.
+    """
+    spimes = make_spimes(service, provider, start=False)
+    for spime in spimes:
+        spime.schedule_status = 'on'
+        service.run_until(service.now + 0.005)
+    service.run_until(35.)
+    assert provider.transactions == ['MEAS? (@101)'] + ['MEAS? (@101);MEAS? (@102);MEAS? (@103)'] * 3
+    assert [len(spime.logged) for spime in spimes] == [1, 1, 1]
@@ -0,0 +1,217 @@
+""" test_schedule_dispatcher.py
+Tests and a simulated-time benchmark for the service-level ScheduleDispatcher, and for the fixed-rate, fixed-delay,
+overrun, stagger and adaptive-interval behaviour of the Scheduler loops it runs.
+"""
+import pytest
+from dripline.core import Provider, ScheduleDispatcher, Scheduler, Spime
+
+
+@pytest.fixture
+def dispatcher(sim_loop):
+    return ScheduleDispatcher(add_timeout=sim_loop.add_timeout,
+                              remove_timeout=sim_loop.remove_timeout,
+                              clock=sim_loop.clock,
+                             )
+
+def test_dispatcher_runs_in_order(sim_loop, dispatcher):
+    """
+    Tasks run in due-time order and only once.
+    """
+    calls = []
+    dispatcher.add(lambda: calls.append('b'), 2.)
+    dispatcher.add(lambda: calls.append('a'), 1.)
+    sim_loop.run_until(10.)
+    assert calls == ['a', 'b']
+    assert dispatcher.pending == 0
+
+def test_dispatcher_cancel_and_reschedule(sim_loop, dispatcher):
+    """
+    Cancelled tasks do not run and rescheduled tasks run only at their new time.
+    """
+    calls = []
+    cancelled = dispatcher.add(lambda: calls.append('cancelled'), 1.)
+    moved = dispatcher.add(lambda: calls.append(sim_loop.now), 1.)
+    dispatcher.cancel(cancelled)
+    dispatcher.reschedule(moved, 5.)
+    sim_loop.run_until(10.)
+    assert calls == [5.]
+
+def test_dispatcher_single_timer(sim_loop, dispatcher):
+    """
+    Co-due tasks share one ioloop timer.
+    """
+    for i in range(100):
+        dispatcher.add(lambda: None, 1.)
+    sim_loop.run_until(2.)
+    assert len(sim_loop.timers) == 0
+    assert dispatcher.statistics['dispatches'] == 1
+    assert dispatcher.statistics['tasks_run'] == 100
+
+
+class BenchSpime(Spime):
+    def on_get(self):
+        return {'value_raw': 1.}
+
+    def store_value(self, alert, severity):
+        pass
+
+class BenchService(object):
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+
+def test_dispatcher_benchmark_10k_spimes(sim_loop, dispatcher):
+    """
+    Schedule 10k spimes over ten simulated minutes: every tick runs, with one ioloop timer per dispatch.
+    """
+    service = BenchService(dispatcher)
+    spimes = []
+    for i in range(10000):
+        spime = BenchSpime(name='spime_{}'.format(i), log_interval=[10, 30, 60][i % 3], max_interval=3600, delay_start=True)
+        spime.service = service
+        spimes.append(spime)
+    for spime in spimes:
+        spime.schedule_status = 'on'
+    sim_loop.run_until(600.)
+    stats = dispatcher.statistics
+    expected = sum(600 // spime.schedule_interval for spime in spimes)
+    assert stats['tasks_run'] == expected
+    assert sim_loop.n_added <= stats['dispatches'] + 1
+
+
+class Ticker(Scheduler):
+    """
+    Records the simulated time of each scheduled event, which then takes the next of <durations> (in simulated seconds).
+    """
+    def __init__(self, sim_loop, durations=(), **kwargs):
+        Scheduler.__init__(self, **kwargs)
+        self.name = 'ticker'
+        self.sim_loop = sim_loop
+        self.durations = list(durations)
+        self.times = []
+
+    def scheduled_action(self):
+        self.times.append(self.sim_loop.now)
+        if self.durations:
+            self.sim_loop.now += self.durations.pop(0)
+
+def start_ticker(sim_loop, dispatcher, **kwargs):
+    ticker = Ticker(sim_loop, **kwargs)
+    ticker.service = BenchService(dispatcher)
+    ticker.schedule_status = 'on'
+    return ticker
+
+@pytest.mark.parametrize('schedule_mode,times', [
+    ('fixed_rate', [0., 10., 20., 30.]),
+    ('fixed_delay', [0., 13., 26., 39.]),
+])
+def test_schedule_modes(sim_loop, dispatcher, schedule_mode, times):
+    """
+    A fixed_rate loop keeps to its grid however long events take; a fixed_delay loop waits the interval after each.
+    """
+    ticker = start_ticker(sim_loop, dispatcher, schedule_interval=10., schedule_mode=schedule_mode, durations=[3.] * 4)
+    sim_loop.run_until(39.)
+    assert ticker.times == times
+    assert ticker.schedule_overruns == 0
+
+@pytest.mark.parametrize('overrun_policy,times,skipped', [
+    ('skip', [0., 20., 30., 40.], 1),
+    ('immediate', [0., 15., 20., 30., 40.], 0),
+])
+def test_overrun_policies(sim_loop, dispatcher, overrun_policy, times, skipped):
+    """
+    After an event overruns the next tick, 'skip' waits for the following grid point and 'immediate' runs at once;
+    either way the loop then resumes its grid.
+    """
+    ticker = start_ticker(sim_loop, dispatcher, schedule_interval=10., overrun_policy=overrun_policy, durations=[15.])
+    sim_loop.run_until(40.)
+    assert ticker.times == times
+    assert ticker.schedule_overruns == 1
+    assert ticker.schedule_skipped_ticks == skipped
+
+def test_bad_schedule_options():
+    with pytest.raises(ValueError):
+        Ticker(None, schedule_mode='whenever')
+    with pytest.raises(ValueError):
+        Ticker(None, overrun_policy='queue')
+
+
+class RecordingSpime(BenchSpime):
+    def on_get(self):
+        self.times.append(self.service.dispatcher.clock())
+        return {'value_raw': 1.}
+
+def test_provider_stagger(sim_loop, dispatcher):
+    """
+    Loops of one provider with the same interval get stable slots, and start at phases spread over the interval;
+    a loop with another interval, or without stagger, starts at once.
+    """
+    provider = Provider(name='instrument')
+    service = BenchService(dispatcher)
+    spimes = []
+    for name, interval, stagger in [('a', 10, True), ('b', 10, True), ('c', 10, True), ('slow', 60, True), ('d', 10, False)]:
+        spime = RecordingSpime(name=name, log_interval=interval, stagger=stagger, max_interval=3600)
+        spime.times = []
+        provider.add_endpoint(spime)
+        spime.service = service
+        spimes.append(spime)
+    a, b, c, slow, d = spimes
+    assert [provider.stagger_slot(spime) for spime in (a, b, c, slow)] == [0, 1, 2, 0]
+    assert provider.stagger_slot(b) == 1
+    assert a.schedule_phase == 0.
+    assert b.schedule_phase == pytest.approx(6.180, abs=1e-3)
+    assert c.schedule_phase == pytest.approx(2.361, abs=1e-3)
+    assert d.schedule_phase == 0.
+    for spime in spimes:
+        spime.schedule_status = 'on'
+    sim_loop.run_until(25.)
+    assert a.times == [0., 10., 20.]
+    assert b.times == pytest.approx([6.180, 16.180], abs=1e-3)
+    assert c.times == pytest.approx([2.361, 12.361, 22.361], abs=1e-3)
+    assert slow.times == [0.]
+    assert d.times == [0., 10., 20.]
+
+
+class AdaptiveSpime(BenchSpime):
+    """
+    Reads its current value, recording the simulated time of each read.
+    """
+    def __init__(self, **kwargs):
+        BenchSpime.__init__(self, **kwargs)
+        self.value = 1.
+        self.times = []
+
+    def on_get(self):
+        self.times.append(self.service.now)
+        return {'value_raw': self.value}
+
+def intervals(times):
+    return [later - earlier for earlier, later in zip(times, times[1:])]
+
+def test_adaptive_interval(simulated_service):
+    """
+    While readings do not change, the interval doubles up to max_schedule_interval; a change drops it back to the minimum.
+    """
+    spime = AdaptiveSpime(name='adaptive', log_interval=1., min_schedule_interval=1., max_schedule_interval=16., max_interval=3600)
+    spime.service = simulated_service
+    spime.schedule_status = 'on'
+    simulated_service.run_until(50.)
+    assert intervals(spime.times) == [1., 2., 4., 8., 16., 16.]
+    spime.value = 5.
+    simulated_service.run_until(70.)
+    assert intervals(spime.times)[6:] == [16., 1., 2., 4.]
+    assert spime.effective_interval == 8.
+
+def test_adaptive_interval_in_executor(simulated_service):
+    """
+    In an executor, a reading adapts the interval after the next tick is already scheduled: that tick stands, and the
+    new interval applies from it on.
+    """
+    spime = AdaptiveSpime(name='adaptive', log_interval=1., min_schedule_interval=1., max_schedule_interval=16., max_interval=3600,
+                          run_in_executor=True)
+    spime.service = simulated_service
+    spime.schedule_status = 'on'
+    simulated_service.run_until(40.)
+    assert intervals(spime.times) == [1., 1., 2., 4., 8., 16.]
+    spime.value = 5.
+    simulated_service.run_until(72.)
+    assert intervals(spime.times)[6:] == [16., 16., 1., 2., 4.]
@@ -0,0 +1,113 @@
+""" test_socket_provider.py
+Tests for SocketPoolProvider against a local TCP server.
+"""
+import socket
+import threading
+
+import pytest
+from dripline.core import DriplineHardwareConnectionError, SocketPoolProvider
+
+
+class LineServer(object):
+    """
+    Answers each line received with 'echo:<line>', on every connection; drop() closes the open connections.
+    """
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.address = self.listener.getsockname()
+        self.connections = []
+        self.n_accepted = 0
+        thread = threading.Thread(target=self._accept)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            self.n_accepted += 1
+            self.connections.append(connection)
+            thread = threading.Thread(target=self._serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        buffer = b''
+        while True:
+            try:
+                data = connection.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buffer += data
+            while b'\n' in buffer:
+                line, buffer = buffer.split(b'\n', 1)
+                connection.sendall(b'echo:' + line + b'\n')
+
+    def drop(self):
+        for connection in self.connections:
+            connection.shutdown(socket.SHUT_RDWR)
+            connection.close()
+        self.connections = []
+
+    def close(self):
+        self.drop()
+        self.listener.close()
+
+
+@pytest.fixture
+def server():
+    server = LineServer()
+    yield server
+    server.close()
+
+@pytest.fixture
+def provider(server):
+    provider = SocketPoolProvider(name='pooled', socket_info=server.address, reconnect_backoff=0.)
+    yield provider
+    provider.close_connections()
+
+def test_persistent_connection(server, provider):
+    assert provider.send(['a', 'b']) == 'echo:a;echo:b'
+    assert provider.send('c') == 'echo:c'
+    assert server.n_accepted == 1
+    stats = provider.connection_statistics[0]
+    assert stats['transactions'] == 3
+    assert stats['reconnects'] == 0
+
+def test_reconnect_after_failure(server, provider):
+    """
+    A dropped connection fails the command in progress, then is reopened and counted as one reconnect.
+    """
+    provider.send('a')
+    server.drop()
+    with pytest.raises(DriplineHardwareConnectionError):
+        provider.send('b')
+    assert provider.send('c') == 'echo:c'
+    assert server.n_accepted == 2
+    assert provider.connection_statistics[0]['reconnects'] == 1
+
+def test_check_connections(server, provider):
+    provider.health_check_command = 'ping'
+    assert provider.check_connections() == {0: True}
+    server.drop()
+    assert provider.check_connections() == {0: False}
+    assert provider.check_connections() == {0: True}
+
+
+def test_scheduled_health_checks(server, provider, simulated_service):
+    """
+    With health_check_interval, idle connections are checked periodically once the service starts.
+    """
+    service = simulated_service
+    provider.service = service
+    provider.health_check_interval = 10.
+    provider.health_check_command = 'ping'
+    provider.on_service_start()
+    service.run_until(35.)
+    assert provider.connection_statistics[0]['transactions'] == 3
@@ -0,0 +1,78 @@
+""" test_sql_sink.py
+Tests for SQLSink, writing batches of sensor_value alerts to an SQLite database.
+"""
+import sqlite3
+import types
+
+import pytest
+from dripline.core import AlertMessage, SQLSink
+
+
+@pytest.fixture
+def database(tmpdir):
+    return str(tmpdir.join('readings.db'))
+
+def make_sink(database, **kwargs):
+    return SQLSink(name='sql_sink', broker='localhost', connect_args=[database], **kwargs)
+
+def alert(endpoint_name, value_raw, value_cal=None):
+    payload = {'value_raw': value_raw}
+    if value_cal is not None:
+        payload['value_cal'] = value_cal
+    return AlertMessage(payload=payload), types.SimpleNamespace(routing_key='sensor_value.' + endpoint_name)
+
+def rows(database, table):
+    connection = sqlite3.connect(database)
+    try:
+        return connection.execute('SELECT endpoint_name, value_raw, value_cal FROM {} ORDER BY rowid'.format(table)).fetchall()
+    finally:
+        connection.close()
+
+def test_batch_split_by_kind(database):
+    """
+    Numeric and string readings go to their own tables, with one executemany per table.
+    """
+    sink = make_sink(database, create_tables=True)
+    sink.this_consume_batch([alert('temperature', 1.5, 3.), alert('valve', 'open'), alert('temperature', 2, 4.),
+                             alert('flag', True, 1)])
+    assert rows(database, 'numeric_data') == [('temperature', 1.5, 3.), ('temperature', 2, 4.)]
+    assert rows(database, 'string_data') == [('valve', 'open', None), ('flag', 'True', '1')]
+    assert sink.sink_statistics['rows_inserted'] == 4
+
+def test_executemany_per_table(database, monkeypatch):
+    sink = make_sink(database, create_tables=True)
+    calls = []
+    class CountingCursor(object):
+        def __init__(self, cursor):
+            self._cursor = cursor
+        def executemany(self, statement, these_rows):
+            calls.append((statement, len(these_rows)))
+            return self._cursor.executemany(statement, these_rows)
+    connection = sink._connect()
+    monkeypatch.setattr(sink, '_connect', lambda: types.SimpleNamespace(cursor=lambda: CountingCursor(connection.cursor()),
+                                                                        commit=connection.commit, rollback=connection.rollback))
+    sink.this_consume_batch([alert('a', i) for i in range(100)] + [alert('b', 'text')])
+    assert sorted(n_rows for _, n_rows in calls) == [1, 100]
+    assert len(set(statement for statement, _ in calls)) == 2
+
+def test_kind_without_table_dropped(database):
+    sink = make_sink(database, create_tables=True, data_tables_dict={'numeric': 'numeric_data'})
+    sink.this_consume_batch([alert('a', 1.), alert('b', 'text')])
+    assert rows(database, 'numeric_data') == [('a', 1., None)]
+    assert sink.sink_statistics['rows_dropped'] == 1
+
+def test_failed_batch_rolled_back(database):
+    """
+    If any insert of a batch fails, none of it is committed, so alerts retried after it are not stored twice.
+    """
+    connection = sqlite3.connect(database)
+    connection.execute('CREATE TABLE numeric_data (endpoint_name, timestamp, value_raw, value_cal, memo)')
+    connection.commit()
+    connection.close()
+    sink = make_sink(database)
+    with pytest.raises(sqlite3.OperationalError):
+        sink.this_consume_batch([alert('a', 1.), alert('b', 'no string table')])
+    assert rows(database, 'numeric_data') == []
+    assert sink.sink_statistics['failed_batches'] == 1
+    sink.this_consume_batch([alert('a', 1.)])
+    assert rows(database, 'numeric_data') == [('a', 1., None)]
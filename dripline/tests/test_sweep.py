@@ -0,0 +1,199 @@
+""" test_sweep.py
+Tests for Provider.sweep, stepping one endpoint through a list of values and reading others at every step.
+"""
+import concurrent.futures
+import threading
+
+import pytest
+from dripline.core import ChunkedResult, DriplineAccessDenied, DriplineValueError, Endpoint, Provider, RequestMessage, Spimescape, OP_CMD
+
+
+class Source(Endpoint):
+    def __init__(self, **kwargs):
+        Endpoint.__init__(self, **kwargs)
+        self.value = 0.
+        self.threads = set()
+
+    def on_set(self, value):
+        self.threads.add(threading.current_thread())
+        self.value = value
+        return value
+
+
+class Detector(Endpoint):
+    """
+    Reads twice the source's value, as a calibrated reading; fails if told to, at values above fail_above.
+    """
+    def __init__(self, source, fail_above=None, **kwargs):
+        Endpoint.__init__(self, **kwargs)
+        self.source = source
+        self.fail_above = fail_above
+        self.gain = 2.
+
+    def on_get(self):
+        if self.fail_above is not None and self.source.value > self.fail_above:
+            raise IOError('detector saturated')
+        return {'value_raw': str(self.source.value), 'value_cal': self.gain * self.source.value}
+
+
+@pytest.fixture
+def provider():
+    provider = Provider(name='bench')
+    source = Source(name='source')
+    provider.add_endpoint(source)
+    provider.add_endpoint(Detector(name='detector', source=source))
+    provider.add_endpoint(Detector(name='fragile', source=source, fail_above=1.))
+    return provider
+
+def test_sweep_values(provider):
+    """
+    Each listed value is set in turn, and every readback recorded with its calibrated value.
+    """
+    result = provider.sweep(1., 2., 3., set_target='source', readbacks=['detector', 'detector.gain'])
+    assert result['values'] == [1., 2., 3.]
+    assert result['detector'] == [2., 4., 6.]
+    assert result['detector.gain'] == [2.] * 3
+    assert len(result['times']) == 3
+    assert result['errors'] == []
+
+def test_sweep_range(provider):
+    result = provider.sweep(set_target='detector.gain', start=0., stop=1., n_points=5, readbacks='detector')
+    assert result['values'] == [0., 0.25, 0.5, 0.75, 1.]
+    assert result['detector'] == [0.] * 5
+
+def test_sweep_readback_errors(provider):
+    """
+    A failed readback is recorded as None, with the error, and the sweep carries on.
+    """
+    result = provider.sweep(0., 1., 2., 3., set_target='source', readbacks=['fragile', 'detector'])
+    assert result['fragile'] == [0., 2., None, None]
+    assert result['detector'] == [0., 2., 4., 6.]
+    assert [error[:2] for error in result['errors']] == [[2, 'fragile'], [3, 'fragile']]
+
+@pytest.mark.parametrize('kwargs', [
+    {'readbacks': ['detector']},
+    {'set_target': 'missing', 'start': 0, 'stop': 1, 'n_points': 2},
+    {'set_target': 'source', 'start': 0, 'stop': 1, 'n_points': 2, 'readbacks': ['missing']},
+])
+def test_sweep_bad_request(provider, kwargs):
+    with pytest.raises(DriplineValueError):
+        provider.sweep(**kwargs)
+
+def test_sweep_only_own_endpoints(provider):
+    """
+    Endpoints of other providers in the same service cannot be swept or read.
+    """
+    service = Spimescape(name='sweeping_service', broker='localhost', keys=[])
+    service.add_endpoint(provider)
+    other = Provider(name='other_bench')
+    other.add_endpoint(Source(name='other_source'))
+    service.add_endpoint(other)
+    with pytest.raises(DriplineValueError):
+        provider.sweep(1., set_target='other_source')
+    with pytest.raises(DriplineValueError):
+        provider.sweep(1., set_target='source', readbacks=['other_source'])
+
+def test_sweep_locked_target(provider, mock_service, send_request):
+    """
+    A locked set_target can only be swept with its lockout_key, which a sweep request passes on.
+    """
+    source = provider.endpoints['source']
+    key = source.lock('5ca1ab1e' * 4)['key']
+    with pytest.raises(DriplineAccessDenied):
+        provider.sweep(1., set_target='source.value')
+    with pytest.raises(DriplineAccessDenied):
+        provider.sweep(1., set_target='source', lockout_key='0' * 32)
+    assert source.value == 0.
+    provider.service = mock_service
+    send_request(provider, 'bench.sweep', RequestMessage(msgop=OP_CMD, payload={'values': [1., 2.], 'set_target': 'source'}))
+    send_request(provider, 'bench.sweep', RequestMessage(msgop=OP_CMD, lockout_key=key,
+                                                         payload={'values': [1., 2.], 'set_target': 'source', 'readbacks': ['detector']}))
+    denied, swept = mock_service.replies
+    assert denied.retcode == DriplineAccessDenied.retcode
+    assert swept.retcode == 0
+    assert swept.payload['detector'] == [2., 4.]
+
+
+class DoneFutureSource(Source):
+    def on_set(self, value):
+        future = concurrent.futures.Future()
+        future.set_result(Source.on_set(self, value))
+        return future
+
+class Instrument(Provider):
+    """
+    Answers each batched MEAS? with the last value set by a batched SRC command.
+    """
+    def __init__(self, **kwargs):
+        Provider.__init__(self, **kwargs)
+        self.level = 0.
+
+    def send(self, commands):
+        responses = []
+        for command in commands[0].split(self.batch_separator):
+            if command.startswith('SRC '):
+                self.level = float(command.split()[1])
+            else:
+                responses.append(str(self.level))
+        return self.batch_separator.join(responses)
+
+class BatchedSource(Endpoint):
+    def on_set(self, value):
+        return self.provider.send_batched('SRC {}'.format(value))
+
+class BatchedMeter(Endpoint):
+    def on_get(self):
+        return self.provider.send_batched('MEAS?')
+
+def test_sweep_resolves_futures(provider):
+    source = DoneFutureSource(name='future_source')
+    provider.add_endpoint(source)
+    provider.add_endpoint(Detector(name='future_detector', source=source))
+    result = provider.sweep(1., 2., set_target='future_source', readbacks=['future_detector'])
+    assert result['future_detector'] == [2., 4.]
+
+def test_sweep_sends_pending_batches(simulated_service):
+    """
+    A sweep in the provider's executor sends the batches its endpoints are waiting on itself, rather than waiting
+    for their timer to send them from the same executor.
+    """
+    instrument = Instrument(name='instrument', batch_window=10.)
+    instrument.add_endpoint(BatchedSource(name='level'))
+    instrument.add_endpoint(BatchedMeter(name='meter'))
+    instrument.service = simulated_service
+    future = instrument.sweep(1., 2., 3., set_target='level', readbacks=['meter'])
+    assert future.result(5)['meter'] == [['1.0'], ['2.0'], ['3.0']]
+    assert instrument.batch_statistics['transactions'] == 6
+
+def test_sweep_chunked(provider):
+    result = provider.sweep(*range(5), set_target='source', readbacks=['fragile'], chunk_size=2)
+    assert isinstance(result, ChunkedResult)
+    assert [chunk['values'] for chunk in result] == [[0, 1], [2, 3], [4]]
+    assert [chunk['n_chunks'] for chunk in result] == [3] * 3
+    assert [len(chunk['errors']) for chunk in result] == [0, 2, 1]
+
+
+class RunningService(Spimescape):
+    """
+    A service which appears connected, so that sweeps are run in an executor.
+    """
+    def __init__(self, **kwargs):
+        Spimescape.__init__(self, **kwargs)
+        self._connection = object()
+
+def test_sweep_in_provider_executor(provider):
+    """
+    In a running service, a sweep runs in the provider's own executor, which its endpoints' scheduled work also uses.
+    """
+    service = RunningService(name='sweeping_service', broker='localhost', keys=[])
+    service.add_endpoint(provider)
+    try:
+        future = provider.sweep(1., 2., set_target='source', readbacks=['detector'])
+        assert future.result(5)['detector'] == [2., 4.]
+        assert provider.executor is not None
+        assert service.executor_for(provider.endpoints['detector']) is provider.executor
+        (thread,) = provider.endpoints['source'].threads
+        assert thread is not threading.current_thread()
+    finally:
+        for executor in service._provider_executors:
+            executor.shutdown()
@@ -0,0 +1,37 @@
+""" test_topic_trie.py
+Tests for TopicTrie, the routing-key matcher behind Gogol's on_alert handlers.
+"""
+import pytest
+from dripline.core import TopicTrie, binding_key
+
+
+@pytest.fixture
+def trie():
+    trie = TopicTrie()
+    for pattern in ['sensor_value.*_temp', 'sensor_value.#', 'a.*.c', 'a.#.c', 'sensor_value.cpu_temp']:
+        trie.add(pattern, pattern)
+    return trie
+
+@pytest.mark.parametrize('routing_key,expected', [
+    ('sensor_value.cpu_temp', ['sensor_value.*_temp', 'sensor_value.#', 'sensor_value.cpu_temp']),
+    ('sensor_value.pressure', ['sensor_value.#']),
+    ('sensor_value', ['sensor_value.#']),
+    ('a.b.c', ['a.*.c', 'a.#.c']),
+    ('a.c', ['a.#.c']),
+    ('a.b.b.c', ['a.#.c']),
+    ('status_message.x', []),
+])
+def test_match(trie, routing_key, expected):
+    """
+    Every matching pattern is found once, in the order added, with AMQP topic semantics.
+    """
+    assert trie.match(routing_key) == expected
+    # second lookup comes from the cache
+    assert trie.match(routing_key) == expected
+
+def test_binding_key():
+    """
+    Partial-word wildcards are widened to a whole-word wildcard for the broker.
+    """
+    assert binding_key('sensor_value.*_temp') == 'sensor_value.*'
+    assert binding_key('sensor_value.#') == 'sensor_value.#'
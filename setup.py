@@ -45,7 +45,9 @@ extras_require = {
             'sphinx_rtd_theme',
             'sphinxcontrib-programoutput',
             'better-apidoc',
-           ]
+           ],
+    # reading histories (Spime history_length) and the SegmentArchive
+    'numpy': ['numpy'],
 }
 everything = set()
 for deps in extras_require.values():
@@ -66,6 +68,7 @@ setup(
     install_requires=requirements,
     extras_require=extras_require,
     url='http://www.github.com/project8/dripline',
+    entry_points={'console_scripts': ['dripline-bench=dripline.bench:main']},
     tests_require=['pytest'],
     cmdclass={'test': PyTest}
 )